@@ -11,9 +11,17 @@ from typing import List, Dict, Optional, Tuple
 import json
 import re
 from models import db, Lead, LeadStatus, LeadSource, Message, MessageTemplate, Campaign, CampaignResult, Interaction
+from lead_scoring import SOURCE_SCORES, DEFAULT_SOURCE_SCORE, NEXT_BEST_ACTIONS, FALLBACK_ACTION, load_scoring_inputs, score_leads
+from conversion_model import conversion_model_registry
+from llm_cache import llm_cache, cache_key
 
 logger = logging.getLogger(__name__)
 
+CHAT_MODEL = "gpt-3.5-turbo"
+
+# Marcador que el LLM deja en el análisis de intención y se completa por lead: la respuesta cacheada sirve para todos
+NAME_PLACEHOLDER = '{nombre}'
+
 class NexaAI:
     def __init__(self):
         self.openai_client = None
@@ -35,17 +43,27 @@ class NexaAI:
         except Exception as e:
             logger.error(f"Error configurando OpenAI: {e}")
     
-    def analyze_lead_intent(self, message_content: str, lead_data: Dict) -> Dict:
-        """Analizar la intención del lead usando IA"""
+    def analyze_lead_intent(self, message_content: str, lead_data: Dict, use_cache: bool = True) -> Dict:
+        """Analizar la intención del lead usando IA (use_cache=False fuerza una consulta nueva)"""
         try:
             if not self.openai_client:
                 return self._fallback_intent_analysis(message_content, lead_data)
             
-            prompt = f"""
+            # La clave depende solo del mensaje normalizado: el nombre del lead se completa después
+            key = cache_key(CHAT_MODEL, 'intent', message_content)
+            content = self._cached_completion(key, 'intent', use_cache, self._intent_prompt(message_content), 300, 0.7)
+            result = json.loads(content)
+            return self._fill_placeholders(result, lead_data.get('name') or 'Estimado cliente')
+            
+        except Exception as e:
+            logger.error(f"Error analizando intención: {e}")
+            return self._fallback_intent_analysis(message_content, lead_data)
+    
+    def _intent_prompt(self, message_content: str) -> str:
+        return f"""
             Analiza la intención del siguiente mensaje de un lead potencial para una constructora:
             
             Mensaje: "{message_content}"
-            Lead: {lead_data.get('name', 'Sin nombre')} - {lead_data.get('company', 'Sin empresa')}
             
             Clasifica la intención en una de estas categorías:
             1. CONSULTA_GENERAL - Preguntas generales sobre servicios
@@ -59,24 +77,52 @@ class NexaAI:
             - Nivel de urgencia (1-5)
             - Probabilidad de conversión (1-5)
             - Acción recomendada
-            - Respuesta sugerida
+            - Respuesta sugerida (escribe {NAME_PLACEHOLDER} donde va el nombre del lead)
             
             Responde en formato JSON.
             """
-            
-            response = self.openai_client.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=300,
-                temperature=0.7
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            return result
-            
-        except Exception as e:
-            logger.error(f"Error analizando intención: {e}")
-            return self._fallback_intent_analysis(message_content, lead_data)
+    
+    def _cached_completion(self, key: str, kind: str, use_cache: bool, prompt: str,
+                           max_tokens: int, temperature: float) -> str:
+        """Texto de la respuesta del chat-completion, desde la caché si está; las respuestas nuevas se guardan"""
+        if use_cache:
+            cached = llm_cache.get(key)
+            if cached is not None:
+                return cached
+        else:
+            llm_cache.record_bypass()
+        content = self._completion(prompt, max_tokens, temperature)
+        # Solo se guardan respuestas utilizables (el análisis de intención debe ser JSON válido)
+        if kind != 'intent' or self._is_json(content):
+            llm_cache.set(key, kind, CHAT_MODEL, content)
+        return content
+    
+    def _completion(self, prompt: str, max_tokens: int, temperature: float) -> str:
+        response = self.openai_client.ChatCompletion.create(
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return response.choices[0].message.content.strip()
+    
+    @staticmethod
+    def _is_json(content: str) -> bool:
+        try:
+            json.loads(content)
+            return True
+        except ValueError:
+            return False
+    
+    def _fill_placeholders(self, value, name: str):
+        """Completar el marcador del nombre en una respuesta (texto o JSON)"""
+        if isinstance(value, str):
+            return value.replace(NAME_PLACEHOLDER, name)
+        if isinstance(value, dict):
+            return {key: self._fill_placeholders(item, name) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._fill_placeholders(item, name) for item in value]
+        return value
     
     def _fallback_intent_analysis(self, message_content: str, lead_data: Dict) -> Dict:
         """Análisis de intención sin IA como fallback"""
@@ -141,16 +187,20 @@ class NexaAI:
             # Análisis basado en múltiples factores
             factors = {
                 'source_score': self._get_source_score(lead.source),
-                'interaction_score': self._get_interaction_score(lead.id),
+                'interaction_score': self._get_interaction_score(lead.interaction_count or 0),
                 'response_time_score': self._get_response_time_score(lead),
                 'interest_level_score': lead.interest_level / 5.0,
                 'company_score': 1.0 if lead.company else 0.5,
                 'email_score': 1.0 if lead.email else 0.5
             }
             
-            # Calcular score total
-            total_score = sum(factors.values()) / len(factors)
-            conversion_prob = min(total_score * 100, 95)  # Máximo 95%
+            # Calcular score total: modelo entrenado si hay uno publicado, promedio de factores si no
+            model = conversion_model_registry.current()
+            if model and lead.id is not None:
+                conversion_prob = float(model.predict(load_scoring_inputs([lead.id]))[0])
+            else:
+                total_score = sum(factors.values()) / len(factors)
+                conversion_prob = min(total_score * 100, 95)  # Máximo 95%
             
             # Determinar recomendaciones
             recommendations = self._get_conversion_recommendations(factors, conversion_prob)
@@ -159,7 +209,8 @@ class NexaAI:
                 'conversion_probability': round(conversion_prob, 1),
                 'factors': factors,
                 'recommendations': recommendations,
-                'next_best_action': self._get_next_best_action(lead, conversion_prob)
+                'next_best_action': self._get_next_best_action(lead, conversion_prob),
+                'model_version': model.version if model else None
             }
             
         except Exception as e:
@@ -168,19 +219,10 @@ class NexaAI:
     
     def _get_source_score(self, source: LeadSource) -> float:
         """Calcular score basado en la fuente del lead"""
-        source_scores = {
-            LeadSource.WEBSITE: 0.8,
-            LeadSource.WHATSAPP: 0.9,
-            LeadSource.REFERIDO: 0.95,
-            LeadSource.REDES_SOCIALES: 0.7,
-            LeadSource.EVENTO: 0.85,
-            LeadSource.OTRO: 0.6
-        }
-        return source_scores.get(source, 0.6)
+        return SOURCE_SCORES.get(source, DEFAULT_SOURCE_SCORE)
     
-    def _get_interaction_score(self, lead_id: int) -> float:
-        """Calcular score basado en interacciones"""
-        interactions = Interaction.query.filter_by(lead_id=lead_id).count()
+    def _get_interaction_score(self, interactions: int) -> float:
+        """Calcular score basado en la cantidad de interacciones (Lead.interaction_count)"""
         if interactions == 0:
             return 0.3
         elif interactions == 1:
@@ -232,24 +274,36 @@ class NexaAI:
     
     def _get_next_best_action(self, lead: Lead, conversion_prob: float) -> str:
         """Determinar la siguiente mejor acción"""
-        if conversion_prob >= 80:
-            return "Solicitar cierre de venta"
-        elif conversion_prob >= 60:
-            return "Agendar cita de presentación"
-        elif conversion_prob >= 40:
-            return "Enviar propuesta personalizada"
-        elif conversion_prob >= 20:
-            return "Enviar contenido educativo"
-        else:
-            return "Revisar si el lead está calificado"
+        for threshold, action in NEXT_BEST_ACTIONS:
+            if conversion_prob >= threshold:
+                return action
+        return FALLBACK_ACTION
+    
+    def predict_lead_conversion_batch(self, lead_ids: List[int] = None, status: str = None, source: str = None) -> Dict:
+        """Predecir la conversión de muchos leads a la vez (todos por defecto) con el scoring vectorizado"""
+        return score_leads(lead_ids, status, source)
     
-    def generate_personalized_message(self, lead: Lead, template_type: str) -> str:
-        """Generar mensaje personalizado usando IA"""
+    def generate_personalized_message(self, lead: Lead, template_type: str, use_cache: bool = True) -> str:
+        """Generar mensaje personalizado usando IA (use_cache=False fuerza una consulta nueva)"""
         try:
             if not self.openai_client:
                 return self._generate_fallback_message(lead, template_type)
             
-            prompt = f"""
+            # La clave incluye todos los datos del lead que van en el prompt: solo se reutiliza
+            # el mensaje de un lead con el mismo nombre, empresa, estado, fuente e interés
+            kind = f'message:{template_type}'
+            key = cache_key(
+                CHAT_MODEL, kind, lead.name, lead.company or '', lead.status.value, lead.source.value,
+                lead.interest_level
+            )
+            return self._cached_completion(key, kind, use_cache, self._message_prompt(lead, template_type), 200, 0.8)
+            
+        except Exception as e:
+            logger.error(f"Error generando mensaje personalizado: {e}")
+            return self._generate_fallback_message(lead, template_type)
+    
+    def _message_prompt(self, lead: Lead, template_type: str) -> str:
+        return f"""
             Genera un mensaje personalizado de WhatsApp para un lead de construcción:
             
             Lead: {lead.name} - {lead.company or 'Sin empresa'}
@@ -268,19 +322,6 @@ class NexaAI:
             
             Responde solo con el mensaje, sin formato adicional.
             """
-            
-            response = self.openai_client.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=200,
-                temperature=0.8
-            )
-            
-            return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            logger.error(f"Error generando mensaje personalizado: {e}")
-            return self._generate_fallback_message(lead, template_type)
     
     def _generate_fallback_message(self, lead: Lead, template_type: str) -> str:
         """Generar mensaje sin IA como fallback"""
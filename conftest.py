@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Fixtures compartidas de las pruebas de Nexa Lead Manager
+Cada prueba usa una aplicación Flask mínima sobre una base SQLite temporal con el esquema
+y los listeners de sesión de producción (sin importar dashboard.py, que migra la base local)
+"""
+
+import itertools
+import pytest
+from flask import Flask
+from models import db, Lead, LeadStatus, LeadSource
+from migrations import apply_schema_upgrades
+# Registran sus listeners de sesión al importarse
+import counters  # noqa: F401
+import funnel  # noqa: F401
+import rollups  # noqa: F401
+import lead_scores  # noqa: F401
+import lead_activity  # noqa: F401
+import template_registry  # noqa: F401
+import template_engine
+import conversion_model
+from llm_cache import llm_cache
+
+_phone_numbers = itertools.count(1)
+
+@pytest.fixture
+def app(tmp_path):
+    """Aplicación con contexto activo y base recién migrada"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'nexa_test.db'}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['TESTING'] = True
+    db.init_app(app)
+    # Cachés por proceso: valen para una sola base y cada prueba crea una nueva
+    template_registry.template_registry.invalidate()
+    template_registry._versions.clear()
+    template_engine._compiled.clear()
+    conversion_model.conversion_model_registry.invalidate()
+    llm_cache.memory.clear()
+    with app.app_context():
+        apply_schema_upgrades()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def make_lead(app):
+    """Crear (y confirmar) un lead con un número único; los argumentos pisan los valores por defecto"""
+    def make(commit=True, **values):
+        number = next(_phone_numbers)
+        values.setdefault('name', f'Lead {number}')
+        values.setdefault('phone_number', f'+54911{number:08d}')
+        values.setdefault('status', LeadStatus.NUEVO)
+        values.setdefault('source', LeadSource.WHATSAPP)
+        lead = Lead(**values)
+        db.session.add(lead)
+        if commit:
+            db.session.commit()
+        return lead
+    return make
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Modelo de conversión entrenado (regresión logística en NumPy) para Nexa Lead Manager
+El entrenamiento usa los leads cerrados (convertidos vs. perdidos) con sus features al momento del
+cierre y guarda cada versión (medias, escalas y pesos + métricas) en conversion_model_version, en la
+misma transacción que sube el contador de stat_counter; todos los procesos, de cualquier servidor,
+detectan la versión nueva con el contador y la leen de la base sin reiniciar
+"""
+
+import io
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+import numpy as np
+from flask import g, has_app_context
+from sqlalchemy import case, func, select
+from models import db, Lead, LeadSource, LeadStatus, LeadStatusChange, Message, Interaction, ConversionModelVersion
+from counters import apply_deltas, read_counters, CONVERSION_MODEL_VERSION_KEY
+from lead_scoring import load_scoring_inputs, days_since, fetch_matrix
+
+logger = logging.getLogger(__name__)
+
+MIN_TRAINING_SAMPLES = 20
+HOLDOUT_FRACTION = 0.2
+
+FEATURE_NAMES = [f'source_{lead_source.value}' for lead_source in LeadSource] + [
+    'interest_level', 'log_interactions', 'log_messages', 'contacted', 'log_days_since_contact',
+    'has_company', 'has_email'
+]
+
+def build_features(inputs: Dict, now: datetime = None) -> np.ndarray:
+    """Matriz de features (una fila por lead) a partir de load_scoring_inputs"""
+    count = len(inputs['ids'])
+    features = np.zeros((count, len(FEATURE_NAMES)))
+    sources = inputs['source_index']
+    known = np.flatnonzero(sources >= 0)
+    features[known, sources[known]] = 1.0
+    column = len(LeadSource)
+    if 'as_of_day' in inputs:
+        # Entrenamiento: días entre el último contacto y el cierre de cada lead
+        days = np.floor(inputs['as_of_day'] - inputs['contact_day'])
+    else:
+        days = days_since(inputs['contact_day'], now)
+    contacted = ~np.isnan(days)
+    for values in (
+        inputs['interest_level'],
+        np.log1p(inputs['interactions']),
+        np.log1p(inputs['messages']),
+        contacted,
+        np.log1p(np.clip(np.nan_to_num(days), 0, None)),
+        inputs['has_company'],
+        inputs['has_email']
+    ):
+        features[:, column] = values
+        column += 1
+    return features
+
+def _sigmoid(values: np.ndarray) -> np.ndarray:
+    return 0.5 * (1.0 + np.tanh(0.5 * values))
+
+def fit_logistic_regression(features: np.ndarray, labels: np.ndarray, l2: float = 1.0,
+                            max_iter: int = 25, tol: float = 1e-6) -> np.ndarray:
+    """Regresión logística con regularización L2 por Newton-Raphson; devuelve [medias, escalas, pesos]"""
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1.0
+    design = np.empty((len(features), features.shape[1] + 1))
+    design[:, 0] = 1.0
+    np.divide(features - mean, scale, out=design[:, 1:])
+
+    weights = np.zeros(design.shape[1])
+    penalty = np.eye(design.shape[1]) * l2
+    penalty[0, 0] = 0.0  # el término independiente no se regulariza
+    for _ in range(max_iter):
+        probabilities = _sigmoid(design @ weights)
+        gradient = design.T @ (probabilities - labels) + penalty @ weights
+        hessian = (design.T * (probabilities * (1.0 - probabilities))) @ design + penalty
+        step = np.linalg.solve(hessian, gradient)
+        weights -= step
+        if np.abs(step).max() < tol:
+            break
+    # Primera columna: término independiente (media 0, escala 1)
+    return np.vstack([np.concatenate([[0.0], mean]), np.concatenate([[1.0], scale]), weights])
+
+def _predict(params: np.ndarray, features: np.ndarray) -> np.ndarray:
+    mean, scale, weights = params[0, 1:], params[1, 1:], params[2]
+    return _sigmoid(weights[0] + ((features - mean) / scale) @ weights[1:])
+
+def _metrics(probabilities: np.ndarray, labels: np.ndarray) -> Dict:
+    """Log loss, exactitud con umbral 0.5 y AUC (por rangos) sobre el conjunto de validación"""
+    clipped = np.clip(probabilities, 1e-12, 1 - 1e-12)
+    positives = int(labels.sum())
+    negatives = len(labels) - positives
+    auc = None
+    if positives and negatives:
+        ranks = np.empty(len(probabilities))
+        ranks[np.argsort(probabilities, kind='stable')] = np.arange(1, len(probabilities) + 1)
+        auc = round(float((ranks[labels > 0].sum() - positives * (positives + 1) / 2) / (positives * negatives)), 4)
+    return {
+        'log_loss': round(float(-np.mean(labels * np.log(clipped) + (1 - labels) * np.log(1 - clipped))), 4),
+        'accuracy': round(float(np.mean((probabilities >= 0.5) == (labels > 0))), 4),
+        'auc': auc
+    }
+
+CLOSED_STATUSES = (LeadStatus.CONVERTIDO, LeadStatus.PERDIDO)
+
+def load_training_inputs() -> Dict:
+    """Leads cerrados con las features que tenían al cerrarse (último cambio a convertido o perdido)
+
+    Después del cierre los contadores y la fecha de contacto del lead siguen cambiando (mensajes de
+    postventa, recordatorios): leerlos del lead filtraría el resultado en las features. Los leads
+    sin cierre registrado en lead_status_change quedan fuera del entrenamiento.
+    """
+    inputs = load_scoring_inputs(statuses=CLOSED_STATUSES)
+    closes = select(
+        LeadStatusChange.lead_id, func.max(LeadStatusChange.changed_at).label('closed_at')
+    ).where(LeadStatusChange.to_status.in_(CLOSED_STATUSES)).group_by(LeadStatusChange.lead_id).subquery()
+    closed_at = closes.c.closed_at
+    messages = select(func.count(Message.id)).where(
+        Message.lead_id == Lead.id, Message.created_at <= closed_at
+    ).scalar_subquery()
+    interactions = select(func.count(Interaction.id)).where(
+        Interaction.lead_id == Lead.id, Interaction.created_at <= closed_at
+    ).scalar_subquery()
+    last_message = select(func.max(Message.created_at)).where(
+        Message.lead_id == Lead.id, Message.created_at <= closed_at
+    ).scalar_subquery()
+    # last_contact_date posterior al cierre se reemplaza por el último mensaje anterior al cierre
+    last_contact = case((Lead.last_contact_date <= closed_at, Lead.last_contact_date), else_=last_message)
+    as_of = fetch_matrix(
+        select(Lead.id, func.julianday(closed_at), func.julianday(last_contact), interactions, messages)
+        .join(closes, closes.c.lead_id == Lead.id)
+        .where(Lead.status.in_(CLOSED_STATUSES))
+        .order_by(Lead.id),
+        5
+    )
+
+    keep = np.isin(inputs['ids'], as_of[:, 0].astype(np.int64))
+    if not keep.all():
+        logger.warning(f"{int((~keep).sum())} leads cerrados sin cambio de estado registrado; no se usan para entrenar")
+    inputs = {name: values[keep] for name, values in inputs.items()}
+    inputs.update(
+        as_of_day=as_of[:, 1],
+        contact_day=as_of[:, 2],
+        interactions=as_of[:, 3].astype(np.int64),
+        messages=as_of[:, 4].astype(np.int64)
+    )
+    return inputs
+
+def train_conversion_model(l2: float = 1.0) -> Dict:
+    """Entrenar con los leads convertidos y perdidos, guardar la nueva versión y publicarla; devuelve sus metadatos"""
+    started = time.perf_counter()
+    inputs = load_training_inputs()
+    labels = inputs['converted'].astype(np.float64)
+    positives = int(labels.sum())
+    if len(labels) < MIN_TRAINING_SAMPLES or positives == 0 or positives == len(labels):
+        raise ValueError(
+            f"Datos insuficientes para entrenar: {len(labels)} leads cerrados, {positives} convertidos "
+            f"(se necesitan {MIN_TRAINING_SAMPLES} con ambas clases)"
+        )
+    features = build_features(inputs)
+
+    # Validación sobre una partición fija; el modelo publicado se ajusta con el resto
+    order = np.random.default_rng(0).permutation(len(labels))
+    holdout_size = int(len(labels) * HOLDOUT_FRACTION)
+    holdout, train = order[:holdout_size], order[holdout_size:]
+    params = fit_logistic_regression(features[train], labels[train], l2)
+    metrics = _metrics(_predict(params, features[holdout]), labels[holdout]) if holdout_size else {}
+
+    metadata = {
+        'features': FEATURE_NAMES,
+        'trained_at': datetime.utcnow().isoformat(),
+        'samples': int(len(labels)),
+        'positives': positives,
+        'l2': l2,
+        'metrics': metrics,
+        'weights': dict(zip(['intercept'] + FEATURE_NAMES, np.round(params[2], 4).tolist()))
+    }
+    # El contador asigna la versión; los parámetros se guardan en la misma transacción que la publica
+    buffer = io.BytesIO()
+    np.save(buffer, params)
+    try:
+        apply_deltas(db.session.connection(), {CONVERSION_MODEL_VERSION_KEY: 1})
+        version = read_counters([CONVERSION_MODEL_VERSION_KEY])[CONVERSION_MODEL_VERSION_KEY]
+        metadata['version'] = version
+        db.session.add(ConversionModelVersion(
+            version=version, params=buffer.getvalue(), details=json.dumps(metadata)
+        ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    conversion_model_registry.invalidate()
+    if has_app_context():
+        g.pop('conversion_model_checked', None)
+    metadata['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Modelo de conversión v{version} entrenado con {len(labels)} leads: {metrics}")
+    return metadata
+
+class ConversionModel:
+    """Versión publicada del modelo, con sus parámetros ya cargados"""
+
+    def __init__(self, version: int, params: np.ndarray, metadata: Dict):
+        self.version = version
+        self.params = params
+        self.metadata = metadata
+
+    def predict(self, inputs: Dict) -> np.ndarray:
+        """Probabilidad de conversión en porcentaje (un decimal) para cada lead de load_scoring_inputs"""
+        return np.round(_predict(self.params, build_features(inputs)) * 100, 1)
+
+class ConversionModelRegistry:
+    """Modelo vigente del proceso; se recarga cuando cambia el contador de versión"""
+
+    def __init__(self):
+        self.version = None
+        self.model: Optional[ConversionModel] = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.version = None
+
+    def _load(self, version: int):
+        self.model = None
+        self.version = version
+        if not version:
+            return
+        row = db.session.get(ConversionModelVersion, version)
+        if row is None:
+            logger.warning(f"Modelo de conversión v{version} no encontrado; se usa el scoring heurístico")
+            return
+        metadata = json.loads(row.details)
+        if metadata.get('features') != FEATURE_NAMES:
+            logger.warning(f"Modelo de conversión v{version} con otras features; se usa el scoring heurístico")
+            return
+        params = np.load(io.BytesIO(row.params))
+        self.model = ConversionModel(version, params, metadata)
+        logger.info(f"Modelo de conversión v{version} cargado")
+
+    def current(self) -> Optional[ConversionModel]:
+        """Modelo publicado (o None); el contador se consulta una vez por request o contexto"""
+        if has_app_context():
+            if g.get('conversion_model_checked'):
+                return self.model
+            g.conversion_model_checked = True
+        version = read_counters([CONVERSION_MODEL_VERSION_KEY])[CONVERSION_MODEL_VERSION_KEY]
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self._load(version)
+        return self.model
+
+conversion_model_registry = ConversionModelRegistry()
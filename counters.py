@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Contadores incrementales para el dashboard de Nexa Lead Manager
+Mantiene totales por estado/fuente y conteos diarios en la tabla stat_counter,
+actualizados en la misma transacción que las escrituras de leads y mensajes
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, date
+from typing import Dict, Iterable
+from sqlalchemy import event, inspect, text, func
+from models import db, Lead, LeadStatus, LeadSource, Message, StatCounter, LeadStatusChange
+
+logger = logging.getLogger(__name__)
+
+TOTAL_LEADS_KEY = 'leads:total'
+REBUILT_AT_KEY = 'meta:rebuilt_at'
+# Versión de las plantillas de mensaje (ver template_registry.py); no se deriva de otras tablas
+TEMPLATES_VERSION_KEY = 'templates:version'
+# Versión publicada del modelo de conversión (ver conversion_model.py)
+CONVERSION_MODEL_VERSION_KEY = 'models:conversion:version'
+# Contadores que no se derivan de otras tablas: rebuild_counters los conserva
+PRESERVED_KEYS = (TEMPLATES_VERSION_KEY, CONVERSION_MODEL_VERSION_KEY)
+
+_UPSERT_SQL = text("""
+    INSERT INTO stat_counter (name, value) VALUES (:name, :delta)
+    ON CONFLICT (name) DO UPDATE SET value = stat_counter.value + excluded.value
+""")
+
+def _enum_value(value) -> str:
+    """Normalizar un enum (o su valor en texto) a la clave del contador"""
+    return value.value if hasattr(value, 'value') else str(value)
+
+def status_key(status) -> str:
+    return f'leads:status:{_enum_value(status or LeadStatus.NUEVO)}'
+
+def source_key(source) -> str:
+    return f'leads:source:{_enum_value(source or LeadSource.OTRO)}'
+
+def messages_day_key(day: date) -> str:
+    return f'messages:day:{day.isoformat()}'
+
+def conversions_day_key(day: date) -> str:
+    return f'conversions:day:{day.isoformat()}'
+
+def _is_converted(status) -> bool:
+    return status is not None and _enum_value(status) == LeadStatus.CONVERTIDO.value
+
+def _old_value(state, attr: str):
+    """Valor previo de un atributo según su historial (o el actual si no cambió)"""
+    history = state.attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state.object, attr)
+
+def _collect_deltas(session) -> Dict[str, int]:
+    """Calcular variaciones de contadores a partir de los cambios pendientes de la sesión"""
+    deltas = defaultdict(int)
+    now = datetime.utcnow()
+    today = now.date()
+
+    for obj in session.new:
+        if isinstance(obj, Lead):
+            deltas[TOTAL_LEADS_KEY] += 1
+            deltas[status_key(obj.status)] += 1
+            deltas[source_key(obj.source)] += 1
+            if _is_converted(obj.status):
+                deltas[conversions_day_key(today)] += 1
+        elif isinstance(obj, Message):
+            deltas[messages_day_key((obj.created_at or now).date())] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Lead):
+            deltas[TOTAL_LEADS_KEY] -= 1
+            deltas[status_key(obj.status)] -= 1
+            deltas[source_key(obj.source)] -= 1
+        elif isinstance(obj, Message) and obj.created_at:
+            deltas[messages_day_key(obj.created_at.date())] -= 1
+
+    for obj in session.dirty:
+        if not isinstance(obj, Lead) or not session.is_modified(obj, include_collections=False):
+            continue
+        state = inspect(obj)
+        old_status = _old_value(state, 'status')
+        old_source = _old_value(state, 'source')
+        if status_key(old_status) != status_key(obj.status):
+            deltas[status_key(old_status)] -= 1
+            deltas[status_key(obj.status)] += 1
+        if source_key(old_source) != source_key(obj.source):
+            deltas[source_key(old_source)] -= 1
+            deltas[source_key(obj.source)] += 1
+        # Las conversiones se atribuyen al día de la transición (igual que lead_status_change)
+        if _is_converted(obj.status) and not _is_converted(old_status):
+            deltas[conversions_day_key(today)] += 1
+
+    return {key: delta for key, delta in deltas.items() if delta}
+
+def apply_deltas(connection, deltas: Dict[str, int]):
+    """Aplicar variaciones a la tabla de contadores usando UPSERT"""
+    if deltas:
+        connection.execute(_UPSERT_SQL, [{'name': key, 'delta': delta} for key, delta in deltas.items()])
+
+@event.listens_for(db.session, 'before_flush')
+def _update_counters_before_flush(session, flush_context, instances):
+    """Mantener los contadores dentro de la misma transacción que el flush"""
+    deltas = _collect_deltas(session)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+def rebuild_counters() -> Dict[str, int]:
+    """Recalcular todos los contadores desde cero a partir de las tablas base"""
+    counts = defaultdict(int)
+
+    for status, count in db.session.query(Lead.status, func.count(Lead.id)).group_by(Lead.status):
+        counts[status_key(status)] += count
+        counts[TOTAL_LEADS_KEY] += count
+
+    for source, count in db.session.query(Lead.source, func.count(Lead.id)).group_by(Lead.source):
+        counts[source_key(source)] += count
+
+    message_day = func.date(Message.created_at)
+    for day, count in db.session.query(message_day, func.count(Message.id)).filter(
+        Message.created_at.isnot(None)
+    ).group_by(message_day):
+        counts[f'messages:day:{day}'] += count
+
+    conversion_day = func.date(LeadStatusChange.changed_at)
+    for day, count in db.session.query(conversion_day, func.count(LeadStatusChange.id)).filter(
+        LeadStatusChange.to_status == LeadStatus.CONVERTIDO,
+        LeadStatusChange.changed_at.isnot(None)
+    ).group_by(conversion_day):
+        counts[f'conversions:day:{day}'] += count
+
+    counts[REBUILT_AT_KEY] = int(time.time())
+
+    StatCounter.query.filter(StatCounter.name.notin_(PRESERVED_KEYS)).delete()
+    db.session.bulk_insert_mappings(StatCounter, [
+        {'name': name, 'value': value} for name, value in counts.items()
+    ])
+    db.session.commit()
+
+    logger.info(f"Contadores reconstruidos: {len(counts)} claves")
+    return dict(counts)
+
+def ensure_counters():
+    """Reconstruir los contadores si nunca fueron inicializados"""
+    if not db.session.get(StatCounter, REBUILT_AT_KEY):
+        rebuild_counters()
+
+def read_counters(keys: Iterable[str]) -> Dict[str, int]:
+    """Leer un conjunto de contadores en una única consulta por clave primaria"""
+    keys = list(keys)
+    values = dict.fromkeys(keys, 0)
+    values.update(
+        db.session.query(StatCounter.name, StatCounter.value).filter(StatCounter.name.in_(keys)).all()
+    )
+    return values
+
+def get_dashboard_counters(today: date = None) -> Dict[str, int]:
+    """Obtener los contadores que alimentan /api/stats"""
+    today = today or datetime.utcnow().date()
+    week_days = [today - timedelta(days=offset) for offset in range(8)]
+
+    keys = [TOTAL_LEADS_KEY, messages_day_key(today)]
+    keys += [status_key(status) for status in LeadStatus]
+    keys += [conversions_day_key(day) for day in week_days]
+    values = read_counters(keys)
+
+    return {
+        'total_leads': values[TOTAL_LEADS_KEY],
+        'status': {status.value: values[status_key(status)] for status in LeadStatus},
+        'messages_today': values[messages_day_key(today)],
+        'weekly_conversions': sum(values[conversions_day_key(day)] for day in week_days)
+    }
@@ -5,15 +5,37 @@ Interfaz moderna para gestión de leads y campañas de WhatsApp
 """
 
 import logging
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+import click
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 # import plotly.graph_objs as go
 # import plotly.utils
+import csv
 import json
-from datetime import datetime, timedelta
-from models import db, User, Lead, LeadStatus, LeadSource, Message, MessageTemplate, Campaign, CampaignResult, Interaction
+import time
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from models import db, User, Lead, LeadStatus, LeadSource, Message, MessageTemplate, Campaign, CampaignRun, CampaignResult, ImportJob, Interaction, find_lead_by_phone, get_database_uri
 from lead_manager import lead_manager
+from counters import get_dashboard_counters, ensure_counters, rebuild_counters, read_counters, status_key, TOTAL_LEADS_KEY
+from migrations import apply_schema_upgrades, backfill_phone_e164
+from search_index import apply_lead_search, rebuild_search_index
+from rollups import ensure_rollups, backfill_rollups
+from funnel import ensure_funnel, get_funnel, rebuild_funnel_stats
+from outbox import enqueue_message, get_outbox_stats, run_sender, start_sender_in_background
+from scheduler import LeaderScheduler, start_when_lock_acquired
+from lead_import import create_import_job, import_leads_from_csv, start_import_in_background
+from lead_export import EXPORT_FORMATS, export_leads
+from lead_pagination import LEAD_ORDERINGS, keyset_page, keyset_query
+from lead_scoring import score_leads, summarize_scores
+from lead_scores import ensure_lead_scores, refresh_all_scores, refresh_queued_scores
+from lead_activity import check_lead_activity, ensure_lead_activity
+from conversion_model import train_conversion_model
+from llm_cache import llm_cache, parse_use_cache
+from template_engine import compile_template, declared_variables, get_compiled, render_for_leads, sample_values, validate_template
+from template_registry import compact_template_messages, render_stored, template_registry
 import os
 
 # Configuración de logging
@@ -30,13 +52,12 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-pro
 
 # Configurar ruta de base de datos
 # En Render, usar directorio temporal o raíz del proyecto
+database_path = get_database_uri()
 if os.getenv('RENDER'):
     # Estamos en Render, usar directorio temporal
-    database_path = 'sqlite:///nexa_leads.db'
     print("🚀 Detectado entorno Render - usando BD en directorio raíz")
 else:
     # Entorno local, usar directorio instance
-    database_path = 'sqlite:///instance/nexa_leads.db'
     print("🏠 Entorno local detectado - usando BD en directorio instance")
 
 app.config['SQLALCHEMY_DATABASE_URI'] = database_path
@@ -338,6 +359,7 @@ force_migrate_database_on_startup()
 
 # Inicializar extensiones
 db.init_app(app)
+lead_manager.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -352,6 +374,14 @@ with app.app_context():
             print("❌ Motor de base de datos no disponible")
             raise Exception("Motor de base de datos no disponible")
         
+        # Aplicar migraciones idempotentes (tablas auxiliares, índices, columnas nuevas)
+        apply_schema_upgrades()
+        ensure_funnel()
+        ensure_counters()
+        ensure_rollups()
+        ensure_lead_activity()
+        ensure_lead_scores()
+        
         # Verificar que las tablas existan (no crear, solo verificar)
         inspector = db.inspect(db.engine)
         tables = inspector.get_table_names()
@@ -384,6 +414,27 @@ with app.app_context():
         print("⚠️ La aplicación continuará pero puede no funcionar correctamente")
         # Continuar con la aplicación incluso si hay errores de BD
 
+# Las tareas programadas corren en `flask --app app scheduler` y el outbox en `flask --app app outbox-worker`;
+# con SCHEDULER_EMBEDDED / OUTBOX_EMBEDDED el proceso web los ejecuta en hilos (solo para desarrollo local;
+# en Render start.sh los lanza como procesos aparte). No arrancan al importar: con preload_app el import ocurre en el master de gunicorn
+# y los hilos no sobreviven al fork. gunicorn.conf.py los arranca en post_worker_init.
+EMBEDDED_WORKERS_LOCK = os.getenv(
+    'EMBEDDED_WORKERS_LOCK', os.path.join(tempfile.gettempdir(), 'nexa-embedded-workers.lock')
+)
+
+def _start_embedded_loops():
+    if os.getenv('SCHEDULER_EMBEDDED', 'false').lower() == 'true':
+        LeaderScheduler(app).start_in_background()
+    if os.getenv('OUTBOX_EMBEDDED', 'false').lower() == 'true' and lead_manager.dispatcher:
+        start_sender_in_background(app, lead_manager.dispatcher, lead_manager._format_phone_number)
+
+def start_embedded_workers():
+    """Arrancar el scheduler y el envío del outbox embebidos en un solo proceso por máquina"""
+    if os.getenv('SCHEDULER_EMBEDDED', 'false').lower() != 'true' and \
+            os.getenv('OUTBOX_EMBEDDED', 'false').lower() != 'true':
+        return None
+    return start_when_lock_acquired(EMBEDDED_WORKERS_LOCK, _start_embedded_loops)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
@@ -524,14 +575,17 @@ def dashboard():
 def get_stats():
     """Obtener estadísticas para el dashboard"""
     try:
-        # Estadísticas generales
-        total_leads = Lead.query.count()
-        new_leads = Lead.query.filter_by(status=LeadStatus.NUEVO).count()
-        contacted_leads = Lead.query.filter_by(status=LeadStatus.CONTACTADO).count()
-        interested_leads = Lead.query.filter_by(status=LeadStatus.INTERESADO).count()
-        converted_leads = Lead.query.filter_by(status=LeadStatus.CONVERTIDO).count()
-        
-        # Leads que necesitan seguimiento (manejar columna que puede no existir)
+        # Totales por estado, mensajes de hoy y conversiones semanales desde los contadores
+        counters = get_dashboard_counters()
+        total_leads = counters['total_leads']
+        new_leads = counters['status'][LeadStatus.NUEVO.value]
+        contacted_leads = counters['status'][LeadStatus.CONTACTADO.value]
+        interested_leads = counters['status'][LeadStatus.INTERESADO.value]
+        converted_leads = counters['status'][LeadStatus.CONVERTIDO.value]
+        messages_today = counters['messages_today']
+        weekly_conversions = counters['weekly_conversions']
+        
+        # Leads que necesitan seguimiento (depende de la hora actual, no se puede precalcular)
         leads_needing_follow_up = 0
         try:
             today = datetime.utcnow()
@@ -545,29 +599,6 @@ def get_stats():
                 Lead.status.in_([LeadStatus.NUEVO, LeadStatus.CONTACTADO])
             ).count()
         
-        # Mensajes enviados hoy
-        messages_today = 0
-        try:
-            today = datetime.utcnow()
-            messages_today = Message.query.filter(
-                Message.created_at >= today.replace(hour=0, minute=0, second=0, microsecond=0)
-            ).count()
-        except Exception:
-            # Si hay error, usar 0
-            messages_today = 0
-        
-        # Conversiones de la semana
-        weekly_conversions = 0
-        try:
-            week_ago = datetime.utcnow() - timedelta(days=7)
-            weekly_conversions = Lead.query.filter(
-                Lead.status == LeadStatus.CONVERTIDO,
-                Lead.updated_at >= week_ago
-            ).count()
-        except Exception:
-            # Si hay error, usar 0
-            weekly_conversions = 0
-        
         return jsonify({
             'total_leads': total_leads,
             'new_leads': new_leads,
@@ -583,6 +614,25 @@ def get_stats():
         logger.error(f"Error obteniendo estadísticas: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _serialize_lead_summary(lead):
+    """Datos de un lead para los listados"""
+    return {
+        'id': lead.id,
+        'name': lead.name,
+        'phone_number': lead.phone_number,
+        'email': lead.email,
+        'company': lead.company,
+        'status': lead.status.value,
+        'source': lead.source.value,
+        'created_at': lead.created_at.isoformat(),
+        'last_contact_date': lead.last_contact_date.isoformat() if lead.last_contact_date else None,
+        'next_follow_up': lead.next_follow_up.isoformat() if lead.next_follow_up else None,
+        'conversion_score': lead.conversion_score,
+        'message_count': lead.message_count or 0,
+        'interaction_count': lead.interaction_count or 0,
+        'last_inbound_at': lead.last_inbound_at.isoformat() if lead.last_inbound_at else None
+    }
+
 @app.route('/api/leads')
 @login_required
 def get_leads():
@@ -593,6 +643,9 @@ def get_leads():
         status = request.args.get('status')
         source = request.args.get('source')
         search = request.args.get('search')
+        order_by = request.args.get('order_by', 'created_at')
+        if order_by not in LEAD_ORDERINGS:
+            return jsonify({'error': f"Orden no soportado: {order_by}"}), 400
         
         query = Lead.query
         
@@ -600,33 +653,28 @@ def get_leads():
             query = query.filter_by(status=status)
         if source:
             query = query.filter_by(source=source)
+        rank = None
         if search:
-            query = query.filter(
-                db.or_(
-                    Lead.name.contains(search),
-                    Lead.phone_number.contains(search),
-                    Lead.email.contains(search),
-                    Lead.company.contains(search)
-                )
-            )
-        
-        leads = query.order_by(Lead.created_at.desc()).paginate(
+            # FTS5 con ranking bm25 si está disponible, LIKE en caso contrario
+            query, rank = apply_lead_search(query, search)
+        
+        # Modo cursor: ?after=<cursor> (vacío para la primera página)
+        if 'after' in request.args:
+            return _get_leads_by_cursor(query, request.args.get('after'), per_page, status, source, search, order_by)
+        
+        if order_by == 'score':
+            # Recorre el índice (conversion_score, id) hacia atrás; los leads sin score quedan al final
+            ordering = [Lead.conversion_score.desc(), Lead.id.desc()]
+        elif rank is not None:
+            ordering = [rank, Lead.created_at.desc()]
+        else:
+            ordering = [Lead.created_at.desc()]
+        leads = query.order_by(*ordering).paginate(
             page=page, per_page=per_page, error_out=False
         )
         
         return jsonify({
-            'leads': [{
-                'id': lead.id,
-                'name': lead.name,
-                'phone_number': lead.phone_number,
-                'email': lead.email,
-                'company': lead.company,
-                'status': lead.status.value,
-                'source': lead.source.value,
-                'created_at': lead.created_at.isoformat(),
-                'last_contact_date': lead.last_contact_date.isoformat() if lead.last_contact_date else None,
-                'next_follow_up': lead.next_follow_up.isoformat() if lead.next_follow_up else None
-            } for lead in leads.items],
+            'leads': [_serialize_lead_summary(lead) for lead in leads.items],
             'total': leads.total,
             'pages': leads.pages,
             'current_page': leads.page
@@ -635,6 +683,59 @@ def get_leads():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _get_leads_by_cursor(query, after, per_page, status, source, search, order_by='created_at'):
+    """Paginación por keyset sobre el índice (created_at, id) o (conversion_score, id), sin OFFSET ni COUNT"""
+    per_page = max(1, min(per_page, 200))
+    query = keyset_query(query, order_by)
+    try:
+        leads, next_cursor, has_more = keyset_page(query, after, per_page, order_by)
+    except ValueError:
+        return jsonify({'error': 'Cursor inválido'}), 400
+    
+    # Total opcional: exacto con include_total=1, aproximado desde los contadores si no hay búsqueda
+    total = None
+    total_is_exact = False
+    if request.args.get('include_total', type=int):
+        total = query.order_by(None).count()
+        total_is_exact = True
+    elif not search and not source:
+        counter_key = status_key(status) if status else TOTAL_LEADS_KEY
+        total = read_counters([counter_key])[counter_key]
+    
+    return jsonify({
+        'leads': [_serialize_lead_summary(lead) for lead in leads],
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+        'total': total,
+        'total_is_exact': total_is_exact
+    })
+
+@app.route('/api/leads/export')
+@login_required
+def export_leads_stream():
+    """Exportar leads en CSV o NDJSON con los filtros de /api/leads, en streaming (?gzip=1 para comprimir)"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Formato no soportado: {export_format}"}), 400
+    gzip = bool(request.args.get('gzip', type=int))
+    
+    chunks = export_leads(
+        export_format, gzip,
+        status=request.args.get('status'),
+        source=request.args.get('source'),
+        search=request.args.get('search')
+    )
+    filename = f"leads_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}" + ('.gz' if gzip else '')
+    # stream_with_context mantiene la sesión de base de datos abierta mientras se envían los bloques
+    return Response(
+        stream_with_context(chunks),
+        mimetype='application/gzip' if gzip else EXPORT_FORMATS[export_format],
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no'  # sin buffer en el proxy: los bytes salen a medida que se generan
+        }
+    )
+
 @app.route('/api/leads/<int:lead_id>')
 @login_required
 def get_lead_detail(lead_id):
@@ -642,11 +743,14 @@ def get_lead_detail(lead_id):
     try:
         lead = Lead.query.get_or_404(lead_id)
         
-        # Obtener mensajes del lead
-        messages = Message.query.filter_by(lead_id=lead_id).order_by(Message.created_at.desc()).limit(10).all()
+        # Últimos mensajes e interacciones; los contadores del lead evitan consultar si no hay ninguno
+        messages = []
+        if lead.message_count:
+            messages = Message.query.filter_by(lead_id=lead_id).order_by(Message.created_at.desc()).limit(10).all()
         
-        # Obtener interacciones del lead
-        interactions = Interaction.query.filter_by(lead_id=lead_id).order_by(Interaction.created_at.desc()).limit(10).all()
+        interactions = []
+        if lead.interaction_count:
+            interactions = Interaction.query.filter_by(lead_id=lead_id).order_by(Interaction.created_at.desc()).limit(10).all()
         
         return jsonify({
             'lead': {
@@ -661,15 +765,19 @@ def get_lead_detail(lead_id):
                 'notes': lead.notes,
                 'created_at': lead.created_at.isoformat(),
                 'last_contact_date': lead.last_contact_date.isoformat() if lead.last_contact_date else None,
-                'next_follow_up': lead.next_follow_up.isoformat() if lead.next_follow_up else None
+                'next_follow_up': lead.next_follow_up.isoformat() if lead.next_follow_up else None,
+                'conversion_score': lead.conversion_score,
+                'message_count': lead.message_count or 0,
+                'interaction_count': lead.interaction_count or 0,
+                'last_inbound_at': lead.last_inbound_at.isoformat() if lead.last_inbound_at else None
             },
             'messages': [{
                 'id': msg.id,
                 'type': msg.message_type,
-                'content': msg.content,
+                'content': content,
                 'status': msg.status,
                 'created_at': msg.created_at.isoformat()
-            } for msg in messages],
+            } for msg, content in zip(messages, render_stored(messages))],
             'interactions': [{
                 'id': interaction.id,
                 'type': interaction.interaction_type,
@@ -695,14 +803,22 @@ def send_message_to_lead(lead_id):
         if not message_content:
             return jsonify({'error': 'Mensaje requerido'}), 400
         
+        # Esta ruta comparte URL con send_lead_message, que es la que maneja los envíos programados
+        if data.get('scheduled'):
+            return send_lead_message(lead_id)
+        
+        # El envío real lo hace el proceso del outbox (flask --app dashboard outbox-worker)
         success = False
         if template_category != 'custom':
             success = lead_manager.send_follow_up_message(lead, template_category)
         else:
-            success = lead_manager.send_whatsapp_message(lead.phone_number, message_content, lead.id)
+            enqueue_message(lead.id, message_content)
+            lead.last_contact_date = datetime.utcnow()
+            db.session.commit()
+            success = True
         
         if success:
-            return jsonify({'success': True, 'message': 'Mensaje enviado correctamente'})
+            return jsonify({'success': True, 'message': 'Mensaje encolado para envío'})
         else:
             return jsonify({'error': 'Error enviando mensaje'}), 500
             
@@ -789,12 +905,38 @@ def create_campaign():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/campaigns/<int:campaign_id>/runs')
+@login_required
+def get_campaign_runs(campaign_id):
+    """Ejecuciones de una campaña con su checkpoint y progreso"""
+    try:
+        runs = CampaignRun.query.filter_by(campaign_id=campaign_id).order_by(CampaignRun.id.desc()).all()
+        
+        return jsonify({
+            'runs': [{
+                'id': run.id,
+                'status': run.status,
+                'last_lead_id': run.last_lead_id,
+                'processed': run.processed,
+                'sent': run.sent,
+                'failed': run.failed,
+                'resumed_count': run.resumed_count,
+                'last_error': run.last_error,
+                'heartbeat_at': run.heartbeat_at.isoformat() if run.heartbeat_at else None,
+                'started_at': run.started_at.isoformat() if run.started_at else None,
+                'finished_at': run.finished_at.isoformat() if run.finished_at else None
+            } for run in runs]
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/templates')
 @login_required
 def get_templates():
     """Obtener lista de plantillas de mensaje"""
     try:
-        templates = MessageTemplate.query.filter_by(is_active=True).all()
+        templates = template_registry.active()
         
         return jsonify({
             'templates': [{
@@ -816,7 +958,9 @@ def get_templates():
 def get_template(template_id):
     """Obtener una plantilla específica"""
     try:
-        template = MessageTemplate.query.get_or_404(template_id)
+        template = template_registry.get(template_id)
+        if not template:
+            return jsonify({'error': 'Plantilla no encontrada'}), 404
         
         return jsonify({
             'template': {
@@ -840,6 +984,13 @@ def create_template():
     try:
         data = request.get_json()
         
+        unknown = validate_template(data['content'], data.get('variables'))
+        if unknown:
+            return jsonify({
+                'error': f"Variables desconocidas en la plantilla: {', '.join(unknown)}",
+                'unknown_variables': unknown
+            }), 400
+        
         template = MessageTemplate(
             name=data['name'],
             category=data['category'],
@@ -886,6 +1037,43 @@ def delete_template(template_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/templates/preview', methods=['POST'])
+@login_required
+def preview_template():
+    """Previsualizar una plantilla (guardada o en edición) contra los N leads más recientes"""
+    try:
+        data = request.get_json() or {}
+        limit = min(max(int(data.get('n', 5)), 1), 50)
+        
+        if data.get('template_id'):
+            template = template_registry.get(data['template_id'])
+            if not template:
+                return jsonify({'error': 'Plantilla no encontrada'}), 404
+            compiled = get_compiled(template)
+            variables = data.get('variables', template.variables)
+        else:
+            compiled = compile_template(data.get('content', ''))
+            variables = data.get('variables')
+        
+        started = time.perf_counter()
+        leads = db.session.query(
+            Lead.id, Lead.name, Lead.company, Lead.phone_number, Lead.email
+        ).order_by(Lead.created_at.desc()).limit(limit).all()
+        messages = render_for_leads(compiled, leads, sample_values(variables))
+        
+        return jsonify({
+            'previews': [{
+                'lead_id': lead.id,
+                'lead_name': lead.name,
+                'message': message
+            } for lead, message in zip(leads, messages)],
+            'unknown_variables': compiled.unknown_variables(declared_variables(variables)),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/templates/<int:template_id>', methods=['PUT'])
 @login_required
 def update_template(template_id):
@@ -894,18 +1082,29 @@ def update_template(template_id):
         template = MessageTemplate.query.get_or_404(template_id)
         data = request.get_json()
         
+        content = data.get('content', template.content)
+        variables = data.get('variables', template.variables)
+        unknown = validate_template(content, variables)
+        if unknown:
+            return jsonify({
+                'error': f"Variables desconocidas en la plantilla: {', '.join(unknown)}",
+                'unknown_variables': unknown
+            }), 400
+        
         # Actualizar campos
         if 'name' in data:
             template.name = data['name']
         if 'category' in data:
             template.category = data['category']
-        if 'content' in data:
-            template.content = data['content']
+        if content != template.content:
+            # La versión se incrementa al hacer flush (ver template_registry)
+            template.content = content
         if 'variables' in data:
             template.variables = data['variables']
         if 'is_active' in data:
             template.is_active = data['is_active']
         
+        template.updated_at = datetime.utcnow()
         db.session.commit()
         
         return jsonify({
@@ -917,7 +1116,8 @@ def update_template(template_id):
                 'category': template.category,
                 'content': template.content,
                 'variables': template.variables,
-                'is_active': template.is_active
+                'is_active': template.is_active,
+                'version': template.version
             }
         })
         
@@ -931,16 +1131,21 @@ def get_analytics():
     """Obtener datos para gráficos de analytics"""
     try:
         days = request.args.get('days', 30, type=int)
-        analytics = lead_manager.get_lead_analytics(days)
+        bucket = request.args.get('bucket')
+        if bucket not in (None, 'day', 'week'):
+            return jsonify({'error': 'bucket debe ser day o week'}), 400
+        analytics = lead_manager.get_lead_analytics(days, bucket)
         
         # Verificar que analytics no esté vacío
         if not analytics:
             analytics = {
                 'status_distribution': {},
                 'source_distribution': {},
+                'source_performance': {},
                 'conversion_rate': 0,
                 'total_leads': 0,
-                'conversions': 0
+                'conversions': 0,
+                'series': []
             }
         
         # Retornar solo los datos sin gráficos (plotly removido)
@@ -956,10 +1161,30 @@ def get_analytics():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/analytics/funnel')
+@login_required
+def get_funnel_analytics():
+    """Funnel de estados: conversión entre etapas y tiempo medio en cada etapa"""
+    try:
+        return jsonify({'funnel': get_funnel()})
+    except Exception as e:
+        logger.error(f"Error obteniendo funnel: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/outbox/stats')
+@login_required
+def get_outbox_statistics():
+    """Profundidad y throughput del outbox de mensajes"""
+    try:
+        return jsonify({'outbox': get_outbox_stats()})
+    except Exception as e:
+        logger.error(f"Error obteniendo estado del outbox: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/import-leads', methods=['POST'])
 @login_required
 def import_leads():
-    """Importar leads desde archivo CSV"""
+    """Importar leads desde archivo CSV (trabajo en segundo plano; el progreso se consulta por job_id)"""
     try:
         if 'file' not in request.files:
             return jsonify({'error': 'No se proporcionó archivo'}), 400
@@ -968,20 +1193,49 @@ def import_leads():
         if file.filename == '':
             return jsonify({'error': 'No se seleccionó archivo'}), 400
         
-        # Guardar archivo temporalmente
-        temp_path = f'temp_import_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        file.save(temp_path)
+        job = create_import_job(file, created_by_id=current_user.id)
+        start_import_in_background(app, job.id)
         
-        # Importar leads
-        imported, skipped = lead_manager.import_leads_from_csv(temp_path)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'total_rows': job.total_rows,
+            'status_url': url_for('get_import_job', job_id=job.id)
+        }), 202
         
-        # Limpiar archivo temporal
-        os.remove(temp_path)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/import-leads/<int:job_id>')
+@login_required
+def get_import_job(job_id):
+    """Estado y progreso de una importación de leads"""
+    try:
+        job = db.session.get(ImportJob, job_id)
+        if not job:
+            return jsonify({'error': 'Importación no encontrada'}), 404
         
+        progress = round(min(100.0, job.processed * 100.0 / job.total_rows), 1) if job.total_rows else None
         return jsonify({
-            'success': True,
-            'imported': imported,
-            'skipped': skipped
+            'job': {
+                'id': job.id,
+                'filename': job.filename,
+                'status': job.status,
+                'total_rows': job.total_rows,
+                'processed': job.processed,
+                'imported': job.imported,
+                'skipped': job.skipped,
+                'progress': 100.0 if job.status == 'completed' else progress,
+                'skip_reasons': json.loads(job.skip_reasons) if job.skip_reasons else {},
+                'skipped_rows': json.loads(job.skipped_rows) if job.skipped_rows else [],
+                'last_error': job.last_error,
+                'resumed_count': job.resumed_count or 0,
+                'created_at': job.created_at.isoformat() if job.created_at else None,
+                'started_at': job.started_at.isoformat() if job.started_at else None,
+                'heartbeat_at': job.heartbeat_at.isoformat() if job.heartbeat_at else None,
+                'finished_at': job.finished_at.isoformat() if job.finished_at else None
+            }
         })
         
     except Exception as e:
@@ -999,7 +1253,7 @@ def create_lead():
             return jsonify({'error': 'Número de teléfono es requerido'}), 400
         
         # Verificar si el lead ya existe
-        existing_lead = Lead.query.filter_by(phone_number=data['phone_number']).first()
+        existing_lead = find_lead_by_phone(data['phone_number'])
         if existing_lead:
             return jsonify({'error': 'Ya existe un lead con este número de teléfono'}), 400
         
@@ -1152,24 +1406,25 @@ def send_lead_message(lead_id):
         if not message_content:
             return jsonify({'error': 'Contenido del mensaje requerido'}), 400
         
-        # Crear el mensaje
-        message = Message(
-            lead_id=lead_id,
-            content=message_content,
-            message_type='outbound',
-            status='pending'
-        )
-        
-        # Si hay programación, establecer la fecha
+        # Si hay programación, establecer la fecha; si no, el mensaje va al outbox
         if scheduled_time:
             try:
                 scheduled_datetime = datetime.fromisoformat(scheduled_time.replace('Z', '+00:00'))
-                message.scheduled_at = scheduled_datetime
-                message.status = 'scheduled'
             except ValueError:
                 return jsonify({'error': 'Formato de fecha inválido'}), 400
-        
-        db.session.add(message)
+            # Las fechas se guardan en UTC sin zona horaria, igual que created_at
+            if scheduled_datetime.tzinfo:
+                scheduled_datetime = scheduled_datetime.astimezone(timezone.utc).replace(tzinfo=None)
+            message = Message(
+                lead_id=lead_id,
+                content=message_content,
+                message_type='outbound',
+                status='scheduled',
+                scheduled_at=scheduled_datetime
+            )
+            db.session.add(message)
+        else:
+            message = enqueue_message(lead_id, message_content)
         
         # Crear interacción
         interaction = Interaction(
@@ -1185,21 +1440,9 @@ def send_lead_message(lead_id):
         
         db.session.commit()
         
-        # Aquí se integraría con Twilio para envío real
-        # Por ahora solo simulamos el envío
-        try:
-            from lead_manager import send_whatsapp_message
-            if not scheduled_time:  # Solo enviar inmediatamente
-                send_whatsapp_message(lead.phone_number, message_content)
-                message.status = 'sent'
-                db.session.commit()
-        except Exception as e:
-            logger.warning(f"No se pudo enviar mensaje real: {e}")
-            # El mensaje se marca como enviado aunque no se haya enviado físicamente
-        
         return jsonify({
             'success': True,
-            'message': 'Mensaje enviado correctamente',
+            'message': 'Mensaje encolado para envío',
             'message_id': message.id,
             'status': message.status
         })
@@ -1222,8 +1465,12 @@ def analyze_lead_intent():
         
         if not message_content:
             return jsonify({'error': 'Mensaje requerido'}), 400
+        try:
+            use_cache = parse_use_cache(data.get('use_cache'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        analysis = ai_features.analyze_lead_intent(message_content, lead_data)
+        analysis = ai_features.analyze_lead_intent(message_content, lead_data, use_cache=use_cache)
         
         return jsonify({
             'success': True,
@@ -1251,6 +1498,36 @@ def predict_lead_conversion(lead_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ai/predict-conversion/batch', methods=['GET', 'POST'])
+@login_required
+def predict_lead_conversion_batch():
+    """Predecir la conversión de muchos leads en lote; devuelve el resumen y los de mayor probabilidad"""
+    try:
+        from ai_features import ai_features
+        
+        data = request.get_json(silent=True) or {}
+        lead_ids = data.get('lead_ids')
+        limit = max(1, min(request.args.get('limit', 100, type=int), 5000))
+        
+        scores = ai_features.predict_lead_conversion_batch(
+            lead_ids, status=request.args.get('status'), source=request.args.get('source')
+        )
+        # Solo los primeros `limit` por probabilidad viajan en la respuesta
+        top = scores['probabilities'].argsort(kind='stable')[::-1][:limit]
+        
+        return jsonify({
+            'success': True,
+            'summary': summarize_scores(scores),
+            'predictions': [{
+                'lead_id': int(scores['lead_ids'][i]),
+                'conversion_probability': float(scores['probabilities'][i]),
+                'next_best_action': str(scores['actions'][i])
+            } for i in top]
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/ai/generate-message', methods=['POST'])
 @login_required
 def generate_personalized_message():
@@ -1265,8 +1542,13 @@ def generate_personalized_message():
         if not lead_id:
             return jsonify({'error': 'ID de lead requerido'}), 400
         
+        try:
+            use_cache = parse_use_cache(data.get('use_cache'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         lead = Lead.query.get_or_404(lead_id)
-        message = ai_features.generate_personalized_message(lead, template_type)
+        message = ai_features.generate_personalized_message(lead, template_type, use_cache=use_cache)
         
         return jsonify({
             'success': True,
@@ -1276,6 +1558,19 @@ def generate_personalized_message():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ai/cache/stats')
+@login_required
+def llm_cache_stats():
+    """Aciertos, fallos y tamaño de la caché de respuestas del LLM"""
+    try:
+        return jsonify({
+            'success': True,
+            'stats': llm_cache.stats()
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/ai/analyze-campaign/<int:campaign_id>')
 @login_required
 def analyze_campaign_performance(campaign_id):
@@ -1508,9 +1803,174 @@ def delete_user(user_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# ============================================================================
+# COMANDOS DE ADMINISTRACIÓN (flask --app dashboard <comando>)
+# ============================================================================
+
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Reconstruir desde cero los contadores del dashboard"""
+    counts = rebuild_counters()
+    print(f"✅ Contadores reconstruidos: {len(counts)} claves, {counts.get('leads:total', 0)} leads")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Reconstruir el índice FTS5 de búsqueda de leads"""
+    if rebuild_search_index():
+        print("✅ Índice de búsqueda reconstruido")
+    else:
+        print("⚠️ FTS5 no disponible en esta base de datos")
+
+@app.cli.command('rebuild-funnel')
+def rebuild_funnel_command():
+    """Recalcular el funnel desde el registro de cambios de estado"""
+    transitions = rebuild_funnel_stats()
+    print(f"✅ Funnel reconstruido: {transitions} transiciones distintas")
+
+@app.cli.command('outbox-worker')
+@click.option('--batch-size', default=50, show_default=True, help='Mensajes reclamados por lote')
+@click.option('--poll-interval', default=2.0, show_default=True, help='Segundos de espera con la cola vacía')
+@click.option('--once', is_flag=True, help='Vaciar la cola y terminar')
+def outbox_worker_command(batch_size, poll_interval, once):
+    """Proceso de envío del outbox de mensajes de WhatsApp"""
+    if not lead_manager.dispatcher:
+        print("❌ Twilio no configurado: defina TWILIO_ACCOUNT_SID y TWILIO_AUTH_TOKEN")
+        return
+    print(f"📤 Enviando mensajes del outbox en lotes de {batch_size}...")
+    totals = run_sender(lead_manager.dispatcher, lead_manager._format_phone_number,
+                        batch_size=batch_size, poll_interval=poll_interval, once=once)
+    print(f"✅ Outbox vaciado: {totals['sent']} enviados, {totals['retrying']} reintentos, {totals['failed']} fallidos")
+
+@app.cli.command('scheduler')
+@click.option('--lease-seconds', default=60, show_default=True, help='Duración del lease de líder')
+def scheduler_command(lease_seconds):
+    """Proceso de tareas programadas (solo el líder elegido ejecuta los trabajos)"""
+    leader = LeaderScheduler(app, lease_seconds=lease_seconds)
+    print(f"⏰ Scheduler {leader.owner} esperando el lease de líder...")
+    try:
+        leader.run_forever()
+    except KeyboardInterrupt:
+        leader.stop()
+        print("\n👋 Scheduler detenido")
+
+@app.cli.command('backfill-rollups')
+@click.option('--since', help='Fecha inicial (YYYY-MM-DD); por defecto el primer registro')
+@click.option('--chunk-days', default=30, show_default=True, help='Días por bloque (un commit por bloque)')
+def backfill_rollups_command(since, chunk_days):
+    """Reconstruir el histórico de rollups diarios de leads y mensajes"""
+    since_day = datetime.strptime(since, '%Y-%m-%d').date() if since else None
+    chunks = backfill_rollups(since_day, chunk_days)
+    print(f"✅ Rollups reconstruidos en {chunks} bloques de {chunk_days} días")
+
+@app.cli.command('import-leads')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=1000, show_default=True, help='Filas por bloque (un commit por bloque)')
+def import_leads_command(csv_path, chunk_size):
+    """Importar leads desde un CSV grande sin pasar por la API"""
+    print(f"📥 Importando {csv_path} en bloques de {chunk_size} filas...")
+    totals = import_leads_from_csv(csv_path, chunk_size)
+    print(f"✅ Importación completada: {totals['imported']} importados, {totals['skipped']} omitidos")
+    for reason, count in totals['skip_reasons'].items():
+        print(f"   {reason}: {count}")
+
+@app.cli.command('backfill-phones')
+@click.option('--chunk-size', default=1000, show_default=True, help='Filas por bloque (un commit por bloque)')
+def backfill_phones_command(chunk_size):
+    """Completar el número normalizado (E.164) de leads y usuarios existentes"""
+    totals = backfill_phone_e164(chunk_size)
+    print(f"✅ Números normalizados: {totals['leads']} leads, {totals['users']} usuarios")
+    if totals['lead_duplicates']:
+        print(f"⚠️ {totals['lead_duplicates']} leads repiten un número ya registrado (phone_e164 vacío)")
+
+@app.cli.command('score-leads')
+@click.option('--status', help='Solo leads con este estado')
+@click.option('--source', help='Solo leads de esta fuente')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='CSV con lead_id, probabilidad y siguiente acción')
+def score_leads_command(status, source, output):
+    """Calcular la probabilidad de conversión de todos los leads con el scoring vectorizado"""
+    scores = score_leads(status=status, source=source)
+    summary = summarize_scores(scores)
+    print(f"✅ {summary['count']} leads puntuados (carga {summary['load_ms']} ms, cálculo {summary['compute_ms']} ms)")
+    print(f"   Probabilidad promedio: {summary['average_probability']}%")
+    for action, count in summary['by_action'].items():
+        print(f"   {action}: {count}")
+    if output:
+        with open(output, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(['lead_id', 'conversion_probability', 'next_best_action'])
+            writer.writerows(zip(scores['lead_ids'].tolist(), scores['probabilities'].tolist(), scores['actions'].tolist()))
+        print(f"📄 Resultados guardados en {output}")
+
+@app.cli.command('refresh-scores')
+@click.option('--all', 'sweep', is_flag=True, help='Recalcular todos los leads (barrido nocturno) en lugar de solo la cola')
+def refresh_scores_command(sweep):
+    """Actualizar el score de conversión guardado en los leads"""
+    if sweep:
+        totals = refresh_all_scores()
+        print(f"✅ Barrido completado: {totals['updated']} de {totals['scored']} scores cambiaron")
+    else:
+        updated = refresh_queued_scores()
+        print(f"✅ Scores recalculados: {updated} leads de la cola")
+
+@app.cli.command('train-conversion-model')
+@click.option('--l2', default=1.0, show_default=True, help='Regularización L2 de la regresión logística')
+@click.option('--rescore', is_flag=True, help='Recalcular los scores guardados con la nueva versión')
+def train_conversion_model_command(l2, rescore):
+    """Entrenar y publicar una nueva versión del modelo de conversión (los procesos la toman sin reiniciar)"""
+    try:
+        metadata = train_conversion_model(l2)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+    metrics = metadata['metrics']
+    print(f"✅ Modelo v{metadata['version']} entrenado con {metadata['samples']} leads "
+          f"({metadata['positives']} convertidos) en {metadata['elapsed_ms']} ms")
+    print(f"   Validación: AUC {metrics.get('auc')}, exactitud {metrics.get('accuracy')}, log loss {metrics.get('log_loss')}")
+    if rescore:
+        totals = refresh_all_scores()
+        print(f"✅ Scores recalculados: {totals['updated']} de {totals['scored']} cambiaron")
+
+@app.cli.command('check-lead-activity')
+@click.option('--repair', is_flag=True, help='Corregir los leads cuyos contadores no coinciden')
+def check_lead_activity_command(repair):
+    """Verificar message_count, interaction_count y last_inbound_at contra las tablas de mensajes e interacciones"""
+    totals = check_lead_activity(repair)
+    if not totals['mismatched']:
+        print("✅ Contadores de actividad consistentes")
+        return
+    print(f"⚠️ {totals['mismatched']} leads con contadores distintos (guardado, real):")
+    for row in totals['sample']:
+        print(f"   lead {row['lead_id']}: mensajes {row['message_count']}, interacciones {row['interaction_count']}, "
+              f"último entrante {row['last_inbound_at']}")
+    if repair:
+        print(f"✅ {totals['repaired']} leads reparados")
+
+@app.cli.command('compact-messages')
+@click.option('--chunk-size', default=1000, show_default=True, help='Mensajes revisados por bloque (un commit por bloque)')
+@click.option('--vacuum', is_flag=True, help='Ejecutar VACUUM al terminar para devolver el espacio al disco')
+def compact_messages_command(chunk_size, vacuum):
+    """Guardar los mensajes de plantilla como referencia + variables en lugar del texto completo"""
+    totals = compact_template_messages(chunk_size)
+    print(f"✅ Mensajes compactados: {totals['compacted']} de {totals['scanned']} "
+          f"({totals['bytes_saved'] / 1024:.1f} KB de texto menos)")
+    if vacuum:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
+        print("🧹 VACUUM completado")
+
+@app.cli.command('clear-llm-cache')
+def clear_llm_cache_command():
+    """Vaciar la caché de respuestas del LLM (por ejemplo, después de cambiar los prompts)"""
+    deleted = llm_cache.clear()
+    print(f"🧹 Caché LLM vaciada: {deleted} respuestas eliminadas")
+
 if __name__ == '__main__':
     # Configuración para producción
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV') == 'development'
-    
+
+    # Con el reloader de desarrollo solo el proceso hijo (el que sirve) arranca los bucles
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_embedded_workers()
+
     app.run(debug=debug, host='0.0.0.0', port=port)
@@ -3,12 +3,56 @@
 Utilidades para la gestión de la base de datos del Nexa WhatsApp Bot
 """
 
+import os
 import sqlite3
 import argparse
 from datetime import datetime, timedelta
 import json
+import re
 from typing import List, Dict, Any
 
+# Consultas calientes de Nexa Lead Manager (con parámetros de ejemplo) para EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    'leads_por_estado': (
+        'SELECT COUNT(*) FROM lead WHERE status = ?', ('NUEVO',)
+    ),
+    'seguimientos_pendientes': (
+        'SELECT id FROM lead WHERE next_follow_up <= ? AND status IN (?, ?, ?)',
+        ('2024-01-01 00:00:00', 'NUEVO', 'CONTACTADO', 'INTERESADO')
+    ),
+    'listado_leads': (
+        'SELECT * FROM lead ORDER BY created_at DESC, id DESC LIMIT 20', ()
+    ),
+    'leads_recientes': (
+        'SELECT COUNT(*) FROM lead WHERE created_at >= ?', ('2024-01-01 00:00:00',)
+    ),
+    'mensajes_de_lead': (
+        'SELECT * FROM message WHERE lead_id = ? ORDER BY created_at DESC LIMIT 10', (1,)
+    ),
+    'interacciones_de_lead': (
+        'SELECT * FROM interaction WHERE lead_id = ? ORDER BY created_at DESC LIMIT 10', (1,)
+    ),
+    'resultados_de_campana': (
+        'SELECT status, COUNT(*) FROM campaign_result WHERE campaign_id = ? GROUP BY status', (1,)
+    ),
+    'mensajes_programados': (
+        "SELECT id, scheduled_at FROM message WHERE status = 'scheduled' AND scheduled_at <= ? ORDER BY scheduled_at LIMIT 50",
+        ('2024-01-01 00:00:00',)
+    ),
+    'outbox_listos': (
+        "SELECT id FROM message WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 50",
+        ('2024-01-01 00:00:00',)
+    ),
+}
+
+def app_database_path() -> str:
+    """Archivo SQLite de Nexa Lead Manager, resuelto como Flask-SQLAlchemy: relativo a instance/"""
+    from models import get_database_uri
+    path = get_database_uri()[len('sqlite:///'):]
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', path)
+    return path
+
 class DatabaseManager:
     def __init__(self, db_path: str = 'nexa_bot.db'):
         self.db_path = db_path
@@ -157,9 +201,36 @@ class DatabaseManager:
             ''', (f'%{search_term}%', f'%{search_term}%', limit))
             return [dict(row) for row in cursor.fetchall()]
 
+    def explain_hot_queries(self) -> List[Dict[str, Any]]:
+        """Mostrar qué índice usa cada consulta caliente (EXPLAIN QUERY PLAN)"""
+        report = []
+        with self.get_connection() as conn:
+            for name, (query, params) in HOT_QUERIES.items():
+                try:
+                    plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+                except sqlite3.Error as e:
+                    report.append({'query': name, 'plan': [], 'indexes': [], 'full_scan': False, 'error': str(e)})
+                    continue
+                
+                indexes = []
+                for detail in plan:
+                    match = re.search(r'USING (?:COVERING )?INDEX (\w+)', detail)
+                    if match:
+                        indexes.append(match.group(1))
+                    elif 'USING INTEGER PRIMARY KEY' in detail:
+                        indexes.append('PRIMARY KEY')
+                
+                report.append({
+                    'query': name,
+                    'plan': plan,
+                    'indexes': indexes,
+                    'full_scan': any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in plan)
+                })
+        return report
+
 def main():
     parser = argparse.ArgumentParser(description='Utilidades de base de datos para Nexa WhatsApp Bot')
-    parser.add_argument('--db', default='nexa_bot.db', help='Ruta de la base de datos')
+    parser.add_argument('--db', help='Ruta de la base de datos (por defecto nexa_bot.db; explain usa la base de la aplicación)')
     
     subparsers = parser.add_subparsers(dest='command', help='Comandos disponibles')
     
@@ -188,13 +259,20 @@ def main():
     search_parser.add_argument('term', help='Término de búsqueda')
     search_parser.add_argument('--limit', type=int, default=100, help='Límite de resultados')
     
+    # Comando de análisis de índices
+    explain_parser = subparsers.add_parser('explain', help='Mostrar índices usados por las consultas calientes')
+    
     args = parser.parse_args()
     
     if not args.command:
         parser.print_help()
         return
     
-    db_manager = DatabaseManager(args.db)
+    db_path = args.db
+    if db_path is None:
+        # Las consultas calientes son de Nexa Lead Manager, no de la base del bot
+        db_path = app_database_path() if args.command == 'explain' else 'nexa_bot.db'
+    db_manager = DatabaseManager(db_path)
     
     try:
         if args.command == 'stats':
@@ -235,6 +313,22 @@ def main():
             for result in results[:10]:  # Mostrar solo los primeros 10
                 print(f"  {result['timestamp']} - {result['phone_number']}: {result['message'][:50]}...")
     
+        elif args.command == 'explain':
+            if not os.path.exists(db_path):
+                print(f"❌ No existe la base de datos: {db_path}")
+                return
+            report = db_manager.explain_hot_queries()
+            print(f"\n🔎 Plan de ejecución de consultas calientes ({db_path}):")
+            for entry in report:
+                if entry.get('error'):
+                    print(f"  ⚠️ {entry['query']}: {entry['error']}")
+                    continue
+                status = '❌ SCAN completo' if entry['full_scan'] else '✅'
+                indexes = ', '.join(entry['indexes']) or 'ninguno'
+                print(f"  {status} {entry['query']}: índice {indexes}")
+                for detail in entry['plan']:
+                    print(f"      {detail}")
+    
     except Exception as e:
         print(f"❌ Error: {e}")
 
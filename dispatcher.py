@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Despachador concurrente de mensajes salientes de WhatsApp para Nexa Lead Manager
+Envía lotes de mensajes con un pool acotado de hilos y un token bucket ajustado
+a la cuota de mensajes por segundo de Twilio
+"""
+
+import os
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioException, TwilioRestException
+
+logger = logging.getLogger(__name__)
+
+TWILIO_API_BASE = 'https://api.twilio.com'
+
+# Cuota de Twilio (mensajes/segundo) e hilos de envío; 0 desactiva el limitador
+MESSAGES_PER_SECOND = float(os.getenv('TWILIO_MESSAGES_PER_SECOND', 10))
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 8))
+DISPATCH_BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE', 100))
+# Tope por request a Twilio: un envío sin respuesta no retiene el lote más allá del lease del outbox
+TWILIO_HTTP_TIMEOUT_SECONDS = float(os.getenv('TWILIO_HTTP_TIMEOUT_SECONDS', 15))
+
+class TokenBucket:
+    """Limitador de tasa thread-safe: `rate` tokens por segundo con ráfagas de hasta `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Bloquear hasta obtener un token"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class PooledTwilioHttpClient(TwilioHttpClient):
+    """Cliente HTTP de Twilio con pool de conexiones dimensionado, timeout y URL base configurable"""
+
+    def __init__(self, pool_size: int = DISPATCH_WORKERS, base_url: str = None,
+                 timeout: float = TWILIO_HTTP_TIMEOUT_SECONDS, **kwargs):
+        super().__init__(pool_connections=True, timeout=timeout, **kwargs)
+        self.base_url = (base_url or '').rstrip('/')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 10))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.base_url and url.startswith(TWILIO_API_BASE):
+            url = self.base_url + url[len(TWILIO_API_BASE):]
+        return super().request(method, url, *args, **kwargs)
+
+def build_twilio_client(account_sid: str, auth_token: str, pool_size: int = DISPATCH_WORKERS,
+                        base_url: str = None, timeout: float = TWILIO_HTTP_TIMEOUT_SECONDS) -> Client:
+    """Crear un cliente de Twilio apto para envíos concurrentes (TWILIO_API_BASE_URL apunta a un servidor falso)"""
+    http_client = PooledTwilioHttpClient(
+        pool_size=pool_size, base_url=base_url or os.getenv('TWILIO_API_BASE_URL'), timeout=timeout
+    )
+    return Client(account_sid, auth_token, http_client=http_client)
+
+def outbound_message(lead_id: int, to_number: str, body: str, **extra) -> Dict:
+    """Mensaje a despachar; los campos extra se devuelven intactos en el resultado"""
+    return dict(extra, lead_id=lead_id, to=to_number, body=body)
+
+class OutboundDispatcher:
+    """Envía mensajes en lotes con concurrencia acotada y tasa limitada, sin tocar la base de datos"""
+
+    def __init__(self, twilio_client: Client, whatsapp_from: str, workers: int = DISPATCH_WORKERS,
+                 rate: float = MESSAGES_PER_SECOND, batch_size: int = DISPATCH_BATCH_SIZE):
+        self.twilio_client = twilio_client
+        self.whatsapp_from = whatsapp_from
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.bucket = TokenBucket(rate)
+
+    def worst_case_seconds(self, messages: int) -> float:
+        """Duración máxima de dispatch() para `messages` mensajes si todos agotan el timeout HTTP"""
+        timeout = getattr(self.twilio_client.http_client, 'timeout', None)
+        if not timeout:
+            return float('inf')
+        rounds = -(-messages // self.workers)
+        rate_wait = messages / self.bucket.rate if self.bucket.rate > 0 else 0.0
+        return rounds * timeout + rate_wait
+
+    def _send_one(self, message: Dict) -> Dict:
+        self.bucket.acquire()
+        result = dict(message, sid=None, error=None, sent_at=None, retryable=True)
+        try:
+            sent = self.twilio_client.messages.create(
+                from_=f"whatsapp:{self.whatsapp_from}",
+                body=message['body'],
+                to=f"whatsapp:{message['to']}"
+            )
+            result['sid'] = sent.sid
+            result['sent_at'] = datetime.utcnow()
+        except TwilioRestException as e:
+            # Los 4xx (salvo 429) son rechazos definitivos: número inválido, opt-out, etc.
+            result['error'] = f"Error de Twilio: {e}"
+            result['retryable'] = e.status == 429 or e.status >= 500
+        except TwilioException as e:
+            result['error'] = f"Error de Twilio: {e}"
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    def dispatch(self, messages: Iterable[Dict],
+                 on_progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """Enviar todos los mensajes; devuelve totales y un resultado por mensaje"""
+        messages = list(messages)
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        results: List[Dict] = []
+        sent = failed = 0
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dispatch') as executor:
+            for number, batch in enumerate(batches, start=1):
+                batch_results = list(executor.map(self._send_one, batch))
+                results.extend(batch_results)
+                batch_failed = sum(1 for result in batch_results if result['error'])
+                sent += len(batch_results) - batch_failed
+                failed += batch_failed
+
+                elapsed = time.monotonic() - started
+                progress = {
+                    'batch': number,
+                    'batches': len(batches),
+                    'processed': len(results),
+                    'total': len(messages),
+                    'sent': sent,
+                    'failed': failed,
+                    'rate': round(len(results) / elapsed, 1) if elapsed else None
+                }
+                logger.info(
+                    f"Lote {number}/{len(batches)}: {len(results)}/{len(messages)} procesados, "
+                    f"{failed} fallidos, {progress['rate']} msg/s"
+                )
+                if on_progress:
+                    on_progress(progress)
+
+        elapsed = time.monotonic() - started
+        return {
+            'total': len(messages),
+            'sent': sent,
+            'failed': failed,
+            'elapsed': round(elapsed, 3),
+            'rate': round(len(messages) / elapsed, 1) if elapsed else None,
+            'results': results
+        }
+
+def run_benchmark(messages: int, concurrency: List[int], rate: float, latency: float, failure_rate: float):
+    """Medir mensajes/segundo contra el servidor falso de Twilio para cada nivel de concurrencia"""
+    from fake_twilio import FakeTwilioServer
+
+    with FakeTwilioServer(latency=latency, failure_rate=failure_rate) as server:
+        print(f"📡 Servidor falso de Twilio en {server.base_url} (latencia {latency * 1000:.0f} ms)")
+        print(f"{'hilos':>6} {'enviados':>9} {'fallidos':>9} {'segundos':>9} {'msg/s':>8}")
+        for workers in concurrency:
+            client = build_twilio_client('ACbenchmark', 'token', pool_size=workers, base_url=server.base_url)
+            dispatcher = OutboundDispatcher(client, '+5491100000000', workers=workers, rate=rate)
+            batch = [outbound_message(i, f'+54911{i:08d}', f'Mensaje {i}') for i in range(messages)]
+            report = dispatcher.dispatch(batch)
+            print(f"{workers:>6} {report['sent']:>9} {report['failed']:>9} {report['elapsed']:>9} {report['rate']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Despachador de mensajes de WhatsApp')
+    subparsers = parser.add_subparsers(dest='command', help='Comandos disponibles')
+
+    bench_parser = subparsers.add_parser('benchmark', help='Medir msg/s contra un servidor falso de Twilio')
+    bench_parser.add_argument('--messages', type=int, default=200, help='Mensajes por corrida')
+    bench_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16, 32], help='Niveles de concurrencia')
+    bench_parser.add_argument('--rate', type=float, default=0, help='Límite de msg/s (0 = sin límite)')
+    bench_parser.add_argument('--latency', type=float, default=0.05, help='Latencia simulada de Twilio en segundos')
+    bench_parser.add_argument('--failure-rate', type=float, default=0.0, help='Proporción de envíos rechazados')
+
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        run_benchmark(args.messages, args.concurrency, args.rate, args.latency, args.failure_rate)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
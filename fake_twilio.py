@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Servidor HTTP local que imita la API de mensajes de Twilio
+Sirve para probar y medir el despachador sin enviar mensajes reales
+(TWILIO_API_BASE_URL=http://127.0.0.1:<puerto>)
+"""
+
+import json
+import time
+import random
+import threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+class _FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if not self.path.endswith('/Messages.json'):
+            return self._reply(404, {'code': 20404, 'message': 'Not found', 'status': 404})
+        if server.failure_rate and random.random() < server.failure_rate:
+            if server.error_status >= 500:
+                return self._reply(server.error_status, {'code': 20500, 'message': 'Internal Server Error', 'status': server.error_status})
+            return self._reply(server.error_status, {'code': 21211, 'message': "Invalid 'To' Phone Number", 'status': server.error_status})
+
+        sid = 'SM' + uuid4().hex
+        with server.lock:
+            server.received.append({'sid': sid, 'to': form.get('To'), 'body': form.get('Body')})
+        self._reply(201, {
+            'sid': sid,
+            'status': 'queued',
+            'to': form.get('To'),
+            'from': form.get('From'),
+            'body': form.get('Body'),
+            'num_segments': '1'
+        })
+
+    def _reply(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTwilioServer:
+    """Servidor falso en un hilo de fondo; usar como context manager"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, failure_rate: float = 0.0,
+                 error_status: int = 400):
+        self.httpd = ThreadingHTTPServer((host, port), _FakeTwilioHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.failure_rate = failure_rate
+        self.httpd.error_status = error_status
+        self.httpd.received = []
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def received(self):
+        return self.httpd.received
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor falso de la API de mensajes de Twilio')
+    parser.add_argument('--port', type=int, default=8089, help='Puerto de escucha')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latencia simulada en segundos')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Proporción de envíos rechazados')
+    parser.add_argument('--error-status', type=int, default=400, help='Código HTTP de los rechazos (5xx = transitorio)')
+    args = parser.parse_args()
+
+    server = FakeTwilioServer(port=args.port, latency=args.latency, failure_rate=args.failure_rate,
+                              error_status=args.error_status)
+    print(f"📡 Twilio falso escuchando en {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Servidor detenido")
+
+if __name__ == '__main__':
+    main()
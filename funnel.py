@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Registro de cambios de estado y motor de funnel incremental
+Cada cambio de Lead.status agrega una fila a lead_status_change y actualiza
+funnel_transition_stats en la misma transacción
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Optional
+from flask import has_request_context
+from flask_login import current_user
+from sqlalchemy import event, inspect, text, func, select, exists, case, literal, update
+from models import db, Lead, LeadStatus, LeadStatusChange, FunnelTransitionStat
+from counters import read_counters, status_key
+
+logger = logging.getLogger(__name__)
+
+CREATED_STAGE = ''
+
+_UPSERT_SQL = text("""
+    INSERT INTO funnel_transition_stats (from_stage, to_stage, transition_count, total_seconds)
+    VALUES (:from_stage, :to_stage, :count, :seconds)
+    ON CONFLICT (from_stage, to_stage) DO UPDATE SET
+        transition_count = funnel_transition_stats.transition_count + excluded.transition_count,
+        total_seconds = funnel_transition_stats.total_seconds + excluded.total_seconds
+""")
+
+def _stage(status) -> str:
+    if status is None:
+        return CREATED_STAGE
+    return status.value if hasattr(status, 'value') else str(status)
+
+def _current_user_id() -> Optional[int]:
+    """Usuario autenticado que provoca el cambio (si hay una request activa)"""
+    try:
+        if has_request_context() and current_user.is_authenticated:
+            return current_user.id
+    except Exception:
+        pass
+    return None
+
+@event.listens_for(db.session, 'before_flush')
+def _record_status_changes(session, flush_context, instances):
+    """Registrar cada cambio de estado y acumular el funnel dentro del mismo flush"""
+    now = datetime.utcnow()
+    deltas = defaultdict(lambda: [0, 0.0])
+    user_id = _current_user_id()
+
+    for obj in list(session.new):
+        if isinstance(obj, Lead):
+            status = obj.status or LeadStatus.NUEVO
+            obj.status_changed_at = obj.status_changed_at or now
+            session.add(LeadStatusChange(
+                lead=obj, from_status=None, to_status=status,
+                seconds_in_previous=0, changed_by_id=user_id, changed_at=obj.status_changed_at
+            ))
+            deltas[(CREATED_STAGE, _stage(status))][0] += 1
+
+    for obj in list(session.dirty):
+        if not isinstance(obj, Lead):
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.deleted or _stage(history.deleted[0]) == _stage(obj.status):
+            continue
+        old_status = history.deleted[0]
+        entered_at = obj.status_changed_at or obj.created_at or now
+        seconds = max(0.0, (now - entered_at).total_seconds())
+        session.add(LeadStatusChange(
+            lead_id=obj.id, from_status=old_status, to_status=obj.status,
+            seconds_in_previous=seconds, changed_by_id=user_id, changed_at=now
+        ))
+        obj.status_changed_at = now
+        delta = deltas[(_stage(old_status), _stage(obj.status))]
+        delta[0] += 1
+        delta[1] += seconds
+
+    if deltas:
+        session.connection().execute(_UPSERT_SQL, [
+            {'from_stage': from_stage, 'to_stage': to_stage, 'count': count, 'seconds': seconds}
+            for (from_stage, to_stage), (count, seconds) in deltas.items()
+        ])
+
+def record_bulk_creations(connection, lead_ids, status: LeadStatus, changed_at: datetime,
+                          changed_by_id: Optional[int] = None):
+    """Registrar la transición inicial de leads creados con INSERT masivo (no pasan por el flush)"""
+    if not lead_ids:
+        return
+    connection.execute(LeadStatusChange.__table__.insert(), [{
+        'lead_id': lead_id, 'from_status': None, 'to_status': status,
+        'seconds_in_previous': 0, 'changed_by_id': changed_by_id, 'changed_at': changed_at
+    } for lead_id in lead_ids])
+    connection.execute(_UPSERT_SQL, {
+        'from_stage': CREATED_STAGE, 'to_stage': _stage(status), 'count': len(lead_ids), 'seconds': 0.0
+    })
+
+def seed_status_history() -> int:
+    """Registrar el estado actual como transición inicial de los leads sin historial"""
+    entered_at = case(
+        (Lead.status == LeadStatus.NUEVO, Lead.created_at),
+        else_=func.coalesce(Lead.updated_at, Lead.created_at)
+    )
+    seed = select(
+        Lead.id, Lead.status, literal(0.0), func.coalesce(entered_at, func.current_timestamp())
+    ).where(
+        Lead.status.isnot(None),
+        ~exists().where(LeadStatusChange.lead_id == Lead.id)
+    )
+    result = db.session.execute(LeadStatusChange.__table__.insert().from_select(
+        ['lead_id', 'to_status', 'seconds_in_previous', 'changed_at'], seed
+    ))
+    db.session.execute(
+        update(Lead).where(Lead.status_changed_at.is_(None)).values(status_changed_at=entered_at),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    return result.rowcount
+
+def rebuild_funnel_stats() -> int:
+    """Recalcular funnel_transition_stats desde el registro de transiciones"""
+    rows = db.session.query(
+        LeadStatusChange.from_status, LeadStatusChange.to_status,
+        func.count(LeadStatusChange.id), func.coalesce(func.sum(LeadStatusChange.seconds_in_previous), 0)
+    ).group_by(LeadStatusChange.from_status, LeadStatusChange.to_status).all()
+
+    FunnelTransitionStat.query.delete()
+    db.session.bulk_insert_mappings(FunnelTransitionStat, [
+        {'from_stage': _stage(from_status), 'to_stage': _stage(to_status),
+         'transition_count': count, 'total_seconds': float(seconds)}
+        for from_status, to_status, count, seconds in rows
+    ])
+    db.session.commit()
+    logger.info(f"Funnel reconstruido: {len(rows)} transiciones distintas")
+    return len(rows)
+
+def ensure_funnel():
+    """Inicializar el historial y el funnel la primera vez que se despliega"""
+    if not db.session.query(LeadStatusChange.id).first() and db.session.query(Lead.id).first():
+        seeded = seed_status_history()
+        rebuild_funnel_stats()
+        logger.info(f"Historial de estados inicializado para {seeded} leads")
+
+def count_transitions_since(to_status: LeadStatus, since: datetime) -> int:
+    """Transiciones a un estado desde una fecha (índice to_status, changed_at)"""
+    return LeadStatusChange.query.filter(
+        LeadStatusChange.to_status == to_status,
+        LeadStatusChange.changed_at >= since
+    ).count()
+
+def get_funnel() -> Dict:
+    """Funnel por etapa: entradas, salidas, conversión entre etapas y tiempo medio en cada etapa"""
+    stages = [status.value for status in LeadStatus]
+    entered = defaultdict(int)
+    exited = defaultdict(int)
+    seconds_in_stage = defaultdict(float)
+    transitions = []
+
+    stats = FunnelTransitionStat.query.all()
+    for stat in stats:
+        entered[stat.to_stage] += stat.transition_count
+        if stat.from_stage != CREATED_STAGE:
+            exited[stat.from_stage] += stat.transition_count
+            seconds_in_stage[stat.from_stage] += stat.total_seconds
+
+    for stat in stats:
+        base = entered[stat.from_stage] if stat.from_stage != CREATED_STAGE else None
+        transitions.append({
+            'from': stat.from_stage or None,
+            'to': stat.to_stage,
+            'count': stat.transition_count,
+            'rate': round(stat.transition_count / base * 100, 1) if base else None,
+            'avg_hours_in_from': round(stat.total_seconds / stat.transition_count / 3600, 1)
+            if stat.from_stage != CREATED_STAGE and stat.transition_count else None
+        })
+
+    current = read_counters(status_key(stage) for stage in stages)
+    return {
+        'stages': [{
+            'stage': stage,
+            'entered': entered[stage],
+            'exited': exited[stage],
+            'current': current[status_key(stage)],
+            'avg_hours_in_stage': round(seconds_in_stage[stage] / exited[stage] / 3600, 1) if exited[stage] else None
+        } for stage in stages],
+        'transitions': sorted(transitions, key=lambda item: (-item['count'], item['from'] or '', item['to']))
+    }
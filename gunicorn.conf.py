@@ -29,3 +29,16 @@ pidfile = "gunicorn.pid"
 limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+# Hooks
+def post_fork(server, worker):
+    """Con preload_app el worker hereda el pool de conexiones del master: descartarlo sin cerrarlas"""
+    from dashboard import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def post_worker_init(worker):
+    """Scheduler y outbox embebidos: un lock de archivo los deja en un único worker a la vez"""
+    from dashboard import start_embedded_workers
+    start_embedded_workers()
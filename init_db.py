@@ -9,6 +9,7 @@ import sys
 from datetime import datetime, timedelta
 from models import db, User, Lead, LeadStatus, LeadSource, MessageTemplate, Campaign
 from lead_manager import lead_manager
+from counters import rebuild_counters
 from werkzeug.security import generate_password_hash
 
 def init_database():
@@ -38,6 +39,9 @@ def init_database():
     create_sample_leads()
     
     db.session.commit()
+    
+    # Dejar los contadores del dashboard consistentes con los datos iniciales
+    rebuild_counters()
     print("✅ Base de datos inicializada correctamente")
 
 def create_default_templates():
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Contadores de actividad por lead para Nexa Lead Manager
+Lead.message_count, Lead.interaction_count y Lead.last_inbound_at se actualizan en la misma
+transacción que los INSERT/DELETE de mensajes e interacciones; los listados y el scoring leen
+una sola fila en lugar de agregar las tablas hijas
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+from sqlalchemy import bindparam, event, text
+from models import db, Lead, Message, Interaction
+
+logger = logging.getLogger(__name__)
+
+INBOUND = 'inbound'
+REPAIR_CHUNK_SIZE = 500
+MISMATCH_SAMPLE = 20
+
+_APPLY_SQL = text("""
+    UPDATE lead SET
+        message_count = coalesce(message_count, 0) + :messages,
+        interaction_count = coalesce(interaction_count, 0) + :interactions,
+        last_inbound_at = CASE
+            WHEN :inbound_at IS NOT NULL AND (last_inbound_at IS NULL OR last_inbound_at < :inbound_at)
+            THEN :inbound_at ELSE last_inbound_at END
+    WHERE id = :lead_id
+""").bindparams(bindparam('inbound_at', type_=db.DateTime))
+
+# Valores reales desde las tablas hijas (usa los índices (lead_id, created_at))
+_ACTUAL_MESSAGES = "(SELECT count(*) FROM message WHERE message.lead_id = lead.id)"
+_ACTUAL_INTERACTIONS = "(SELECT count(*) FROM interaction WHERE interaction.lead_id = lead.id)"
+_ACTUAL_LAST_INBOUND = (
+    f"(SELECT max(created_at) FROM message WHERE message.lead_id = lead.id AND message.message_type = '{INBOUND}')"
+)
+
+_RECOMPUTE_LAST_INBOUND_SQL = text(f"UPDATE lead SET last_inbound_at = {_ACTUAL_LAST_INBOUND} WHERE id = :lead_id")
+
+_MISMATCH_SQL = text(f"""
+    SELECT id, message_count, interaction_count, last_inbound_at,
+           {_ACTUAL_MESSAGES} AS actual_messages,
+           {_ACTUAL_INTERACTIONS} AS actual_interactions,
+           {_ACTUAL_LAST_INBOUND} AS actual_last_inbound
+    FROM lead
+    WHERE message_count IS NOT {_ACTUAL_MESSAGES}
+       OR interaction_count IS NOT {_ACTUAL_INTERACTIONS}
+       OR last_inbound_at IS NOT {_ACTUAL_LAST_INBOUND}
+""")
+
+_REPAIR_SQL = text(f"""
+    UPDATE lead SET
+        message_count = {_ACTUAL_MESSAGES},
+        interaction_count = {_ACTUAL_INTERACTIONS},
+        last_inbound_at = {_ACTUAL_LAST_INBOUND}
+    WHERE id IN :lead_ids
+""").bindparams(bindparam('lead_ids', expanding=True))
+
+def _new_delta():
+    return {'messages': 0, 'interactions': 0, 'inbound_at': None}
+
+def apply_activity_deltas(connection, deltas: Dict[int, Dict]):
+    """Aplicar variaciones por lead: {lead_id: {'messages': n, 'interactions': n, 'inbound_at': fecha}}"""
+    params = [
+        dict(_new_delta(), **delta, lead_id=lead_id)
+        for lead_id, delta in deltas.items() if lead_id is not None
+    ]
+    if params:
+        connection.execute(_APPLY_SQL, params)
+
+def record_bulk_activity(connection, lead_ids: Iterable[int], messages: int = 0, interactions: int = 0,
+                         inbound_at: Optional[datetime] = None):
+    """Sumar actividad a leads escritos con INSERT masivo (no pasan por el flush); un lead repetido suma varias veces"""
+    deltas = defaultdict(_new_delta)
+    for lead_id in lead_ids:
+        delta = deltas[lead_id]
+        delta['messages'] += messages
+        delta['interactions'] += interactions
+        delta['inbound_at'] = inbound_at
+    apply_activity_deltas(connection, deltas)
+
+@event.listens_for(db.session, 'after_flush')
+def _update_activity_after_flush(session, flush_context):
+    """Mantener los contadores del lead dentro del mismo flush (después del INSERT, con lead_id asignado)"""
+    deltas = defaultdict(_new_delta)
+    recompute_inbound = set()
+
+    for obj in session.new:
+        if isinstance(obj, Message) and obj.lead_id is not None:
+            delta = deltas[obj.lead_id]
+            delta['messages'] += 1
+            if obj.message_type == INBOUND and obj.created_at:
+                delta['inbound_at'] = max(filter(None, (delta['inbound_at'], obj.created_at)))
+        elif isinstance(obj, Interaction):
+            deltas[obj.lead_id]['interactions'] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Message) and obj.lead_id is not None:
+            deltas[obj.lead_id]['messages'] -= 1
+            if obj.message_type == INBOUND:
+                recompute_inbound.add(obj.lead_id)
+        elif isinstance(obj, Interaction):
+            deltas[obj.lead_id]['interactions'] -= 1
+
+    if deltas:
+        connection = session.connection()
+        apply_activity_deltas(connection, deltas)
+        # Borrar el último mensaje entrante obliga a buscar el anterior
+        if recompute_inbound:
+            connection.execute(_RECOMPUTE_LAST_INBOUND_SQL, [{'lead_id': lead_id} for lead_id in recompute_inbound])
+
+def check_lead_activity(repair: bool = False) -> Dict:
+    """Comparar los contadores con las tablas hijas; con repair=True corrige los leads que no coinciden"""
+    mismatched = db.session.execute(_MISMATCH_SQL).all()
+    totals = {
+        'mismatched': len(mismatched),
+        'repaired': 0,
+        'sample': [{
+            'lead_id': row.id,
+            'message_count': [row.message_count, row.actual_messages],
+            'interaction_count': [row.interaction_count, row.actual_interactions],
+            'last_inbound_at': [row.last_inbound_at, row.actual_last_inbound]
+        } for row in mismatched[:MISMATCH_SAMPLE]]
+    }
+    if repair and mismatched:
+        lead_ids = [row.id for row in mismatched]
+        for start in range(0, len(lead_ids), REPAIR_CHUNK_SIZE):
+            db.session.execute(_REPAIR_SQL, {'lead_ids': lead_ids[start:start + REPAIR_CHUNK_SIZE]})
+            db.session.commit()
+        totals['repaired'] = len(lead_ids)
+        logger.info(f"Contadores de actividad reparados en {len(lead_ids)} leads")
+    return totals
+
+def ensure_lead_activity():
+    """Completar los contadores la primera vez (columnas recién agregadas a una base existente)"""
+    if db.session.query(Lead.id).filter(Lead.message_count.is_(None)).first():
+        check_lead_activity(repair=True)
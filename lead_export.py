@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Exportación de leads en streaming (CSV / NDJSON) para Nexa Lead Manager
+Recorre la consulta con yield_per (cursor del lado del servidor) cargando solo las columnas exportadas
+y emite los bytes por bloques, con gzip opcional; la memoria no depende de la cantidad de leads
+"""
+
+import os
+import io
+import csv
+import json
+import zlib
+from typing import Iterable, Iterator
+from models import db, Lead
+from search_index import apply_lead_search
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+# Columnas exportadas, en el orden del encabezado CSV
+EXPORT_COLUMNS = (
+    Lead.id, Lead.name, Lead.phone_number, Lead.email, Lead.company, Lead.status, Lead.source,
+    Lead.interest_level, Lead.created_at, Lead.last_contact_date, Lead.next_follow_up
+)
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+
+def build_export_query(status: str = None, source: str = None, search: str = None):
+    """Consulta de exportación con los mismos filtros que /api/leads, sobre el índice (created_at, id)"""
+    query = db.session.query(*EXPORT_COLUMNS)
+    if status:
+        query = query.filter(Lead.status == status)
+    if source:
+        query = query.filter(Lead.source == source)
+    if search:
+        # El ranking no se usa: la exportación sigue el orden de creación
+        query, _ = apply_lead_search(query, search)
+    return query.order_by(Lead.created_at.desc(), Lead.id.desc())
+
+def _export_value(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return getattr(value, 'value', value)
+
+def _batched_rows(query, batch_size: int) -> Iterator[list]:
+    """Filas de la consulta agrupadas en bloques de batch_size, leídas con un cursor en streaming"""
+    batch = []
+    for row in query.yield_per(batch_size):
+        batch.append([_export_value(value) for value in row])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_csv(query, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """CSV con encabezado; un fragmento de bytes por bloque de filas"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    # El encabezado sale antes de la primera consulta: la descarga empieza de inmediato
+    yield buffer.getvalue().encode('utf-8')
+    for batch in _batched_rows(query, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_ndjson(query, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """Un objeto JSON por línea; un fragmento de bytes por bloque de filas"""
+    for batch in _batched_rows(query, batch_size):
+        yield ''.join(
+            json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n' for row in batch
+        ).encode('utf-8')
+
+def gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Comprimir un flujo de bytes en formato gzip sin acumularlo en memoria"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: cabecera gzip
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_leads(export_format: str = 'csv', gzip: bool = False, batch_size: int = EXPORT_BATCH_SIZE,
+                 **filters) -> Iterator[bytes]:
+    """Generador de bytes de la exportación en el formato pedido"""
+    query = build_export_query(**filters)
+    chunks = iter_csv(query, batch_size) if export_format == 'csv' else iter_ndjson(query, batch_size)
+    return gzip_stream(chunks) if gzip else chunks
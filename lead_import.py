@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Importación de leads desde CSV para Nexa Lead Manager
+Lee el archivo en streaming, comprueba duplicados por bloque con una sola consulta IN (...),
+inserta en bloque y confirma cada N filas; el progreso queda en import_job para consultarlo
+"""
+
+import os
+import csv
+import json
+import socket
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+from sqlalchemy import case, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Lead, LeadStatus, LeadSource, ImportJob, normalize_phone
+from counters import apply_deltas, status_key, source_key, TOTAL_LEADS_KEY
+from funnel import record_bulk_creations
+from lead_scores import enqueue_leads
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 1000))
+IMPORT_UPLOAD_DIR = os.getenv('IMPORT_UPLOAD_DIR', 'uploads')
+IMPORT_SKIPPED_SAMPLE = 50
+# Sin heartbeat durante este tiempo el trabajo se considera interrumpido (worker reciclado o caído)
+IMPORT_JOB_STALE_SECONDS = int(os.getenv('IMPORT_JOB_STALE_SECONDS', 300))
+IMPORT_JOB_MAX_RESUMES = int(os.getenv('IMPORT_JOB_MAX_RESUMES', 3))
+
+# Motivos de omisión expuestos en el estado del trabajo
+SKIP_NO_PHONE = 'sin_telefono'
+SKIP_INVALID_PHONE = 'telefono_invalido'
+SKIP_DUPLICATE_IN_FILE = 'duplicado_en_archivo'
+SKIP_EXISTING = 'ya_existe'
+SKIP_INVALID = 'fila_invalida'
+
+def _clean(value) -> str:
+    return str(value or '').strip()
+
+def count_csv_rows(csv_file_path: str) -> int:
+    """Cantidad aproximada de filas de datos (líneas menos el encabezado), leyendo en bloques binarios"""
+    lines = 0
+    with open(csv_file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return max(0, lines - 1)
+
+def _insert_chunk(rows: List[Dict], now: datetime, created_by_id: Optional[int]) -> List[str]:
+    """Insertar un bloque de leads; devuelve los teléfonos normalizados insertados (los que ya existían se ignoran)"""
+    # Sin columnas de conflicto: cubre tanto phone_number como el índice único de phone_e164
+    inserted = db.session.execute(
+        sqlite_insert(Lead).on_conflict_do_nothing().returning(Lead.id, Lead.phone_e164),
+        rows
+    ).all()
+    if inserted:
+        connection = db.session.connection()
+        # Los INSERT masivos no pasan por el flush: contadores, funnel y cola de scores se actualizan a mano
+        apply_deltas(connection, {
+            TOTAL_LEADS_KEY: len(inserted),
+            status_key(LeadStatus.NUEVO): len(inserted),
+            source_key(LeadSource.WEBSITE): len(inserted)
+        })
+        record_bulk_creations(connection, [row.id for row in inserted], LeadStatus.NUEVO, now, created_by_id)
+        enqueue_leads(connection, [row.id for row in inserted])
+    return [row.phone_e164 for row in inserted]
+
+def import_leads_from_csv(csv_file_path: str, chunk_size: int = IMPORT_CHUNK_SIZE, created_by_id: int = None,
+                          on_chunk: Optional[Callable[[Dict], None]] = None, previous: Optional[Dict] = None) -> Dict:
+    """Importar un CSV por bloques con un commit por bloque; devuelve totales y motivos de omisión
+
+    `previous` son los totales confirmados por una ejecución interrumpida: sus primeras
+    `processed` filas ya están importadas o contadas y no se vuelven a procesar
+    """
+    totals = {'processed': 0, 'imported': 0, 'skipped': 0, 'skip_reasons': Counter(), 'skipped_rows': []}
+    if previous:
+        totals.update(
+            processed=previous['processed'], imported=previous['imported'], skipped=previous['skipped'],
+            skip_reasons=Counter(previous['skip_reasons']), skipped_rows=list(previous['skipped_rows'])
+        )
+    resume_after = totals['processed']
+    seen = set()
+
+    def skip(line: int, reason: str, phone_number: str = ''):
+        totals['skipped'] += 1
+        totals['skip_reasons'][reason] += 1
+        if len(totals['skipped_rows']) < IMPORT_SKIPPED_SAMPLE:
+            totals['skipped_rows'].append({'line': line, 'reason': reason, 'phone_number': phone_number})
+
+    def flush(chunk: List[tuple]):
+        now = datetime.utcnow()
+        phones = [row['phone_e164'] for _, row in chunk]
+        existing = {
+            phone for (phone,) in db.session.query(Lead.phone_e164).filter(Lead.phone_e164.in_(phones))
+        }
+        new_rows = []
+        for line, row in chunk:
+            if row['phone_e164'] in existing:
+                skip(line, SKIP_EXISTING, row['phone_number'])
+            else:
+                new_rows.append((line, dict(row, created_at=now, updated_at=now, status_changed_at=now)))
+        if new_rows:
+            inserted = set(_insert_chunk([row for _, row in new_rows], now, created_by_id))
+            # Un lead creado por otro proceso entre la consulta y el INSERT también cuenta como existente
+            for line, row in new_rows:
+                if row['phone_e164'] not in inserted:
+                    skip(line, SKIP_EXISTING, row['phone_number'])
+            totals['imported'] += len(inserted)
+        if on_chunk:
+            on_chunk(totals)
+        db.session.commit()
+
+    chunk = []
+    with open(csv_file_path, 'r', encoding='utf-8-sig', newline='') as file:
+        reader = csv.DictReader(file)
+        for index, row in enumerate(reader, 1):
+            if index <= resume_after:
+                # Fila ya confirmada: solo se recuerda el teléfono para detectar duplicados posteriores
+                phone_e164 = normalize_phone(_clean(row.get('phone_number')))
+                if phone_e164:
+                    seen.add(phone_e164)
+                continue
+            totals['processed'] += 1
+            line = reader.line_num
+            try:
+                phone_number = _clean(row.get('phone_number'))
+                if not phone_number:
+                    skip(line, SKIP_NO_PHONE)
+                    continue
+                phone_e164 = normalize_phone(phone_number)
+                if not phone_e164:
+                    skip(line, SKIP_INVALID_PHONE, phone_number)
+                    continue
+                # El mismo número escrito de otra forma también es un duplicado
+                if phone_e164 in seen:
+                    skip(line, SKIP_DUPLICATE_IN_FILE, phone_number)
+                    continue
+                seen.add(phone_e164)
+                chunk.append((line, {
+                    'phone_number': phone_number,
+                    'phone_e164': phone_e164,
+                    'name': _clean(row.get('name')),
+                    'email': _clean(row.get('email')),
+                    'company': _clean(row.get('company')),
+                    'source': LeadSource.WEBSITE,
+                    'status': LeadStatus.NUEVO,
+                    'notes': row.get('notes') or 'Importado desde CSV',
+                    'created_by_id': created_by_id
+                }))
+            except Exception as e:
+                logger.error(f"Error importando fila {line}: {e}")
+                skip(line, SKIP_INVALID)
+                continue
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        elif on_chunk:
+            # Filas finales omitidas sin bloque pendiente: dejar el progreso al día
+            on_chunk(totals)
+            db.session.commit()
+
+    logger.info(f"Importación completada: {totals['imported']} importados, {totals['skipped']} omitidos")
+    return totals
+
+def create_import_job(file_storage, created_by_id: int = None) -> ImportJob:
+    """Guardar el archivo subido en el directorio de importaciones y registrar el trabajo pendiente"""
+    os.makedirs(IMPORT_UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(IMPORT_UPLOAD_DIR, f'import_{uuid4().hex}.csv')
+    file_storage.save(file_path)
+    job = ImportJob(
+        filename=file_storage.filename,
+        file_path=file_path,
+        status='queued',
+        total_rows=count_csv_rows(file_path),
+        created_by_id=created_by_id
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+class ImportJobLost(Exception):
+    """Otro proceso tomó el trabajo (heartbeat vencido): este worker deja de importar"""
+
+def _saved_totals(job: ImportJob) -> Dict:
+    return {
+        'processed': job.processed or 0,
+        'imported': job.imported or 0,
+        'skipped': job.skipped or 0,
+        'skip_reasons': json.loads(job.skip_reasons) if job.skip_reasons else {},
+        'skipped_rows': json.loads(job.skipped_rows) if job.skipped_rows else []
+    }
+
+def _save_progress(job_id: int, owner: str, totals: Dict, **values):
+    """Guardar progreso y heartbeat en la transacción del bloque, solo si el trabajo sigue siendo nuestro"""
+    saved = db.session.execute(
+        update(ImportJob).where(ImportJob.id == job_id, ImportJob.owner == owner).values(
+            processed=totals['processed'],
+            imported=totals['imported'],
+            skipped=totals['skipped'],
+            skip_reasons=json.dumps(dict(totals['skip_reasons'])),
+            skipped_rows=json.dumps(totals['skipped_rows']),
+            heartbeat_at=datetime.utcnow(),
+            **values
+        ),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    if not saved:
+        raise ImportJobLost(f"La importación {job_id} fue tomada por otro proceso")
+
+def _claim_import_job(job_id: int) -> Optional[str]:
+    """Tomar un trabajo en cola o uno interrumpido (heartbeat vencido); devuelve el owner o None"""
+    now = datetime.utcnow()
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+    stale_before = now - timedelta(seconds=IMPORT_JOB_STALE_SECONDS)
+    claimed = db.session.execute(
+        update(ImportJob).where(
+            ImportJob.id == job_id,
+            db.or_(
+                ImportJob.status == 'queued',
+                db.and_(
+                    ImportJob.status == 'running',
+                    db.or_(ImportJob.heartbeat_at.is_(None), ImportJob.heartbeat_at < stale_before)
+                )
+            )
+        ).values(
+            status='running', owner=owner, heartbeat_at=now,
+            started_at=func.coalesce(ImportJob.started_at, now),
+            # Las expresiones del UPDATE ven el estado anterior: solo cuenta como reanudación si ya corría
+            resumed_count=func.coalesce(ImportJob.resumed_count, 0) + case((ImportJob.status == 'running', 1), else_=0)
+        ),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    db.session.commit()
+    return owner if claimed else None
+
+def _fail_import_job(job_id: int, owner: str, error: str):
+    db.session.execute(
+        update(ImportJob).where(ImportJob.id == job_id, ImportJob.owner == owner).values(
+            status='failed', last_error=error, finished_at=datetime.utcnow()
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+
+def run_import_job(job_id: int, chunk_size: int = IMPORT_CHUNK_SIZE) -> Optional[ImportJob]:
+    """Ejecutar (o reanudar) un trabajo de importación; el progreso se confirma junto con cada bloque"""
+    owner = _claim_import_job(job_id)
+    job = db.session.get(ImportJob, job_id)
+    if not job or owner is None:
+        return job
+    if job.resumed_count:
+        logger.info(f"Reanudando la importación {job_id} desde la fila {job.processed or 0}")
+
+    try:
+        # El archivo vive en el directorio de importaciones del servidor que recibió la subida
+        if not os.path.exists(job.file_path):
+            raise FileNotFoundError(f"Archivo de importación no disponible: {job.file_path}")
+        totals = import_leads_from_csv(
+            job.file_path, chunk_size, job.created_by_id,
+            on_chunk=lambda totals: _save_progress(job_id, owner, totals),
+            previous=_saved_totals(job)
+        )
+        _save_progress(job_id, owner, totals, status='completed', finished_at=datetime.utcnow())
+        db.session.commit()
+    except ImportJobLost as e:
+        logger.warning(str(e))
+        db.session.rollback()
+    except Exception as e:
+        logger.error(f"Error en la importación {job_id}: {e}")
+        db.session.rollback()
+        _fail_import_job(job_id, owner, str(e))
+
+    db.session.refresh(job)
+    if job.status == 'completed' and os.path.exists(job.file_path):
+        os.remove(job.file_path)
+    return job
+
+def resume_stale_import_jobs() -> int:
+    """Tarea programada: reanudar importaciones sin heartbeat (o nunca iniciadas) y fallar las que se repiten"""
+    stale_before = datetime.utcnow() - timedelta(seconds=IMPORT_JOB_STALE_SECONDS)
+    jobs = db.session.query(ImportJob.id, ImportJob.resumed_count).filter(
+        db.or_(
+            db.and_(ImportJob.status == 'queued', ImportJob.created_at < stale_before),
+            db.and_(
+                ImportJob.status == 'running',
+                db.or_(ImportJob.heartbeat_at.is_(None), ImportJob.heartbeat_at < stale_before)
+            )
+        )
+    ).order_by(ImportJob.id).all()
+    for job_id, resumed_count in jobs:
+        if (resumed_count or 0) >= IMPORT_JOB_MAX_RESUMES:
+            owner = _claim_import_job(job_id)
+            if owner:
+                logger.error(f"Importación {job_id} interrumpida {resumed_count + 1} veces; se marca como fallida")
+                _fail_import_job(job_id, owner, f"Interrumpida {resumed_count + 1} veces sin completarse")
+            continue
+        run_import_job(job_id)
+    return len(jobs)
+
+def start_import_in_background(app, job_id: int, **kwargs) -> threading.Thread:
+    """Ejecutar la importación en un hilo del proceso actual; la request responde de inmediato"""
+    def run():
+        with app.app_context():
+            try:
+                run_import_job(job_id, **kwargs)
+            finally:
+                db.session.remove()
+    thread = threading.Thread(target=run, name=f'lead-import-{job_id}', daemon=True)
+    thread.start()
+    return thread
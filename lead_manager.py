@@ -6,26 +6,75 @@ Sistema especializado para seguimiento de clientes potenciales y reenvío de men
 
 import os
 import logging
-from datetime import datetime, timedelta
+import time
+import socket
+from uuid import uuid4
+from datetime import datetime, timedelta, time as dt_time, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from typing import List, Dict, Optional, Tuple
-from twilio.rest import Client
 from twilio.base.exceptions import TwilioException
 import json
-import re
-from models import db, Lead, LeadStatus, LeadSource, Message, MessageTemplate, Campaign, CampaignResult, Interaction
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from models import db, Lead, LeadStatus, LeadSource, Message, MessageTemplate, Campaign, CampaignRun, CampaignResult, Interaction, create_interaction, find_lead_by_phone, normalize_phone
 from models import User # Added missing import for User
+from rollups import lead_rollup_rows, count_messages_since
+from counters import get_dashboard_counters, apply_deltas, messages_day_key
+from lead_scores import enqueue_leads
+from lead_activity import record_bulk_activity
+from dispatcher import OutboundDispatcher, build_twilio_client, outbound_message
+from outbox import enqueue_message
+from lead_import import import_leads_from_csv as import_csv_in_chunks
+from template_engine import compile_template, get_compiled, lead_variables
+from template_registry import TemplateVersionConflict, template_registry, store_template_version, template_message_columns
 
 logger = logging.getLogger(__name__)
 
+# Leads por bloque al ejecutar una campaña (un commit por bloque)
+CAMPAIGN_CHUNK_SIZE = int(os.getenv('CAMPAIGN_CHUNK_SIZE', 200))
+# Sin heartbeat durante este tiempo, una ejecución se considera interrumpida y se reanuda
+CAMPAIGN_RUN_STALE_SECONDS = int(os.getenv('CAMPAIGN_RUN_STALE_SECONDS', 600))
+# Una ejecución interrumpida más veces que esto se marca como fallida en lugar de reanudarse
+CAMPAIGN_RUN_MAX_RESUMES = int(os.getenv('CAMPAIGN_RUN_MAX_RESUMES', 3))
+# Campañas programadas que no se ejecutaron dentro de este margen se dan por perdidas
+CAMPAIGN_MISFIRE_GRACE_SECONDS = int(os.getenv('CAMPAIGN_MISFIRE_GRACE_SECONDS', 3600))
+
+# Recordatorios de seguimiento: ventana de envío (hora local), días hábiles y capacidad por hora
+FOLLOW_UP_WINDOW_START = os.getenv('FOLLOW_UP_WINDOW_START', '09:00')
+FOLLOW_UP_WINDOW_END = os.getenv('FOLLOW_UP_WINDOW_END', '18:00')
+FOLLOW_UP_WEEKDAYS = {int(day) for day in os.getenv('FOLLOW_UP_WEEKDAYS', '0,1,2,3,4').split(',') if day.strip()}
+FOLLOW_UP_TIMEZONE = os.getenv('FOLLOW_UP_TIMEZONE', 'America/Argentina/Buenos_Aires')
+FOLLOW_UP_PER_HOUR = int(os.getenv('FOLLOW_UP_PER_HOUR', 120))
+FOLLOW_UP_BATCH_SIZE = int(os.getenv('FOLLOW_UP_BATCH_SIZE', 20))
+FOLLOW_UP_STATUSES = [LeadStatus.CONTACTADO, LeadStatus.INTERESADO]
+
+def _follow_up_timezone():
+    try:
+        return ZoneInfo(FOLLOW_UP_TIMEZONE)
+    except ZoneInfoNotFoundError:
+        logger.warning(f"Zona horaria {FOLLOW_UP_TIMEZONE} no disponible, se usa UTC")
+        return timezone.utc
+
+def next_follow_up_slot(after: datetime) -> datetime:
+    """Primer instante >= after (UTC sin zona) dentro de la ventana de envío de un día hábil"""
+    tz = _follow_up_timezone()
+    start = dt_time.fromisoformat(FOLLOW_UP_WINDOW_START)
+    end = dt_time.fromisoformat(FOLLOW_UP_WINDOW_END)
+    local = after.replace(tzinfo=timezone.utc).astimezone(tz)
+    for _ in range(8):
+        if local.weekday() in FOLLOW_UP_WEEKDAYS and local.time() < end:
+            if local.time() < start:
+                local = local.replace(hour=start.hour, minute=start.minute, second=0, microsecond=0)
+            return local.astimezone(timezone.utc).replace(tzinfo=None)
+        local = (local + timedelta(days=1)).replace(hour=start.hour, minute=start.minute, second=0, microsecond=0)
+    raise ValueError("FOLLOW_UP_WEEKDAYS no contiene días válidos")
+
 class NexaLeadManager:
     def __init__(self, app=None):
         self.app = app
         self.twilio_client = None
-        self.scheduler = BackgroundScheduler()
+        self.dispatcher = None
         self.setup_twilio()
-        self.setup_scheduler()
         
     def setup_twilio(self):
         """Configurar cliente de Twilio"""
@@ -33,37 +82,18 @@ class NexaLeadManager:
             account_sid = os.getenv('TWILIO_ACCOUNT_SID')
             auth_token = os.getenv('TWILIO_AUTH_TOKEN')
             if account_sid and auth_token:
-                self.twilio_client = Client(account_sid, auth_token)
+                self.twilio_client = build_twilio_client(account_sid, auth_token)
                 self.whatsapp_from = os.getenv('WHATSAPP_FROM')
+                self.dispatcher = OutboundDispatcher(self.twilio_client, self.whatsapp_from)
                 logger.info("Twilio configurado correctamente")
             else:
                 logger.warning("Credenciales de Twilio no encontradas")
         except Exception as e:
             logger.error(f"Error configurando Twilio: {e}")
     
-    def setup_scheduler(self):
-        """Configurar programador de tareas"""
-        try:
-            self.scheduler.start()
-            # Programar tareas diarias
-            self.scheduler.add_job(
-                self.send_follow_up_reminders,
-                'cron',
-                hour=9,
-                minute=0,
-                id='follow_up_reminders'
-            )
-            self.scheduler.add_job(
-                self.send_weekly_summary,
-                'cron',
-                day_of_week='mon',
-                hour=8,
-                minute=0,
-                id='weekly_summary'
-            )
-            logger.info("Programador de tareas configurado")
-        except Exception as e:
-            logger.error(f"Error configurando programador: {e}")
+    def init_app(self, app):
+        """Asociar la aplicación Flask (las tareas programadas corren en scheduler.py)"""
+        self.app = app
     
     def create_lead_from_website(self, phone_number: str, name: str = None, 
                                 email: str = None, company: str = None, 
@@ -71,7 +101,7 @@ class NexaLeadManager:
         """Crear lead desde el sitio web de Nexa"""
         try:
             # Verificar si el lead ya existe
-            existing_lead = Lead.query.filter_by(phone_number=phone_number).first()
+            existing_lead = find_lead_by_phone(phone_number)
             if existing_lead:
                 logger.info(f"Lead existente encontrado: {phone_number}")
                 return existing_lead
@@ -104,10 +134,7 @@ class NexaLeadManager:
     def send_welcome_message(self, lead: Lead) -> bool:
         """Enviar mensaje de bienvenida a un nuevo lead"""
         try:
-            template = MessageTemplate.query.filter_by(
-                category='welcome',
-                is_active=True
-            ).first()
+            template = template_registry.get_by_category('welcome')
             
             if not template:
                 # Plantilla por defecto
@@ -122,22 +149,22 @@ Somos especialistas en construcción y desarrollo inmobiliario con más de 10 a
 
 Saludos,
 Equipo Nexa Constructora"""
+                # Se encola en el outbox; lo envía el proceso outbox-worker
+                enqueue_message(lead.id, message_content)
             else:
-                message_content = self.format_template(template.content, lead)
-            
-            return self.send_whatsapp_message(lead.phone_number, message_content, lead.id)
+                enqueue_message(lead.id, template=template, values=lead_variables(lead))
+            db.session.commit()
+            return True
             
         except Exception as e:
             logger.error(f"Error enviando mensaje de bienvenida: {e}")
+            db.session.rollback()
             return False
     
     def send_follow_up_message(self, lead: Lead, template_category: str = 'follow_up') -> bool:
         """Enviar mensaje de seguimiento"""
         try:
-            template = MessageTemplate.query.filter_by(
-                category=template_category,
-                is_active=True
-            ).first()
+            template = template_registry.get_by_category(template_category)
             
             if not template:
                 # Plantilla por defecto de seguimiento
@@ -151,30 +178,29 @@ Estamos disponibles para una consulta gratuita.
 
 Saludos,
 Equipo Nexa Constructora"""
+                enqueue_message(lead.id, message_content)
             else:
-                message_content = self.format_template(template.content, lead)
+                enqueue_message(lead.id, template=template, values=lead_variables(lead))
             
-            success = self.send_whatsapp_message(lead.phone_number, message_content, lead.id)
+            # El mensaje encolado y el estado del lead se confirman en la misma transacción
+            lead.status = LeadStatus.CONTACTADO
+            lead.last_contact_date = datetime.utcnow()
+            lead.next_follow_up = datetime.utcnow() + timedelta(days=3)
+            db.session.commit()
             
-            if success:
-                # Actualizar estado del lead
-                lead.status = LeadStatus.CONTACTADO
-                lead.last_contact_date = datetime.utcnow()
-                lead.next_follow_up = datetime.utcnow() + timedelta(days=3)
-                db.session.commit()
-                
-                # Crear interacción
-                create_interaction(
-                    lead.id,
-                    'whatsapp_follow_up',
-                    f'Mensaje de seguimiento enviado: {template_category}',
-                    'sent'
-                )
+            # Crear interacción
+            create_interaction(
+                lead.id,
+                'whatsapp_follow_up',
+                f'Mensaje de seguimiento enviado: {template_category}',
+                'sent'
+            )
             
-            return success
+            return True
             
         except Exception as e:
             logger.error(f"Error enviando mensaje de seguimiento: {e}")
+            db.session.rollback()
             return False
     
     def send_whatsapp_message(self, to_number: str, message_content: str, 
@@ -218,7 +244,7 @@ Equipo Nexa Constructora"""
     
     def send_bulk_whatsapp(self, leads: List[Lead], template_name: str, 
                            variables: dict = None, scheduled_time: datetime = None) -> Dict:
-        """Enviar mensajes masivos de WhatsApp"""
+        """Enviar mensajes masivos de WhatsApp (envío concurrente y una única escritura al final)"""
         results = {
             'total': len(leads),
             'sent': 0,
@@ -226,68 +252,58 @@ Equipo Nexa Constructora"""
             'errors': []
         }
         
-        for lead in leads:
-            try:
-                # Personalizar mensaje para cada lead
-                lead_variables = {
-                    'name': lead.name or 'Cliente',
-                    'company': lead.company or 'Empresa',
-                    'phone': lead.phone_number,
-                    'email': lead.email or 'No especificado'
-                }
-                
-                if variables:
-                    lead_variables.update(variables)
-                
-                # Obtener plantilla
-                template = MessageTemplate.query.filter_by(name=template_name, is_active=True).first()
-                if not template:
-                    results['errors'].append(f"Plantilla '{template_name}' no encontrada para {lead.name}")
-                    results['failed'] += 1
-                    continue
-                
-                # Enviar mensaje
-                success = self.send_whatsapp_message(
-                    lead.phone_number,
-                    template.content,
-                    template_name,
-                    lead_variables
-                )
-                
-                if success:
-                    results['sent'] += 1
-                    
-                    # Crear registro de mensaje
-                    message = Message(
-                        lead_id=lead.id,
-                        content=template.content,
-                        message_type='outbound',
-                        status='sent',
-                        sent_at=datetime.utcnow()
-                    )
-                    db.session.add(message)
-                    
-                    # Crear interacción
-                    interaction = Interaction(
-                        lead_id=lead.id,
-                        interaction_type='bulk_message_sent',
-                        description=f'Mensaje masivo enviado: {template_name}',
-                        outcome='completed'
-                    )
-                    db.session.add(interaction)
-                    
-                    # Actualizar fecha de último contacto
-                    lead.last_contact_date = datetime.utcnow()
-                    
-                else:
-                    results['failed'] += 1
-                    results['errors'].append(f"Error enviando a {lead.name}")
-                    
-            except Exception as e:
-                results['failed'] += 1
-                results['errors'].append(f"Error procesando {lead.name}: {str(e)}")
+        template = template_registry.get_by_name(template_name)
+        if not template:
+            results['failed'] = len(leads)
+            results['errors'] = [f"Plantilla '{template_name}' no encontrada para {lead.name}" for lead in leads]
+            return results
         
+        if not self.dispatcher:
+            logger.warning("Twilio no configurado")
+            results['failed'] = len(leads)
+            results['errors'] = [f"Error enviando a {lead.name}" for lead in leads]
+            return results
+        
+        # La versión se guarda antes de enviar: si choca con otro texto guardado no se envía nada
         try:
+            store_template_version(template)
+            db.session.commit()
+        except TemplateVersionConflict as e:
+            db.session.rollback()
+            logger.error(f"Envío masivo cancelado: {e}")
+            results['failed'] = len(leads)
+            results['errors'] = [str(e)]
+            return results
+        
+        # Plantilla compilada una vez y completada para todos los leads en una pasada
+        values = [dict({
+            'name': lead.name or 'Cliente',
+            'company': lead.company or 'Empresa',
+            'phone': lead.phone_number,
+            'email': lead.email or 'No especificado'
+        }, **(variables or {})) for lead in leads]
+        bodies = get_compiled(template).render_many(values)
+        outbound = [
+            outbound_message(
+                lead.id, lead.phone_e164 or self._format_phone_number(lead.phone_number), body, name=lead.name, values=lead_values
+            )
+            for lead, body, lead_values in zip(leads, bodies, values)
+        ]
+        
+        report = self.dispatcher.dispatch(outbound)
+        results['sent'] = report['sent']
+        results['failed'] = report['failed']
+        results['errors'] = [
+            f"Error enviando a {result['name']}: {result['error']}"
+            for result in report['results'] if result['error']
+        ]
+        
+        try:
+            self._save_dispatch_results(
+                report['results'],
+                'bulk_message_sent', f'Mensaje masivo enviado: {template_name}',
+                template=template
+            )
             db.session.commit()
         except Exception as e:
             logger.error(f"Error guardando resultados: {e}")
@@ -295,45 +311,70 @@ Equipo Nexa Constructora"""
         
         return results
     
-    def _format_phone_number(self, phone_number: str) -> str:
-        """Formatear número de teléfono para WhatsApp"""
-        # Remover caracteres no numéricos
-        cleaned = re.sub(r'[^\d+]', '', phone_number)
+    def _save_dispatch_results(self, dispatch_results: List[Dict], interaction_type: str,
+                               description: str, campaign_id: int = None, template=None) -> int:
+        """Insertar en bloque mensajes enviados, interacciones y resultados de campaña (sin commit)"""
+        # Con plantilla, cada resultado trae sus `values` y el mensaje guarda versión y variables, no el texto
+        sent = [result for result in dispatch_results if not result['error']]
+        if not sent:
+            return 0
+        now = datetime.utcnow()
+        if template is not None:
+            store_template_version(template)
         
-        # Agregar código de país si no está presente
-        if not cleaned.startswith('+'):
-            if cleaned.startswith('54'):  # Argentina
-                cleaned = '+' + cleaned
-            elif cleaned.startswith('0'):
-                cleaned = '+54' + cleaned[1:]  # Argentina
-            else:
-                cleaned = '+54' + cleaned  # Argentina por defecto
+        message_ids = dict(db.session.execute(
+            insert(Message).returning(Message.lead_id, Message.id),
+            [dict({
+                'lead_id': result['lead_id'],
+                'message_type': 'outbound',
+                'status': 'sent',
+                'sent_at': result['sent_at'],
+                'twilio_sid': result['sid'],
+                'created_at': now
+            }, **(
+                template_message_columns(template, result['values']) if template is not None
+                else {'content': result['body']}
+            )) for result in sent]
+        ).all())
+        db.session.execute(insert(Interaction), [{
+            'lead_id': result['lead_id'],
+            'interaction_type': interaction_type,
+            'description': description,
+            'outcome': 'completed',
+            'created_at': now
+        } for result in sent])
+        if campaign_id is not None:
+            db.session.execute(insert(CampaignResult), [{
+                'campaign_id': campaign_id,
+                'lead_id': result['lead_id'],
+                'message_id': message_ids[result['lead_id']],
+                'status': 'sent',
+                'sent_at': result['sent_at']
+            } for result in sent])
         
-        return cleaned
+        # Actualizar fecha de último contacto (UPDATE masivo por clave primaria)
+        db.session.execute(update(Lead), [
+            {'id': result['lead_id'], 'last_contact_date': result['sent_at']} for result in sent
+        ])
+        # Los INSERT masivos no pasan por el flush: contador diario, actividad por lead y cola de scores a mano
+        connection = db.session.connection()
+        lead_ids = [result['lead_id'] for result in sent]
+        apply_deltas(connection, {messages_day_key(now.date()): len(sent)})
+        record_bulk_activity(connection, lead_ids, messages=1, interactions=1)
+        enqueue_leads(connection, lead_ids)
+        return len(sent)
+    
+    def _format_phone_number(self, phone_number: str) -> str:
+        """Formatear número de teléfono para WhatsApp (E.164, ver normalize_phone)"""
+        return normalize_phone(phone_number) or phone_number
     
     def _process_message_variables(self, message: str, variables: dict) -> str:
         """Procesar variables en el mensaje"""
-        for key, value in variables.items():
-            placeholder = f"{{{key}}}"
-            message = message.replace(placeholder, str(value))
-        return message
+        return compile_template(message).render(variables)
     
     def format_template(self, template_content: str, lead: Lead) -> str:
         """Formatear plantilla con datos del lead"""
-        replacements = {
-            '{name}': lead.name or 'estimado cliente',
-            '{company}': lead.company or 'tu empresa',
-            '{phone}': lead.phone_number,
-            '{email}': lead.email or 'tu email',
-            '{date}': datetime.now().strftime('%d/%m/%Y'),
-            '{website}': 'https://nexaconstructora.com.ar'
-        }
-        
-        formatted_content = template_content
-        for placeholder, value in replacements.items():
-            formatted_content = formatted_content.replace(placeholder, str(value))
-        
-        return formatted_content
+        return compile_template(template_content).render(lead_variables(lead))
     
     def get_leads_needing_follow_up(self) -> List[Lead]:
         """Obtener leads que necesitan seguimiento"""
@@ -343,72 +384,123 @@ Equipo Nexa Constructora"""
             Lead.status.in_([LeadStatus.NUEVO, LeadStatus.CONTACTADO, LeadStatus.INTERESADO])
         ).all()
     
-    def send_follow_up_reminders(self):
-        """Enviar recordatorios de seguimiento automáticos"""
-        try:
-            # Obtener leads que necesitan seguimiento
-            today = datetime.utcnow()
-            leads_needing_follow_up = Lead.query.filter(
-                Lead.next_follow_up <= today,
-                Lead.status.in_([LeadStatus.CONTACTADO, LeadStatus.INTERESADO])
-            ).all()
-            
-            if not leads_needing_follow_up:
-                logger.info("No hay leads que necesiten seguimiento")
-                return
-            
-            # Obtener plantilla de seguimiento
-            template = MessageTemplate.query.filter_by(
-                category='follow_up', 
-                is_active=True
-            ).first()
-            
-            if not template:
-                logger.warning("Plantilla de seguimiento no encontrada")
-                return
-            
-            # Enviar recordatorios
-            for lead in leads_needing_follow_up:
-                try:
-                    variables = {
-                        'name': lead.name or 'Cliente',
-                        'company': lead.company or 'Empresa',
-                        'days_since_contact': lead.days_since_contact() or 0
-                    }
-                    
-                    success = self.send_whatsapp_message(
-                        lead.phone_number,
-                        template.content,
-                        'follow_up',
-                        variables
-                    )
-                    
-                    if success:
-                        # Crear interacción
-                        interaction = Interaction(
-                            lead_id=lead.id,
-                            interaction_type='follow_up_reminder',
-                            description='Recordatorio de seguimiento enviado automáticamente',
-                            outcome='completed'
-                        )
-                        db.session.add(interaction)
-                        
-                        # Actualizar fecha de último contacto
-                        lead.last_contact_date = datetime.utcnow()
-                        
-                        # Programar próximo seguimiento (7 días)
-                        lead.next_follow_up = today + timedelta(days=7)
-                        
-                        logger.info(f"Recordatorio enviado a {lead.name}")
-                    
-                except Exception as e:
-                    logger.error(f"Error enviando recordatorio a {lead.name}: {e}")
-            
+    def plan_follow_up_slots(self, chunk_size: int = 500) -> int:
+        """Asignar a cada lead vencido un turno dentro de la ventana de envío, a ritmo FOLLOW_UP_PER_HOUR"""
+        now = datetime.utcnow()
+        interval = timedelta(seconds=3600 / max(1, FOLLOW_UP_PER_HOUR))
+        
+        # Continuar después del último turno ya asignado para no superar la capacidad
+        last_slot = db.session.query(db.func.max(Lead.follow_up_slot_at)).filter(
+            Lead.follow_up_slot_at.isnot(None)
+        ).scalar()
+        cursor = max(now, last_slot + interval) if last_slot else now
+        
+        planned = 0
+        last_lead_id = 0
+        while True:
+            leads = db.session.query(Lead.id).filter(
+                Lead.next_follow_up <= now,
+                Lead.status.in_(FOLLOW_UP_STATUSES),
+                Lead.follow_up_slot_at.is_(None),
+                Lead.id > last_lead_id
+            ).order_by(Lead.id).limit(chunk_size).all()
+            if not leads:
+                break
+            
+            slots = []
+            for lead in leads:
+                cursor = next_follow_up_slot(cursor)
+                slots.append({'id': lead.id, 'follow_up_slot_at': cursor})
+                cursor += interval
+            db.session.execute(update(Lead), slots)
             db.session.commit()
-            logger.info(f"Recordatorios enviados: {len(leads_needing_follow_up)} leads")
-            
-        except Exception as e:
-            logger.error(f"Error en recordatorios automáticos: {e}")
+            planned += len(slots)
+            last_lead_id = leads[-1].id
+        
+        if planned:
+            logger.info(f"Recordatorios planificados: {planned} leads hasta {cursor - interval:%Y-%m-%d %H:%M} UTC")
+        return planned
+    
+    def send_follow_up_reminders(self, batch_size: int = FOLLOW_UP_BATCH_SIZE) -> int:
+        """Encolar los recordatorios cuyo turno llegó, en lotes pequeños con un commit por lote"""
+        template = template_registry.get_by_category('follow_up')
+        
+        if not template:
+            logger.warning("Plantilla de seguimiento no encontrada")
+            return 0
+        sent = 0
+        # Leads que fallaron en esta ejecución: no se vuelven a leer para que el bucle avance
+        skipped = set()
+        while True:
+            now = datetime.utcnow()
+            leads = Lead.query.filter(
+                Lead.follow_up_slot_at <= now,
+                Lead.id.notin_(skipped)
+            ).order_by(Lead.follow_up_slot_at).limit(batch_size).all()
+            if not leads:
+                break
+            
+            lead_ids = [lead.id for lead in leads]
+            try:
+                sent += self._enqueue_follow_ups(leads, template, now)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Error en lote de recordatorios, se reintenta lead por lead: {e}")
+                db.session.rollback()
+                sent += self._enqueue_follow_ups_one_by_one(lead_ids, template, now, skipped)
+        
+        if sent:
+            logger.info(f"Recordatorios encolados: {sent} leads")
+        if skipped:
+            logger.warning(f"Recordatorios con error: {len(skipped)} leads se replanifican más adelante")
+        return sent
+    
+    def _enqueue_follow_ups(self, leads: List[Lead], template, now: datetime) -> int:
+        """Encolar el recordatorio de cada lead y liberar su turno (sin commit)"""
+        sent = 0
+        for lead in leads:
+            lead.follow_up_slot_at = None
+            # El lead pudo cambiar de estado o de fecha después de planificarse
+            if lead.status not in FOLLOW_UP_STATUSES or not lead.next_follow_up or lead.next_follow_up > now:
+                continue
+            
+            variables = {
+                'name': lead.name or 'Cliente',
+                'company': lead.company or 'Empresa',
+                'days_since_contact': lead.days_since_contact() or 0
+            }
+            enqueue_message(lead.id, template=template, values=variables)
+            db.session.add(Interaction(
+                lead_id=lead.id,
+                interaction_type='follow_up_reminder',
+                description='Recordatorio de seguimiento enviado automáticamente',
+                outcome='completed'
+            ))
+            
+            # Actualizar fecha de último contacto y programar próximo seguimiento (7 días)
+            lead.last_contact_date = now
+            lead.next_follow_up = now + timedelta(days=7)
+            sent += 1
+        return sent
+    
+    def _enqueue_follow_ups_one_by_one(self, lead_ids: List[int], template, now: datetime, skipped: set) -> int:
+        """Reintentar un lote fallido con un commit por lead; un lead con error no bloquea a los demás"""
+        sent = 0
+        for lead_id in lead_ids:
+            try:
+                sent += self._enqueue_follow_ups([db.session.get(Lead, lead_id)], template, now)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Error encolando el recordatorio del lead {lead_id}: {e}")
+                db.session.rollback()
+                skipped.add(lead_id)
+                # Se libera el turno: plan_follow_up_slots le asigna uno nuevo en la próxima pasada
+                try:
+                    db.session.execute(update(Lead).where(Lead.id == lead_id).values(follow_up_slot_at=None))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+        return sent
     
     def send_weekly_summary(self):
         """Enviar resumen semanal de leads"""
@@ -416,11 +508,8 @@ Equipo Nexa Constructora"""
             # Obtener estadísticas de la semana
             week_ago = datetime.utcnow() - timedelta(days=7)
             
-            new_leads = Lead.query.filter(Lead.created_at >= week_ago).count()
-            converted_leads = Lead.query.filter(
-                Lead.status == LeadStatus.CONVERTIDO,
-                Lead.updated_at >= week_ago
-            ).count()
+            new_leads = sum(row[-1] for row in lead_rollup_rows(week_ago.date()))
+            converted_leads = get_dashboard_counters()['weekly_conversions']
             
             # Enviar resumen a administradores
             admin_users = User.query.filter_by(role='admin', is_active=True).all()
@@ -435,17 +524,20 @@ Equipo Nexa Constructora"""
 ¡Excelente trabajo equipo! 🚀
             """.strip()
             
+            # Por el outbox, con sus reintentos y su claim por proceso, como el resto de los envíos
+            queued = 0
             for admin in admin_users:
-                if admin.phone_number:
-                    self.send_whatsapp_message(
-                        admin.phone_number,
-                        summary_message
-                    )
+                to_number = admin.phone_e164 or normalize_phone(admin.phone_number)
+                if to_number:
+                    enqueue_message(None, summary_message, to_number=to_number)
+                    queued += 1
+            db.session.commit()
             
-            logger.info("Resumen semanal enviado")
+            logger.info(f"Resumen semanal encolado para {queued} administradores")
             
         except Exception as e:
             logger.error(f"Error enviando resumen semanal: {e}")
+            db.session.rollback()
     
     def create_campaign(self, name: str, template_id: int, target_status: LeadStatus = None,
                        target_source: LeadSource = None, scheduled_date: datetime = None) -> Campaign:
@@ -459,18 +551,10 @@ Equipo Nexa Constructora"""
                 scheduled_date=scheduled_date
             )
             
+            # Si tiene fecha programada, la ejecuta run_due_campaigns en el scheduler líder
             db.session.add(campaign)
             db.session.commit()
             
-            # Programar campaña si tiene fecha programada
-            if scheduled_date:
-                self.scheduler.add_job(
-                    self.execute_campaign,
-                    DateTrigger(run_date=scheduled_date),
-                    args=[campaign.id],
-                    id=f'campaign_{campaign.id}'
-                )
-            
             logger.info(f"Campaña creada: {name}")
             return campaign
             
@@ -479,75 +563,283 @@ Equipo Nexa Constructora"""
             db.session.rollback()
             return None
     
-    def execute_campaign(self, campaign_id: int):
-        """Ejecutar una campaña"""
+    def _claim_campaign_run(self, campaign_id: int) -> Optional[CampaignRun]:
+        """Crear la ejecución de la campaña o tomar una interrumpida (lease con heartbeat vencido)"""
+        now = datetime.utcnow()
+        owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        
+        run = CampaignRun.query.filter_by(campaign_id=campaign_id, status='running').first()
+        if run is None:
+            run = CampaignRun(
+                campaign_id=campaign_id, status='running', last_lead_id=0,
+                processed=0, sent=0, failed=0, resumed_count=0,
+                owner=owner, heartbeat_at=now, started_at=now
+            )
+            db.session.add(run)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Otro proceso creó la ejecución al mismo tiempo
+                db.session.rollback()
+                return None
+            return run
+        
+        claimed = db.session.execute(
+            update(CampaignRun).where(
+                CampaignRun.id == run.id,
+                CampaignRun.status == 'running',
+                db.or_(
+                    CampaignRun.heartbeat_at.is_(None),
+                    CampaignRun.heartbeat_at < now - timedelta(seconds=CAMPAIGN_RUN_STALE_SECONDS)
+                )
+            ).values(owner=owner, heartbeat_at=now, resumed_count=CampaignRun.resumed_count + 1),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            logger.info(f"La campaña {campaign_id} ya se está ejecutando en otro proceso")
+            return None
+        
+        db.session.refresh(run)
+        if run.resumed_count > CAMPAIGN_RUN_MAX_RESUMES:
+            # Una ejecución que se cae siempre en el mismo punto no se reintenta para siempre
+            error = f"Interrumpida {run.resumed_count} veces sin completarse"
+            if run.last_error:
+                error = f"{error}: {run.last_error}"
+            logger.error(f"Campaña {campaign_id}: {error}; la ejecución {run.id} se marca como fallida")
+            db.session.execute(
+                update(CampaignRun).where(CampaignRun.id == run.id, CampaignRun.owner == owner).values(
+                    status='failed', last_error=error, finished_at=datetime.utcnow()
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+            return None
+        logger.info(f"Reanudando campaña {campaign_id} desde el lead {run.last_lead_id} (ejecución {run.id})")
+        return run
+    
+    def _renew_campaign_lease(self, run_id: int, owner: str) -> bool:
+        """Renovar el heartbeat antes de enviar un bloque; False si otro proceso tomó la ejecución"""
+        renewed = db.session.execute(
+            update(CampaignRun).where(
+                CampaignRun.id == run_id,
+                CampaignRun.owner == owner,
+                CampaignRun.status == 'running'
+            ).values(heartbeat_at=datetime.utcnow()),
+            execution_options={'synchronize_session': False}
+        ).rowcount == 1
+        db.session.commit()
+        return renewed
+    
+    def _checkpoint_campaign_run(self, run_id: int, owner: str, last_lead_id: int, processed: int,
+                                 sent: int, failed: int) -> bool:
+        """Avanzar el cursor de la ejecución en la transacción del bloque; False si se perdió el lease"""
+        return db.session.execute(
+            update(CampaignRun).where(
+                CampaignRun.id == run_id,
+                CampaignRun.owner == owner
+            ).values(
+                last_lead_id=last_lead_id,
+                processed=CampaignRun.processed + processed,
+                sent=CampaignRun.sent + sent,
+                failed=CampaignRun.failed + failed,
+                heartbeat_at=datetime.utcnow()
+            ),
+            execution_options={'synchronize_session': False}
+        ).rowcount == 1
+    
+    def execute_campaign(self, campaign_id: int, chunk_size: int = CAMPAIGN_CHUNK_SIZE) -> Optional[Dict]:
+        """Ejecutar (o reanudar) una campaña por bloques de leads con checkpoint por bloque"""
+        run = None
         try:
             campaign = Campaign.query.get(campaign_id)
             if not campaign or not campaign.is_active:
-                return
+                return None
             
-            # Obtener leads objetivo
-            query = Lead.query
-            if campaign.target_status:
-                query = query.filter_by(status=campaign.target_status)
-            if campaign.target_source:
-                query = query.filter_by(source=campaign.target_source)
+            template = template_registry.get(campaign.template_id)
+            if not template:
+                logger.warning(f"Plantilla {campaign.template_id} no encontrada para la campaña {campaign_id}")
+                return None
+            if not self.dispatcher:
+                logger.warning("Twilio no configurado")
+                return None
             
-            leads = query.all()
+            # La versión se guarda antes de enviar: si choca con otro texto guardado la campaña no arranca
+            store_template_version(template)
+            db.session.commit()
             
-            logger.info(f"Ejecutando campaña '{campaign.name}' para {len(leads)} leads")
+            run = self._claim_campaign_run(campaign.id)
+            if run is None:
+                return None
+            # Copia local: tras cada commit `run` se recarga y mostraría al dueño actual, no al de este worker
+            run_id, owner = run.id, run.owner
+            compiled = get_compiled(template)
             
-            for lead in leads:
-                try:
-                    template = MessageTemplate.query.get(campaign.template_id)
-                    if template:
-                        message_content = self.format_template(template.content, lead)
-                        success = self.send_whatsapp_message(lead.phone_number, message_content, lead.id)
-                        
-                        if success:
-                            # Crear resultado de campaña
-                            message = Message.query.filter_by(lead_id=lead.id).order_by(Message.created_at.desc()).first()
-                            if message:
-                                create_campaign_result(campaign.id, lead.id, message.id)
+            # Leads objetivo: solo las columnas que usa la plantilla
+            query = db.session.query(Lead.id, Lead.phone_number, Lead.phone_e164, Lead.name, Lead.company, Lead.email)
+            if campaign.target_status:
+                query = query.filter(Lead.status == campaign.target_status)
+            if campaign.target_source:
+                query = query.filter(Lead.source == campaign.target_source)
+            
+            logger.info(f"Ejecutando campaña '{campaign.name}' en bloques de {chunk_size} leads (ejecución {run_id})")
+            budget = self.dispatcher.worst_case_seconds(chunk_size)
+            if budget > CAMPAIGN_RUN_STALE_SECONDS:
+                logger.warning(
+                    f"Campaña '{campaign.name}': un bloque de {chunk_size} puede tardar hasta {budget:.0f}s y el "
+                    f"lease vence a los {CAMPAIGN_RUN_STALE_SECONDS}s; bajar CAMPAIGN_CHUNK_SIZE o TWILIO_HTTP_TIMEOUT_SECONDS"
+                )
+            
+            totals = {'run_id': run_id, 'processed': 0, 'sent': 0, 'failed': 0, 'chunks': []}
+            last_lead_id = run.last_lead_id or 0
+            while True:
+                # Paginación por clave desde el checkpoint: lo ya confirmado no se vuelve a enviar
+                leads = query.filter(Lead.id > last_lead_id).order_by(Lead.id).limit(chunk_size).all()
+                if not leads:
+                    break
+                # Sin lease vigente otro proceso ya reanudó la ejecución: enviar el bloque lo duplicaría
+                if not self._renew_campaign_lease(run_id, owner):
+                    logger.warning(f"Ejecución {run_id} tomada por otro proceso; se detiene este worker sin enviar")
+                    return totals
+                
+                started = time.monotonic()
+                today = datetime.now().strftime('%d/%m/%Y')
+                values = [lead_variables(lead, today) for lead in leads]
+                report = self.dispatcher.dispatch(
+                    outbound_message(lead.id, lead.phone_e164 or self._format_phone_number(lead.phone_number), body, values=lead_values)
+                    for lead, body, lead_values in zip(leads, compiled.render_many(values), values)
+                )
+                sent_at = time.monotonic()
+                self._save_dispatch_results(
+                    report['results'],
+                    'campaign_message_sent', f'Mensaje de campaña enviado: {campaign.name}',
+                    campaign_id=campaign.id, template=template
+                )
+                # Resultados y checkpoint se confirman juntos
+                still_owner = self._checkpoint_campaign_run(
+                    run_id, owner, leads[-1].id, len(leads), report['sent'], report['failed']
+                )
+                db.session.commit()
+                saved_at = time.monotonic()
+                
+                for result in report['results']:
+                    if result['error']:
+                        logger.error(f"Error procesando lead {result['lead_id']} en campaña: {result['error']}")
+                
+                chunk = {
+                    'leads': len(leads),
+                    'sent': report['sent'],
+                    'failed': report['failed'],
+                    'send_seconds': round(sent_at - started, 3),
+                    'db_seconds': round(saved_at - sent_at, 3),
+                    'db_ms_per_lead': round((saved_at - sent_at) * 1000 / len(leads), 2)
+                }
+                totals['chunks'].append(chunk)
+                totals['processed'] += len(leads)
+                totals['sent'] += report['sent']
+                totals['failed'] += report['failed']
+                last_lead_id = leads[-1].id
+                logger.info(
+                    f"Campaña '{campaign.name}' bloque {len(totals['chunks'])}: {len(leads)} leads, "
+                    f"envío {chunk['send_seconds']}s, base de datos {chunk['db_seconds']}s "
+                    f"({chunk['db_ms_per_lead']} ms/lead)"
+                )
                 
-                except Exception as e:
-                    logger.error(f"Error procesando lead {lead.id} en campaña: {e}")
+                if not still_owner:
+                    logger.warning(f"Ejecución {run_id} tomada por otro proceso; se detiene este worker")
+                    return totals
+            
+            db.session.execute(
+                update(CampaignRun).where(CampaignRun.id == run_id, CampaignRun.owner == owner).values(
+                    status='completed', finished_at=datetime.utcnow(), heartbeat_at=datetime.utcnow()
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+            
+            logger.info(
+                f"Campaña '{campaign.name}': {totals['sent']} enviados, {totals['failed']} fallidos "
+                f"en {len(totals['chunks'])} bloques"
+            )
+            return totals
                     
         except Exception as e:
             logger.error(f"Error ejecutando campaña {campaign_id}: {e}")
+            db.session.rollback()
+            if run is not None:
+                # La ejecución queda en 'running': se reanuda desde el último checkpoint
+                try:
+                    CampaignRun.query.filter_by(id=run.id).update({'last_error': str(e)})
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+            return None
     
-    def get_lead_analytics(self, days: int = 30) -> Dict:
-        """Obtener análisis de leads"""
+    def run_due_campaigns(self):
+        """Tarea programada: ejecutar las campañas cuya fecha programada llegó y que nunca se ejecutaron"""
+        now = datetime.utcnow()
+        due = Campaign.query.filter(
+            Campaign.is_active == True,
+            Campaign.scheduled_date <= now,
+            Campaign.scheduled_date >= now - timedelta(seconds=CAMPAIGN_MISFIRE_GRACE_SECONDS),
+            ~Campaign.runs.any()
+        ).order_by(Campaign.scheduled_date).all()
+        for campaign in due:
+            self.execute_campaign(campaign.id)
+    
+    def resume_interrupted_campaigns(self):
+        """Tarea programada: reanudar ejecuciones cuyo proceso dejó de enviar heartbeat"""
+        stale_before = datetime.utcnow() - timedelta(seconds=CAMPAIGN_RUN_STALE_SECONDS)
+        runs = CampaignRun.query.filter(
+            CampaignRun.status == 'running',
+            db.or_(CampaignRun.heartbeat_at.is_(None), CampaignRun.heartbeat_at < stale_before)
+        ).all()
+        for run in runs:
+            self.execute_campaign(run.campaign_id)
+    
+    def get_lead_analytics(self, days: int = 30, bucket: str = None) -> Dict:
+        """Obtener análisis de leads creados en los últimos N días (desde los rollups diarios)"""
         try:
-            start_date = datetime.utcnow() - timedelta(days=days)
+            start_day = (datetime.utcnow() - timedelta(days=days)).date()
+            bucket = bucket or ('day' if days <= 90 else 'week')
             
-            # Obtener todos los leads (sin filtro de fecha por ahora)
-            all_leads = Lead.query.all()
-            
-            # Leads por estado
             status_counts = {}
-            for lead in all_leads:
-                status = lead.status.value if hasattr(lead.status, 'value') else str(lead.status)
-                status_counts[status] = status_counts.get(status, 0) + 1
-            
-            # Leads por fuente
-            source_counts = {}
-            for lead in all_leads:
-                source = lead.source.value if hasattr(lead.source, 'value') else str(lead.source)
-                source_counts[source] = source_counts.get(source, 0) + 1
+            source_performance = {}
+            series_values = {}
+            for day, status, source, _assigned_to_id, count in lead_rollup_rows(start_day):
+                status = self._enum_value(status)
+                source = self._enum_value(source)
+                is_conversion = status == LeadStatus.CONVERTIDO.value
+                
+                # Leads por estado
+                status_counts[status] = status_counts.get(status, 0) + count
+                
+                # Leads y conversiones por fuente
+                performance = source_performance.setdefault(source, {'total': 0, 'conversions': 0})
+                performance['total'] += count
+                performance['conversions'] += count if is_conversion else 0
+                
+                # Serie temporal de leads y conversiones
+                period = (day - timedelta(days=day.weekday()) if bucket == 'week' else day).isoformat()
+                leads, conversions = series_values.get(period, (0, 0))
+                series_values[period] = (leads + count, conversions + (count if is_conversion else 0))
             
-            # Conversiones
-            conversions = sum(1 for lead in all_leads if lead.status == LeadStatus.CONVERTIDO)
+            for performance in source_performance.values():
+                performance['conversion_rate'] = performance['conversions'] / performance['total'] * 100
             
-            # Total de leads
-            total_leads = len(all_leads)
+            total_leads = sum(status_counts.values())
+            conversions = status_counts.get(LeadStatus.CONVERTIDO.value, 0)
             
             return {
                 'status_distribution': status_counts,
-                'source_distribution': source_counts,
+                'source_distribution': {source: item['total'] for source, item in source_performance.items()},
+                'source_performance': source_performance,
                 'conversion_rate': (conversions / total_leads * 100) if total_leads > 0 else 0,
                 'total_leads': total_leads,
-                'conversions': conversions
+                'conversions': conversions,
+                'messages_sent': count_messages_since(start_day),
+                'period': {'days': days, 'start': start_day.isoformat(), 'bucket': bucket},
+                'series': self._fill_series(series_values, start_day, bucket)
             }
             
         except Exception as e:
@@ -555,56 +847,39 @@ Equipo Nexa Constructora"""
             return {
                 'status_distribution': {},
                 'source_distribution': {},
+                'source_performance': {},
                 'conversion_rate': 0,
                 'total_leads': 0,
-                'conversions': 0
+                'conversions': 0,
+                'messages_sent': 0,
+                'series': []
             }
     
-    def import_leads_from_csv(self, csv_file_path: str) -> Tuple[int, int]:
-        """Importar leads desde archivo CSV usando Python nativo"""
-        import csv
+    @staticmethod
+    def _enum_value(value) -> str:
+        return value.value if hasattr(value, 'value') else str(value)
+    
+    @staticmethod
+    def _fill_series(values: Dict, start_day, bucket: str) -> List[Dict]:
+        """Completar con ceros los períodos sin datos"""
+        step = timedelta(days=7 if bucket == 'week' else 1)
+        current = start_day
+        if bucket == 'week':
+            current -= timedelta(days=current.weekday())
+        today = datetime.utcnow().date()
         
+        series = []
+        while current <= today:
+            leads, conversions = values.get(current.isoformat(), (0, 0))
+            series.append({'period': current.isoformat(), 'leads': leads, 'conversions': conversions})
+            current += step
+        return series
+    
+    def import_leads_from_csv(self, csv_file_path: str) -> Tuple[int, int]:
+        """Importar leads desde archivo CSV (en streaming y por bloques, ver lead_import.py)"""
         try:
-            imported = 0
-            skipped = 0
-            
-            with open(csv_file_path, 'r', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                
-                for row in reader:
-                    try:
-                        # Verificar si el lead ya existe
-                        phone_number = str(row.get('phone_number', '')).strip()
-                        if not phone_number:
-                            skipped += 1
-                            continue
-                            
-                        existing = Lead.query.filter_by(phone_number=phone_number).first()
-                        if existing:
-                            skipped += 1
-                            continue
-                        
-                        lead = Lead(
-                            phone_number=phone_number,
-                            name=row.get('name', '').strip(),
-                            email=row.get('email', '').strip(),
-                            company=row.get('company', '').strip(),
-                            source=LeadSource.WEBSITE,
-                            status=LeadStatus.NUEVO,
-                            notes=row.get('notes', 'Importado desde CSV')
-                        )
-                        
-                        db.session.add(lead)
-                        imported += 1
-                        
-                    except Exception as e:
-                        logger.error(f"Error importando fila: {e}")
-                        skipped += 1
-            
-            db.session.commit()
-            logger.info(f"Importación completada: {imported} importados, {skipped} omitidos")
-            return imported, skipped
-            
+            totals = import_csv_in_chunks(csv_file_path)
+            return totals['imported'], totals['skipped']
         except Exception as e:
             logger.error(f"Error importando CSV: {e}")
             db.session.rollback()
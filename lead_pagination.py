@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Paginación por keyset de leads para Nexa Lead Manager
+Recorre los índices (created_at, id) o (conversion_score, id) hacia atrás con un cursor opaco
+en lugar de OFFSET, de modo que cada página cuesta lo mismo sin importar su posición
+"""
+
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+from models import db, Lead
+
+# Orden de /api/leads: columna de la clave del cursor (junto con id) y su conversión desde texto
+LEAD_ORDERINGS = {
+    'created_at': (Lead.created_at, datetime.fromisoformat),
+    'score': (Lead.conversion_score, float)
+}
+
+def encode_cursor(lead, order_by: str = 'created_at') -> str:
+    """Cursor opaco con la posición (clave de orden, id) del último lead devuelto"""
+    value = getattr(lead, LEAD_ORDERINGS[order_by][0].key)
+    raw = f"{value.isoformat() if order_by == 'created_at' else value},{lead.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str, order_by: str = 'created_at') -> Tuple:
+    """Decodificar un cursor opaco (o el formato plano 'clave,id'); ValueError si no es válido"""
+    if ',' not in cursor:
+        cursor = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    value, lead_id = cursor.rsplit(',', 1)
+    return LEAD_ORDERINGS[order_by][1](value), int(lead_id)
+
+def keyset_query(query, order_by: str = 'created_at'):
+    """Limitar el query a los leads que el keyset puede recorrer"""
+    if order_by == 'score':
+        # El keyset no admite NULL: los leads aún sin puntuar aparecen cuando la cola los procesa
+        query = query.filter(Lead.conversion_score.isnot(None))
+    return query
+
+def keyset_page(query, after: Optional[str], per_page: int,
+                order_by: str = 'created_at') -> Tuple[List[Lead], Optional[str], bool]:
+    """Página siguiente al cursor `after` (vacío para la primera): (leads, next_cursor, has_more)"""
+    key_column = LEAD_ORDERINGS[order_by][0]
+    if after:
+        cursor_value, cursor_id = decode_cursor(after, order_by)
+        query = query.filter(db.tuple_(key_column, Lead.id) < (cursor_value, cursor_id))
+
+    rows = query.order_by(key_column.desc(), Lead.id.desc()).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    leads = rows[:per_page]
+    return leads, encode_cursor(leads[-1], order_by) if has_more else None, has_more
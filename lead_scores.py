@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Score de conversión persistido en Lead.conversion_score para Nexa Lead Manager
+Los cambios que afectan el score (interacciones, estado, interés, fecha de contacto...) encolan el lead
+en lead_score_queue dentro del mismo flush; un trabajo periódico recalcula solo los leads encolados
+y un barrido nocturno refresca los factores que decaen con el tiempo
+"""
+
+import os
+import logging
+from datetime import datetime
+from typing import Dict, Iterable
+import numpy as np
+from sqlalchemy import event, inspect, text, select, func, delete
+from models import db, Lead, Interaction, LeadScoreQueue
+from lead_scoring import score_leads, fetch_matrix
+
+logger = logging.getLogger(__name__)
+
+SCORE_BATCH_SIZE = int(os.getenv('SCORE_BATCH_SIZE', 1000))
+SCORE_SWEEP_CHUNK_SIZE = int(os.getenv('SCORE_SWEEP_CHUNK_SIZE', 10000))
+
+# Atributos de Lead que entran en el score (ver lead_scoring.load_scoring_inputs)
+SCORE_INPUT_ATTRS = ('source', 'status', 'interest_level', 'last_contact_date', 'company', 'email')
+
+# Reencolar actualiza queued_at: un lead que cambia mientras se recalcula no sale de la cola
+_ENQUEUE_SQL = text("""
+    INSERT INTO lead_score_queue (lead_id, queued_at) VALUES (:lead_id, :queued_at)
+    ON CONFLICT (lead_id) DO UPDATE SET queued_at = excluded.queued_at
+""")
+
+# SQL directo: guardar el score no es una edición del lead y no debe tocar updated_at
+_STORE_SCORE_SQL = text("UPDATE lead SET conversion_score = :score, scored_at = :scored_at WHERE id = :id")
+
+def enqueue_leads(connection, lead_ids: Iterable[int]):
+    """Marcar leads para recalcular su score (para escrituras masivas que no pasan por el flush)"""
+    now = datetime.utcnow()
+    params = [{'lead_id': lead_id, 'queued_at': now} for lead_id in set(lead_ids) if lead_id is not None]
+    if params:
+        connection.execute(_ENQUEUE_SQL, params)
+
+def _score_inputs_changed(obj) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in SCORE_INPUT_ATTRS)
+
+@event.listens_for(db.session, 'after_flush')
+def _enqueue_changed_leads(session, flush_context):
+    """Encolar los leads afectados por el flush (después del INSERT, cuando los leads nuevos ya tienen id)"""
+    lead_ids = set()
+    for obj in session.new:
+        if isinstance(obj, Lead):
+            lead_ids.add(obj.id)
+        elif isinstance(obj, Interaction):
+            lead_ids.add(obj.lead_id)
+    for obj in session.deleted:
+        if isinstance(obj, Interaction):
+            lead_ids.add(obj.lead_id)
+    for obj in session.dirty:
+        if isinstance(obj, Lead) and _score_inputs_changed(obj):
+            lead_ids.add(obj.id)
+    if lead_ids:
+        enqueue_leads(session.connection(), lead_ids)
+
+def _store_scores(lead_ids: np.ndarray, probabilities: np.ndarray, scored_at: datetime) -> int:
+    if len(lead_ids):
+        db.session.execute(_STORE_SCORE_SQL, [
+            {'id': lead_id, 'score': score, 'scored_at': scored_at}
+            for lead_id, score in zip(lead_ids.tolist(), probabilities.tolist())
+        ])
+    return len(lead_ids)
+
+def refresh_queued_scores(batch_size: int = SCORE_BATCH_SIZE) -> int:
+    """Recalcular el score de los leads encolados, un commit por bloque; devuelve los leads actualizados"""
+    updated = 0
+    while True:
+        claimed_at = datetime.utcnow()
+        lead_ids = [
+            lead_id for (lead_id,) in db.session.query(LeadScoreQueue.lead_id)
+            .order_by(LeadScoreQueue.queued_at).limit(batch_size)
+        ]
+        if not lead_ids:
+            break
+        scores = score_leads(lead_ids)
+        updated += _store_scores(scores['lead_ids'], scores['probabilities'], claimed_at)
+        # Los leads borrados no devuelven score y también salen de la cola
+        db.session.execute(delete(LeadScoreQueue).where(
+            LeadScoreQueue.lead_id.in_(lead_ids), LeadScoreQueue.queued_at <= claimed_at
+        ))
+        db.session.commit()
+        if len(lead_ids) < batch_size:
+            break
+    if updated:
+        logger.info(f"Scores de conversión recalculados: {updated} leads")
+    return updated
+
+def refresh_all_scores(chunk_size: int = SCORE_SWEEP_CHUNK_SIZE) -> Dict:
+    """Barrido completo: recalcula todos los leads y escribe solo los scores que cambiaron"""
+    started = datetime.utcnow()
+    scores = score_leads()
+    stored = fetch_matrix(
+        select(Lead.id, func.coalesce(Lead.conversion_score, -1.0), Lead.scored_at.is_(None)).order_by(Lead.id), 3
+    )
+    lead_ids, probabilities = scores['lead_ids'], scores['probabilities']
+    # Alinear por id los scores guardados con los recalculados (un lead nuevo entre ambas lecturas queda sin par)
+    positions = np.searchsorted(stored[:, 0], lead_ids).clip(max=max(len(stored) - 1, 0))
+    unchanged = np.zeros(len(lead_ids), dtype=bool)
+    if len(stored):
+        unchanged = (
+            (stored[positions, 0] == lead_ids)
+            & (stored[positions, 1] == probabilities)
+            & (stored[positions, 2] == 0)
+        )
+    changed = np.flatnonzero(~unchanged)
+
+    for start in range(0, len(changed), chunk_size):
+        chunk = changed[start:start + chunk_size]
+        _store_scores(lead_ids[chunk], probabilities[chunk], started)
+        db.session.commit()
+    # Lo encolado antes del barrido ya quedó cubierto por él
+    db.session.execute(delete(LeadScoreQueue).where(LeadScoreQueue.queued_at <= started))
+    db.session.commit()
+
+    totals = {'scored': int(len(lead_ids)), 'updated': int(len(changed))}
+    logger.info(f"Barrido de scores: {totals['updated']} de {totals['scored']} leads cambiaron")
+    return totals
+
+def ensure_lead_scores():
+    """Encolar los leads que nunca fueron puntuados (bases existentes o leads anteriores a la columna)"""
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            INSERT INTO lead_score_queue (lead_id, queued_at)
+            SELECT id, :now FROM lead WHERE scored_at IS NULL
+            ON CONFLICT (lead_id) DO NOTHING
+        """), {'now': datetime.utcnow()})
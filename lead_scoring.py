@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Scoring de conversión en lote para Nexa Lead Manager
+Lee en una sola consulta las columnas necesarias de todos los leads (con el conteo de interacciones
+desnormalizado en Lead.interaction_count, ver lead_activity.py) y calcula los seis factores de NexaAI.predict_lead_conversion como arrays de NumPy
+"""
+
+import time
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+import numpy as np
+from sqlalchemy import case, func, select, type_coerce
+from models import db, Lead, LeadSource, LeadStatus
+
+logger = logging.getLogger(__name__)
+
+# Puntajes por fuente del lead (los mismos que usa el scoring individual)
+SOURCE_SCORES = {
+    LeadSource.WEBSITE: 0.8,
+    LeadSource.WHATSAPP: 0.9,
+    LeadSource.REFERIDO: 0.95,
+    LeadSource.REDES_SOCIALES: 0.7,
+    LeadSource.EVENTO: 0.85,
+    LeadSource.OTRO: 0.6
+}
+DEFAULT_SOURCE_SCORE = 0.6
+
+# Siguiente mejor acción por probabilidad mínima de conversión, de mayor a menor
+NEXT_BEST_ACTIONS = (
+    (80, "Solicitar cierre de venta"),
+    (60, "Agendar cita de presentación"),
+    (40, "Enviar propuesta personalizada"),
+    (20, "Enviar contenido educativo")
+)
+FALLBACK_ACTION = "Revisar si el lead está calificado"
+
+FACTOR_NAMES = (
+    'source_score', 'interaction_score', 'response_time_score',
+    'interest_level_score', 'company_score', 'email_score'
+)
+
+# Filas leídas del cursor por bloque al armar las matrices
+FETCH_BLOCK_SIZE = 65536
+
+# Día juliano del epoch Unix: julianday() de SQLite -> días desde 1970-01-01
+_UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+def fetch_matrix(statement, width: int, dtype=np.float64) -> np.ndarray:
+    """Resultado numérico de una consulta como matriz, leído del cursor DBAPI por bloques sin crear objetos Row"""
+    cursor = db.session.connection().execute(statement).cursor
+    blocks = []
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_BLOCK_SIZE)
+            if not rows:
+                break
+            # NULL -> NaN en las columnas de punto flotante
+            blocks.append(np.array(rows, dtype=dtype))
+    finally:
+        cursor.close()
+    return np.concatenate(blocks) if blocks else np.empty((0, width), dtype=dtype)
+
+def load_scoring_inputs(lead_ids: Optional[Iterable[int]] = None, status: str = None, source: str = None,
+                        statuses: Optional[Iterable[LeadStatus]] = None) -> Dict:
+    """Columnas de scoring como arrays ordenados por id, leídas de la tabla lead en una consulta"""
+    # Todas las columnas numéricas: fuente (puntaje y posición) y estado se resuelven con CASE sobre el nombre guardado
+    stored_source = type_coerce(Lead.source, db.String)
+    source_score = case(
+        {lead_source.name: score for lead_source, score in SOURCE_SCORES.items()},
+        value=stored_source,
+        else_=DEFAULT_SOURCE_SCORE
+    )
+    source_index = case(
+        {lead_source.name: index for index, lead_source in enumerate(LeadSource)},
+        value=stored_source,
+        else_=-1
+    )
+    query = select(
+        Lead.id,
+        source_score,
+        func.coalesce(Lead.interest_level, 0),
+        func.coalesce(Lead.company, '') != '',
+        func.coalesce(Lead.email, '') != '',
+        func.julianday(Lead.last_contact_date),
+        func.coalesce(Lead.interaction_count, 0),
+        func.coalesce(Lead.message_count, 0),
+        source_index,
+        type_coerce(Lead.status, db.String) == LeadStatus.CONVERTIDO.name
+    ).order_by(Lead.id)
+    if lead_ids is not None:
+        query = query.where(Lead.id.in_(list(lead_ids)))
+    if status:
+        query = query.where(Lead.status == status)
+    if statuses is not None:
+        query = query.where(Lead.status.in_(list(statuses)))
+    if source:
+        query = query.where(Lead.source == source)
+
+    leads = fetch_matrix(query, 10)
+    inputs = {
+        'ids': leads[:, 0].astype(np.int64),
+        'source_score': leads[:, 1],
+        'interest_level': leads[:, 2],
+        'has_company': leads[:, 3] > 0,
+        'has_email': leads[:, 4] > 0,
+        # NaN para los leads sin contacto registrado
+        'contact_day': leads[:, 5],
+        'interactions': leads[:, 6].astype(np.int64),
+        'messages': leads[:, 7].astype(np.int64),
+        'source_index': leads[:, 8].astype(np.int64),
+        'converted': leads[:, 9] > 0
+    }
+    return inputs
+
+def days_since(contact_day: np.ndarray, now: datetime = None) -> np.ndarray:
+    """Días completos desde un día juliano (NaN si no hay fecha)"""
+    now = now or datetime.utcnow()
+    now_day = (now - datetime(1970, 1, 1)).total_seconds() / 86400 + _UNIX_EPOCH_JULIAN_DAY
+    return np.floor(now_day - contact_day)
+
+def compute_factors(inputs: Dict, now: datetime = None) -> Dict[str, np.ndarray]:
+    """Los seis factores de conversión, un array por factor"""
+    interactions = inputs['interactions']
+    days_since_contact = days_since(inputs['contact_day'], now)
+    # Las comparaciones con NaN dan False: sin contacto cae en el valor por defecto (0.2)
+    with np.errstate(invalid='ignore'):
+        response_time_score = np.select(
+            [days_since_contact <= 1, days_since_contact <= 3, days_since_contact <= 7, days_since_contact <= 14],
+            [1.0, 0.8, 0.6, 0.4],
+            0.2
+        )
+    return {
+        'source_score': inputs['source_score'],
+        'interaction_score': np.select(
+            [interactions == 0, interactions == 1, interactions <= 3], [0.3, 0.6, 0.8], 0.9
+        ),
+        'response_time_score': response_time_score,
+        'interest_level_score': inputs['interest_level'] / 5.0,
+        'company_score': np.where(inputs['has_company'], 1.0, 0.5),
+        'email_score': np.where(inputs['has_email'], 1.0, 0.5)
+    }
+
+def conversion_probabilities(factors: Dict[str, np.ndarray]) -> np.ndarray:
+    """Promedio de los factores en porcentaje, con tope de 95%"""
+    matrix = np.column_stack([factors[name] for name in FACTOR_NAMES])
+    return np.round(np.minimum(matrix.mean(axis=1) * 100, 95), 1)
+
+def next_best_actions(probabilities: np.ndarray) -> np.ndarray:
+    """Siguiente mejor acción para cada probabilidad"""
+    return np.select(
+        [probabilities >= threshold for threshold, _ in NEXT_BEST_ACTIONS],
+        [action for _, action in NEXT_BEST_ACTIONS],
+        FALLBACK_ACTION
+    )
+
+def score_leads(lead_ids: Optional[Iterable[int]] = None, status: str = None, source: str = None) -> Dict:
+    """Scoring de conversión de un conjunto de leads (todos por defecto); devuelve arrays alineados por id"""
+    started = time.perf_counter()
+    inputs = load_scoring_inputs(lead_ids, status, source)
+    loaded = time.perf_counter()
+    factors = compute_factors(inputs)
+    # Con un modelo entrenado publicado se usa su probabilidad; los factores quedan para las recomendaciones
+    from conversion_model import conversion_model_registry
+    model = conversion_model_registry.current()
+    probabilities = model.predict(inputs) if model else conversion_probabilities(factors)
+    actions = next_best_actions(probabilities)
+    finished = time.perf_counter()
+    logger.info(
+        f"Scoring en lote: {len(probabilities)} leads "
+        f"(carga {(loaded - started) * 1000:.0f} ms, cálculo {(finished - loaded) * 1000:.0f} ms)"
+    )
+    return {
+        'lead_ids': inputs['ids'],
+        'probabilities': probabilities,
+        'actions': actions,
+        'factors': factors,
+        'model_version': model.version if model else None,
+        'load_ms': round((loaded - started) * 1000, 1),
+        'compute_ms': round((finished - loaded) * 1000, 1)
+    }
+
+def summarize_scores(scores: Dict) -> Dict:
+    """Resumen de un scoring en lote: cantidad, promedio y leads por siguiente acción"""
+    probabilities = scores['probabilities']
+    actions, counts = np.unique(scores['actions'], return_counts=True)
+    return {
+        'count': int(len(probabilities)),
+        'average_probability': round(float(probabilities.mean()), 1) if len(probabilities) else None,
+        'by_action': {str(action): int(count) for action, count in zip(actions, counts)},
+        'model_version': scores['model_version'],
+        'load_ms': scores['load_ms'],
+        'compute_ms': scores['compute_ms']
+    }
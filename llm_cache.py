@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Caché de respuestas del LLM para Nexa Lead Manager
+Dos niveles: un LRU en memoria por proceso y la tabla llm_response_cache compartida entre procesos.
+La clave es un hash del modelo, el tipo de consulta y el texto normalizado (minúsculas, sin tildes
+ni puntuación), así "¿Precio?" y "precio" reutilizan la misma respuesta; con TTL y tope de filas
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+import re
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import bindparam, func, select, text
+from models import db, LLMResponseCache
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 10000))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv('LLM_CACHE_MEMORY_ENTRIES', 1000))
+
+_NON_WORD_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+_UPSERT_SQL = text("""
+    INSERT INTO llm_response_cache (key, kind, model, response, hits, created_at, expires_at, last_used_at)
+    VALUES (:key, :kind, :model, :response, 0, :now, :expires_at, :now)
+    ON CONFLICT (key) DO UPDATE SET
+        response = excluded.response, created_at = excluded.created_at,
+        expires_at = excluded.expires_at, last_used_at = excluded.last_used_at
+""").bindparams(bindparam('now', type_=db.DateTime), bindparam('expires_at', type_=db.DateTime))
+
+_TOUCH_SQL = text(
+    "UPDATE llm_response_cache SET hits = hits + 1, last_used_at = :now WHERE key = :key"
+).bindparams(bindparam('now', type_=db.DateTime))
+
+# Vencidas primero; después, si sobran filas, las menos usadas recientemente
+_EVICT_SQL = text("""
+    DELETE FROM llm_response_cache WHERE expires_at <= :now OR key IN (
+        SELECT key FROM llm_response_cache ORDER BY last_used_at
+        LIMIT max(0, (SELECT count(*) FROM llm_response_cache) - :max_entries)
+    )
+""").bindparams(bindparam('now', type_=db.DateTime))
+
+def normalize_prompt_text(value) -> str:
+    """Minúsculas, sin tildes y con la puntuación y los espacios colapsados"""
+    folded = unicodedata.normalize('NFKD', str(value or '').lower())
+    folded = ''.join(char for char in folded if not unicodedata.combining(char))
+    return _NON_WORD_RE.sub(' ', folded).strip()
+
+def cache_key(model: str, kind: str, *parts) -> str:
+    """Hash estable de (modelo, tipo de consulta, partes normalizadas del prompt)"""
+    normalized = [model, kind] + [normalize_prompt_text(part) for part in parts]
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def parse_use_cache(value) -> bool:
+    """Valor estricto del parámetro use_cache de una request (ausente = True); ValueError si no es booleano"""
+    if value is None or isinstance(value, bool):
+        return value is not False
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ('true', '1', 'false', '0'):
+        return value.strip().lower() in ('true', '1')
+    raise ValueError(f"use_cache debe ser true o false, no {value!r}")
+
+class LLMCache:
+    """LRU en memoria delante de la tabla llm_response_cache; los errores de base de datos cuentan como fallo de caché"""
+
+    def __init__(self, memory_entries: int = LLM_CACHE_MEMORY_ENTRIES, ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.memory_entries = memory_entries
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_entries = max_entries
+        self.memory: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def _remember(self, key: str, response: str, expires_at: datetime):
+        with self.lock:
+            self.memory[key] = (response, expires_at)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+                self.counters['memory_evictions'] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        """Respuesta guardada y vigente para la clave, o None"""
+        now = datetime.utcnow()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[1] > now:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return entry[0]
+            if entry:
+                del self.memory[key]
+        try:
+            # Conexión propia: lecturas y escrituras de la caché no dependen de la sesión de la request
+            with db.engine.begin() as connection:
+                row = connection.execute(
+                    select(LLMResponseCache.response, LLMResponseCache.expires_at)
+                    .where(LLMResponseCache.key == key, LLMResponseCache.expires_at > now)
+                ).first()
+                if row:
+                    connection.execute(_TOUCH_SQL, {'key': key, 'now': now})
+        except Exception as e:
+            logger.warning(f"Caché LLM no disponible: {e}")
+            row = None
+        if row is None:
+            self.counters['misses'] += 1
+            return None
+        self.counters['db_hits'] += 1
+        self._remember(key, row.response, row.expires_at)
+        return row.response
+
+    def set(self, key: str, kind: str, model: str, response: str):
+        """Guardar una respuesta en ambos niveles y desalojar vencidas y excedentes de la tabla"""
+        now = datetime.utcnow()
+        expires_at = now + self.ttl
+        self._remember(key, response, expires_at)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(_UPSERT_SQL, {
+                    'key': key, 'kind': kind, 'model': model, 'response': response,
+                    'now': now, 'expires_at': expires_at
+                })
+                evicted = connection.execute(_EVICT_SQL, {'now': now, 'max_entries': self.max_entries}).rowcount
+            self.counters['db_evictions'] += max(evicted, 0)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar en la caché LLM: {e}")
+
+    def record_bypass(self):
+        self.counters['bypassed'] += 1
+
+    def clear(self) -> int:
+        """Vaciar ambos niveles; devuelve las filas borradas de la tabla"""
+        with self.lock:
+            self.memory.clear()
+        with db.engine.begin() as connection:
+            return connection.execute(LLMResponseCache.__table__.delete()).rowcount
+
+    def stats(self) -> Dict:
+        """Aciertos y fallos de este proceso, tamaño en memoria y filas en la tabla"""
+        counters = dict(self.counters)
+        hits = counters.get('memory_hits', 0) + counters.get('db_hits', 0)
+        lookups = hits + counters.get('misses', 0)
+        entries = db.session.execute(select(func.count()).select_from(LLMResponseCache)).scalar()
+        return {
+            'memory_hits': counters.get('memory_hits', 0),
+            'db_hits': counters.get('db_hits', 0),
+            'misses': counters.get('misses', 0),
+            'bypassed': counters.get('bypassed', 0),
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+            'memory_entries': len(self.memory),
+            'memory_evictions': counters.get('memory_evictions', 0),
+            'db_entries': entries,
+            'db_evictions': counters.get('db_evictions', 0),
+            'ttl_seconds': int(self.ttl.total_seconds()),
+            'max_entries': self.max_entries
+        }
+
+llm_cache = LLMCache()
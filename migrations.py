@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Migraciones idempotentes de esquema para Nexa Lead Manager
+Se ejecutan al inicio sobre bases existentes sin borrar datos
+"""
+
+import logging
+from sqlalchemy import inspect, text, update
+from sqlalchemy.schema import CreateTable
+from models import db, Lead, User, normalize_phone
+from search_index import ensure_search_index
+
+logger = logging.getLogger(__name__)
+
+def apply_schema_upgrades():
+    """Aplicar cambios de esquema pendientes (requiere contexto de aplicación)"""
+    # create_all solo crea las tablas que todavía no existen
+    db.create_all()
+    add_missing_columns()
+    relax_not_null_columns()
+    enable_sqlite_autoincrement()
+    # Antes de los índices: el índice único de phone_e164 necesita la columna ya completada sin repetidos
+    backfill_phone_e164()
+    create_missing_indexes()
+    ensure_search_index()
+    logger.info("Esquema de base de datos actualizado")
+
+def add_missing_columns():
+    """Agregar a tablas existentes las columnas declaradas en los modelos que falten"""
+    inspector = inspect(db.engine)
+    added = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing or col.primary_key:
+                    continue
+                col_type = col.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {col_type}'))
+                added.append(f"{table.name}.{col.name}")
+    if added:
+        logger.info(f"Columnas agregadas: {', '.join(added)}")
+    return added
+
+def relax_not_null_columns():
+    """Quitar NOT NULL de las columnas que los modelos ya declaran opcionales (SQLite: reconstruye la tabla)"""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    relaxed = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {col['name']: col for col in inspector.get_columns(table.name)}
+        columns = [
+            col.name for col in table.columns
+            if col.nullable and not col.primary_key and col.name in existing and not existing[col.name]['nullable']
+        ]
+        if not columns:
+            continue
+        if db.engine.dialect.name != 'sqlite':
+            with db.engine.begin() as connection:
+                for name in columns:
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ALTER COLUMN "{name}" DROP NOT NULL'))
+        else:
+            _rebuild_sqlite_table(table, existing)
+        relaxed.extend(f"{table.name}.{name}" for name in columns)
+    if relaxed:
+        logger.info(f"Columnas ahora opcionales: {', '.join(relaxed)}")
+    return relaxed
+
+def _rebuild_sqlite_table(table, existing_columns):
+    """Recrear una tabla SQLite con el DDL del modelo: tabla nueva, copiar filas, borrar la vieja y renombrar"""
+    # Los índices se vuelven a crear después en create_missing_indexes
+    rebuilt = f'{table.name}__rebuild'
+    ddl = str(CreateTable(table).compile(dialect=db.engine.dialect)).replace(
+        db.engine.dialect.identifier_preparer.format_table(table), f'"{rebuilt}"', 1
+    )
+    shared = ', '.join(f'"{col.name}"' for col in table.columns if col.name in existing_columns)
+    with db.engine.begin() as connection:
+        connection.execute(text(ddl))
+        connection.execute(text(f'INSERT INTO "{rebuilt}" ({shared}) SELECT {shared} FROM "{table.name}"'))
+        connection.execute(text(f'DROP TABLE "{table.name}"'))
+        connection.execute(text(f'ALTER TABLE "{rebuilt}" RENAME TO "{table.name}"'))
+
+# Ids ya usados fuera de la tabla: el contador de AUTOINCREMENT arranca por encima de ellos
+# (las versiones guardadas de plantillas borradas conservan su template_id)
+_AUTOINCREMENT_FLOORS = {
+    'message_template': 'SELECT max(template_id) FROM message_template_version',
+}
+
+def enable_sqlite_autoincrement():
+    """Pasar a AUTOINCREMENT las tablas que lo declaran, para que SQLite no reutilice ids borrados"""
+    if db.engine.dialect.name != 'sqlite':
+        return []
+    inspector = inspect(db.engine)
+    enabled = []
+    for table in db.metadata.sorted_tables:
+        if not table.dialect_options['sqlite']['autoincrement']:
+            continue
+        with db.engine.connect() as connection:
+            ddl = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+            ).scalar()
+        if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+            continue
+        _rebuild_sqlite_table(table, {col['name'] for col in inspector.get_columns(table.name)})
+        floor = _AUTOINCREMENT_FLOORS.get(table.name)
+        if floor:
+            with db.engine.begin() as connection:
+                used = connection.execute(text(floor)).scalar() or 0
+                seq = connection.execute(
+                    text('SELECT seq FROM sqlite_sequence WHERE name = :name'), {'name': table.name}
+                ).scalar()
+                if seq is None:
+                    connection.execute(
+                        text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                        {'name': table.name, 'seq': used}
+                    )
+                elif seq < used:
+                    connection.execute(
+                        text('UPDATE sqlite_sequence SET seq = :seq WHERE name = :name'),
+                        {'name': table.name, 'seq': used}
+                    )
+        enabled.append(table.name)
+    if enabled:
+        logger.info(f"Tablas con AUTOINCREMENT: {', '.join(enabled)}")
+    return enabled
+
+def create_missing_indexes():
+    """Crear en tablas existentes los índices declarados en los modelos"""
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                try:
+                    index.create(bind=db.engine)
+                    created.append(index.name)
+                except Exception as e:
+                    logger.warning(f"No se pudo crear el índice {index.name}: {e}")
+    if created:
+        logger.info(f"Índices creados: {', '.join(created)}")
+    return created
+
+def backfill_phone_e164(chunk_size: int = 1000):
+    """Completar phone_e164 de leads y usuarios existentes recorriendo por id, un commit por bloque"""
+    totals = {'leads': 0, 'users': 0, 'lead_duplicates': 0}
+    last_id = 0
+    while True:
+        rows = db.session.query(Lead.id, Lead.phone_number).filter(
+            Lead.id > last_id, Lead.phone_e164.is_(None)
+        ).order_by(Lead.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        normalized = {row.id: normalize_phone(row.phone_number) for row in rows}
+        taken = {
+            phone for (phone,) in db.session.query(Lead.phone_e164).filter(
+                Lead.phone_e164.in_({phone for phone in normalized.values() if phone})
+            )
+        }
+        updates = []
+        for lead_id, phone in normalized.items():
+            if not phone:
+                continue
+            if phone in taken:
+                # Mismo número escrito distinto: el lead más antiguo conserva el número normalizado
+                logger.warning(f"Lead {lead_id} duplica el número {phone}; phone_e164 queda vacío")
+                totals['lead_duplicates'] += 1
+                continue
+            taken.add(phone)
+            updates.append({'id': lead_id, 'phone_e164': phone})
+        if updates:
+            db.session.execute(update(Lead), updates)
+        db.session.commit()
+        totals['leads'] += len(updates)
+
+    # Sin índice único en usuarios: un solo UPDATE por bloque sin control de repetidos
+    last_id = 0
+    while True:
+        rows = db.session.query(User.id, User.phone_number).filter(
+            User.id > last_id, User.phone_e164.is_(None), User.phone_number.isnot(None)
+        ).order_by(User.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        updates = [
+            {'id': row.id, 'phone_e164': phone}
+            for row in rows if (phone := normalize_phone(row.phone_number))
+        ]
+        if updates:
+            db.session.execute(update(User), updates)
+        db.session.commit()
+        totals['users'] += len(updates)
+
+    if totals['leads'] or totals['users']:
+        logger.info(f"phone_e164 completado: {totals['leads']} leads, {totals['users']} usuarios")
+    return totals
@@ -1,11 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.orm import column_property, validates
 from datetime import datetime, timedelta
 from enum import Enum
 import json
+import os
+import re
 
 db = SQLAlchemy()
 
+def get_database_uri() -> str:
+    """URI de la base de la aplicación: raíz del proyecto en Render, directorio instance en local"""
+    if os.getenv('RENDER'):
+        return 'sqlite:///nexa_leads.db'
+    return 'sqlite:///instance/nexa_leads.db'
+
 class LeadStatus(Enum):
     NUEVO = "nuevo"
     CONTACTADO = "contactado"
@@ -30,6 +39,7 @@ class User(UserMixin, db.Model):
     first_name = db.Column(db.String(50))
     last_name = db.Column(db.String(50))
     phone_number = db.Column(db.String(20))
+    phone_e164 = db.Column(db.String(20), index=True)  # phone_number normalizado (ver normalize_phone)
     role = db.Column(db.String(20), default='user')  # admin, manager, user
     is_active = db.Column(db.Boolean, default=True)
     last_login = db.Column(db.DateTime)
@@ -41,6 +51,11 @@ class User(UserMixin, db.Model):
     created_leads = db.relationship('Lead', backref='created_by', lazy=True, foreign_keys='Lead.created_by_id')
     assigned_leads = db.relationship('Lead', backref='assigned_to', lazy=True, foreign_keys='Lead.assigned_to_id')
     
+    @validates('phone_number')
+    def _normalize_phone_number(self, key, value):
+        self.phone_e164 = normalize_phone(value)
+        return value
+    
     def get_full_name(self):
         """Obtener nombre completo del usuario"""
         if self.first_name and self.last_name:
@@ -60,16 +75,26 @@ class User(UserMixin, db.Model):
         return self.role in ['admin', 'manager']
 
 class Lead(db.Model):
+    __table_args__ = (
+        db.Index('ix_lead_created_at_id', 'created_at', 'id'),  # Listados por fecha y paginación por cursor
+        # Un lead por número: deduplicación y búsqueda de mensajes entrantes por igualdad
+        db.Index('ux_lead_phone_e164', 'phone_e164', unique=True),
+        db.Index('ix_lead_conversion_score_id', 'conversion_score', 'id'),  # Listado ordenado por score
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone_number = db.Column(db.String(20), nullable=False, unique=True)
+    phone_e164 = db.Column(db.String(20))  # phone_number normalizado al escribir (ver normalize_phone)
     email = db.Column(db.String(120))
     company = db.Column(db.String(100))
-    status = db.Column(db.Enum(LeadStatus), default=LeadStatus.NUEVO)
-    source = db.Column(db.Enum(LeadSource), default=LeadSource.OTRO)
+    # active_history: el valor anterior se carga aunque el lead esté expirado (contadores y funnel lo necesitan)
+    status = column_property(db.Column(db.Enum(LeadStatus), default=LeadStatus.NUEVO, index=True), active_history=True)
+    source = column_property(db.Column(db.Enum(LeadSource), default=LeadSource.OTRO), active_history=True)
     interest_level = db.Column(db.Integer, default=3)  # 1-5
     notes = db.Column(db.Text)
-    next_follow_up = db.Column(db.DateTime)
+    next_follow_up = db.Column(db.DateTime, index=True)
+    follow_up_slot_at = db.Column(db.DateTime, index=True)  # turno planificado para el recordatorio (UTC)
     last_contact_date = db.Column(db.DateTime)
     priority = db.Column(db.String(20), default='medium')  # low, medium, high, urgent
     estimated_value = db.Column(db.Float)  # Valor estimado del proyecto
@@ -77,12 +102,25 @@ class Lead(db.Model):
     location = db.Column(db.String(200))  # Ubicación del proyecto
     created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     assigned_to_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status_changed_at = db.Column(db.DateTime)  # Entrada al estado actual (ver funnel.py)
+    conversion_score = db.Column(db.Float)  # Probabilidad de conversión guardada (ver lead_scores.py)
+    scored_at = db.Column(db.DateTime)
+    # Actividad desnormalizada, mantenida al insertar/borrar mensajes e interacciones (ver lead_activity.py)
+    message_count = db.Column(db.Integer, default=0)
+    interaction_count = db.Column(db.Integer, default=0)
+    last_inbound_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relaciones
     interactions = db.relationship('Interaction', backref='lead', lazy=True, cascade='all, delete-orphan')
     messages = db.relationship('Message', backref='lead', lazy=True, cascade='all, delete-orphan')
+    status_changes = db.relationship('LeadStatusChange', backref='lead', lazy=True, cascade='all, delete-orphan')
+    
+    @validates('phone_number')
+    def _normalize_phone_number(self, key, value):
+        self.phone_e164 = normalize_phone(value)
+        return value
     
     def get_priority_color(self):
         """Obtener color de prioridad para la UI"""
@@ -107,6 +145,10 @@ class Lead(db.Model):
         return datetime.utcnow() >= self.next_follow_up
 
 class Interaction(db.Model):
+    __table_args__ = (
+        db.Index('ix_interaction_lead_id_created_at', 'lead_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     lead_id = db.Column(db.Integer, db.ForeignKey('lead.id'), nullable=False)
     interaction_type = db.Column(db.String(50), nullable=False)  # call, email, whatsapp, meeting
@@ -114,22 +156,70 @@ class Interaction(db.Model):
     outcome = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-class Message(db.Model):
+class LeadStatusChange(db.Model):
+    """Registro append-only de cambios de estado de un lead"""
+    __table_args__ = (
+        db.Index('ix_lead_status_change_lead_id_changed_at', 'lead_id', 'changed_at'),
+        db.Index('ix_lead_status_change_to_status_changed_at', 'to_status', 'changed_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     lead_id = db.Column(db.Integer, db.ForeignKey('lead.id'), nullable=False)
+    from_status = db.Column(db.Enum(LeadStatus))  # NULL = alta del lead
+    to_status = db.Column(db.Enum(LeadStatus), nullable=False)
+    seconds_in_previous = db.Column(db.Float, default=0)  # Tiempo que pasó en from_status
+    changed_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FunnelTransitionStat(db.Model):
+    """Agregado incremental del funnel por transición de etapa (ver funnel.py)"""
+    __tablename__ = 'funnel_transition_stats'
+    
+    from_stage = db.Column(db.String(20), primary_key=True)  # '' = alta del lead
+    to_stage = db.Column(db.String(20), primary_key=True)
+    transition_count = db.Column(db.Integer, nullable=False, default=0)
+    total_seconds = db.Column(db.Float, nullable=False, default=0)
+
+class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_lead_id_created_at', 'lead_id', 'created_at'),
+        db.Index('ix_message_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_message_status_scheduled_at', 'status', 'scheduled_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # Nulo en avisos a usuarios del equipo (resumen semanal), que van a to_number
+    lead_id = db.Column(db.Integer, db.ForeignKey('lead.id'))
     content = db.Column(db.Text, nullable=False)
+    to_number = db.Column(db.String(20))  # destinatario E.164 de mensajes sin lead
     message_type = db.Column(db.String(20), default='outbound')  # inbound, outbound
     status = db.Column(db.String(20), default='pending')  # pending, sent, delivered, read, failed, scheduled
-    scheduled_at = db.Column(db.DateTime)
-    sent_at = db.Column(db.DateTime)
+    scheduled_at = db.Column(db.DateTime, index=True)
+    sent_at = db.Column(db.DateTime, index=True)
     delivered_at = db.Column(db.DateTime)
     read_at = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    # Outbox: envío en segundo plano con reintentos (next_attempt_at nulo = fuera de la cola)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    locked_until = db.Column(db.DateTime)
+    claimed_by = db.Column(db.String(64))
+    last_error = db.Column(db.Text)
+    twilio_sid = db.Column(db.String(64))
+    
+    # Mensajes de plantilla: content queda vacío y se renderiza al leer desde message_template_version
+    template_id = db.Column(db.Integer)
+    template_version = db.Column(db.Integer)
+    variables = db.Column(db.Text)  # JSON compacto con las variables usadas por la plantilla
     
     # Relaciones
     campaign_results = db.relationship('CampaignResult', backref='message_ref', lazy=True, cascade='all, delete-orphan')
 
 class MessageTemplate(db.Model):
+    # Sin reutilizar ids borrados: las cachés y las versiones guardadas se indexan por (id, versión)
+    __table_args__ = {'sqlite_autoincrement': True}
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     category = db.Column(db.String(50), nullable=False)  # welcome, follow_up, reminder, offer
@@ -137,6 +227,23 @@ class MessageTemplate(db.Model):
     variables = db.Column(db.Text)  # JSON de variables disponibles
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Se incrementa al editar el contenido; invalida la plantilla compilada en caché
+    version = db.Column(db.Integer, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MessageTemplateVersion(db.Model):
+    """Contenido de cada versión de una plantilla; se conserva aunque la plantilla se edite o se borre"""
+    template_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ConversionModelVersion(db.Model):
+    """Versión publicada del modelo de conversión; se inserta en la misma transacción que sube el contador"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    params = db.Column(db.LargeBinary, nullable=False)  # matriz [medias, escalas, pesos] en formato .npy
+    details = db.Column(db.Text, nullable=False)  # JSON con features, métricas y pesos
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Campaign(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -152,8 +259,58 @@ class Campaign(db.Model):
     # Relaciones
     template = db.relationship('MessageTemplate')
     results = db.relationship('CampaignResult', backref='campaign_ref', lazy=True, cascade='all, delete-orphan')
+    runs = db.relationship('CampaignRun', backref='campaign', lazy=True, cascade='all, delete-orphan')
+
+class CampaignRun(db.Model):
+    """Ejecución de una campaña con checkpoint por bloque para poder reanudarla"""
+    __table_args__ = (
+        # Una sola ejecución activa por campaña
+        db.Index('ux_campaign_run_active', 'campaign_id', unique=True,
+                 sqlite_where=db.text("status = 'running'"), postgresql_where=db.text("status = 'running'")),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), default='running')  # running, completed, failed
+    last_lead_id = db.Column(db.Integer, default=0)  # cursor: último lead procesado
+    processed = db.Column(db.Integer, default=0)
+    sent = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    # Lease del proceso que ejecuta la campaña; vencido el heartbeat, otro proceso la reanuda
+    owner = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime)
+    resumed_count = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class ImportJob(db.Model):
+    """Importación de leads desde CSV ejecutada en segundo plano, con progreso por bloque"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255))
+    file_path = db.Column(db.String(500))
+    status = db.Column(db.String(20), default='queued')  # queued, running, completed, failed
+    total_rows = db.Column(db.Integer)
+    processed = db.Column(db.Integer, default=0)
+    imported = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)
+    skip_reasons = db.Column(db.Text)  # JSON {motivo: cantidad}
+    skipped_rows = db.Column(db.Text)  # JSON con una muestra de filas omitidas (línea, motivo, teléfono)
+    # Lease del proceso que importa; vencido el heartbeat, la tarea programada reanuda desde `processed`
+    owner = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime)
+    resumed_count = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
 
 class CampaignResult(db.Model):
+    __table_args__ = (
+        db.Index('ix_campaign_result_campaign_id_status', 'campaign_id', 'status'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
     lead_id = db.Column(db.Integer, db.ForeignKey('lead.id'), nullable=False)
@@ -166,7 +323,83 @@ class CampaignResult(db.Model):
     # Relaciones - Sin backref para evitar conflictos
     # lead = db.relationship('Lead', backref='campaign_results')  # Comentado para evitar conflicto
 
+class LeadDailyStat(db.Model):
+    """Rollup diario de leads creados por día × estado × fuente × usuario asignado"""
+    __tablename__ = 'lead_daily_stats'
+    
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.Enum(LeadStatus), primary_key=True)
+    source = db.Column(db.Enum(LeadSource), primary_key=True)
+    assigned_to_id = db.Column(db.Integer, primary_key=True, default=0)  # 0 = sin asignar
+    lead_count = db.Column(db.Integer, nullable=False, default=0)
+    estimated_value = db.Column(db.Float, nullable=False, default=0)
+
+class MessageDailyStat(db.Model):
+    """Rollup diario de mensajes por día × tipo × estado × fuente del lead × usuario asignado"""
+    __tablename__ = 'message_daily_stats'
+    
+    day = db.Column(db.Date, primary_key=True)
+    message_type = db.Column(db.String(20), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    source = db.Column(db.Enum(LeadSource), primary_key=True)
+    assigned_to_id = db.Column(db.Integer, primary_key=True, default=0)  # 0 = sin asignar
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+
+class SchedulerLease(db.Model):
+    """Lease del proceso líder que ejecuta las tareas programadas"""
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class LeadScoreQueue(db.Model):
+    """Leads cuyo score quedó desactualizado (ver lead_scores.py)"""
+    __tablename__ = 'lead_score_queue'
+    lead_id = db.Column(db.Integer, primary_key=True)
+    queued_at = db.Column(db.DateTime, nullable=False)
+
+class LLMResponseCache(db.Model):
+    """Respuestas de chat-completion reutilizables, por hash del prompt normalizado (ver llm_cache.py)"""
+    __tablename__ = 'llm_response_cache'
+    key = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # intent, message:welcome...
+    model = db.Column(db.String(50), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, nullable=False, index=True)  # desalojo por tamaño: menos usadas primero
+
+class StatCounter(db.Model):
+    """Contador agregado mantenido incrementalmente (ver counters.py)"""
+    name = db.Column(db.String(100), primary_key=True)  # leads:total, leads:status:nuevo, messages:day:2024-01-31...
+    value = db.Column(db.Integer, nullable=False, default=0)
+
 # Funciones de utilidad para los modelos
+_PHONE_CHARS_RE = re.compile(r'[^\d+]')
+
+def normalize_phone(phone_number) -> str:
+    """Número en formato E.164 (+5491112345678), con Argentina por defecto; None si no es un número válido"""
+    if not phone_number:
+        return None
+    cleaned = _PHONE_CHARS_RE.sub('', str(phone_number).replace('whatsapp:', ''))
+    digits = cleaned.replace('+', '')
+    if not cleaned.startswith('+'):
+        if digits.startswith('0'):
+            digits = '54' + digits[1:]
+        elif not digits.startswith('54'):
+            digits = '54' + digits
+    # E.164: hasta 15 dígitos incluyendo el código de país
+    if not 8 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+def find_lead_by_phone(phone_number: str):
+    """Buscar un lead por número con una igualdad sobre el índice único de phone_e164"""
+    phone_e164 = normalize_phone(phone_number)
+    if phone_e164:
+        return Lead.query.filter_by(phone_e164=phone_e164).first()
+    return Lead.query.filter_by(phone_number=phone_number).first()
+
 def get_leads_by_status(status: LeadStatus):
     """Obtener leads por estado"""
     return Lead.query.filter_by(status=status).all()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Outbox de mensajes salientes para Nexa Lead Manager
+Las rutas solo insertan filas pendientes en message; un proceso aparte las reclama
+por lotes, las envía por Twilio con reintentos y backoff exponencial y guarda el resultado
+"""
+
+import os
+import time
+import random
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from uuid import uuid4
+from sqlalchemy import bindparam, func, select, update
+from models import db, Lead, Message
+from dispatcher import OutboundDispatcher, outbound_message
+from template_registry import render_stored, store_template_version, template_message_columns
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+# Backoff: base * 2^(intento-1) con tope, más un 10% de jitter
+OUTBOX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', 30))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_MAX_BACKOFF_SECONDS', 3600))
+# Un lote reclamado por un proceso caído vuelve a la cola pasado este tiempo
+OUTBOX_CLAIM_TIMEOUT_SECONDS = int(os.getenv('OUTBOX_CLAIM_TIMEOUT_SECONDS', 300))
+
+# El resultado solo se escribe si la fila sigue reclamada por este proceso: quien perdió el lease
+# (otro proceso la reclamó y la reenvió) no pisa el resultado del nuevo dueño
+_messages = Message.__table__
+_STORE_OUTCOME = update(_messages).where(
+    _messages.c.id == bindparam('message_id'),
+    _messages.c.claimed_by == bindparam('token'),
+    _messages.c.status == 'sending'
+).values(
+    status=bindparam('new_status'),
+    sent_at=bindparam('new_sent_at'),
+    twilio_sid=bindparam('sid'),
+    last_error=bindparam('error'),
+    locked_until=None,
+    next_attempt_at=func.coalesce(bindparam('retry_at', type_=db.DateTime), _messages.c.next_attempt_at)
+)
+
+def enqueue_message(lead_id: Optional[int], content: str = None, send_at: datetime = None,
+                    template=None, values: Dict = None, to_number: str = None) -> Message:
+    """Agregar un mensaje pendiente al outbox (el commit queda a cargo del llamador)"""
+    # Sin lead (avisos al equipo) el destino es to_number, ya normalizado a E.164
+    # Con plantilla se guardan su versión y `values`; el texto se renderiza al reclamar el mensaje
+    if template is not None:
+        store_template_version(template)
+        columns = template_message_columns(template, values or {})
+    else:
+        columns = {'content': content}
+    message = Message(
+        lead_id=lead_id,
+        to_number=to_number,
+        message_type='outbound',
+        status='pending',
+        attempts=0,
+        next_attempt_at=send_at or datetime.utcnow(),
+        **columns
+    )
+    db.session.add(message)
+    return message
+
+def promote_due_scheduled(limit: int = OUTBOX_BATCH_SIZE, now: datetime = None) -> int:
+    """Pasar al outbox un lote de mensajes programados cuya hora llegó (índice status, scheduled_at)"""
+    now = now or datetime.utcnow()
+    due = db.session.query(Message.id, Message.scheduled_at).filter(
+        Message.status == 'scheduled',
+        Message.scheduled_at <= now
+    ).order_by(Message.scheduled_at).limit(limit).all()
+    if not due:
+        db.session.rollback()
+        return 0
+
+    # next_attempt_at = scheduled_at conserva el orden y permite medir el retraso
+    promoted = db.session.execute(
+        update(Message).where(
+            Message.id.in_([row.id for row in due]),
+            Message.status == 'scheduled'
+        ).values(status='pending', next_attempt_at=Message.scheduled_at, attempts=func.coalesce(Message.attempts, 0)),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    db.session.commit()
+
+    logger.info(
+        f"Outbox: {promoted} mensajes programados listos para enviar "
+        f"(retraso máximo {(now - due[0].scheduled_at).total_seconds():.1f}s)"
+    )
+    return promoted
+
+def backoff_delay(attempts: int) -> float:
+    """Segundos de espera antes del siguiente intento"""
+    delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(1.0, 1.1)
+
+def _ready_filter(now: datetime):
+    """Mensajes listos para enviar o reclamados por un proceso que no terminó a tiempo"""
+    return db.or_(
+        db.and_(Message.status == 'pending', Message.next_attempt_at <= now),
+        db.and_(Message.status == 'sending', Message.locked_until < now)
+    )
+
+def claim_batch(limit: int = OUTBOX_BATCH_SIZE) -> List[Dict]:
+    """Reclamar atómicamente un lote de mensajes con un UPDATE ... WHERE id IN (SELECT ... LIMIT)"""
+    now = datetime.utcnow()
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+    ids = select(Message.id).where(_ready_filter(now)).order_by(Message.next_attempt_at).limit(limit)
+
+    db.session.execute(
+        update(Message).where(Message.id.in_(ids.scalar_subquery())).values(
+            status='sending',
+            claimed_by=token,
+            locked_until=now + timedelta(seconds=OUTBOX_CLAIM_TIMEOUT_SECONDS),
+            attempts=func.coalesce(Message.attempts, 0) + 1
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+
+    rows = db.session.query(
+        Message.id, Message.lead_id, Message.content, Message.template_id, Message.template_version,
+        Message.variables, Message.attempts, Message.to_number, Lead.phone_e164, Lead.phone_number
+    ).outerjoin(Lead, Lead.id == Message.lead_id).filter(
+        Message.claimed_by == token,
+        Message.status == 'sending'
+    ).all()
+    return [{
+        'message_id': row.id,
+        'lead_id': row.lead_id,
+        'content': content,
+        'attempts': row.attempts,
+        'phone_e164': row.to_number or row.phone_e164,
+        'phone_number': row.phone_number,
+        'claimed_by': token
+    } for row, content in zip(rows, render_stored(rows))]
+
+def _outcome(result: Dict) -> Dict:
+    """Parámetros de _STORE_OUTCOME según el resultado del envío"""
+    outcome = {
+        'message_id': result['message_id'], 'token': result['claimed_by'],
+        'new_sent_at': None, 'sid': None, 'error': result['error'], 'retry_at': None
+    }
+    if not result['error']:
+        outcome.update(new_status='sent', new_sent_at=result['sent_at'], sid=result['sid'])
+    elif not result['retryable'] or result['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        outcome.update(new_status='failed')
+    else:
+        outcome.update(
+            new_status='pending',
+            retry_at=datetime.utcnow() + timedelta(seconds=backoff_delay(result['attempts']))
+        )
+    return outcome
+
+def process_batch(dispatcher: OutboundDispatcher, format_phone_number, limit: int = OUTBOX_BATCH_SIZE) -> Dict:
+    """Reclamar, enviar y registrar un lote; devuelve los totales del lote"""
+    claimed = claim_batch(limit)
+    if not claimed:
+        return {'claimed': 0, 'sent': 0, 'retrying': 0, 'failed': 0, 'lost': 0}
+
+    # El número normalizado se guarda al escribir el lead; el formateo queda para filas sin phone_e164
+    report = dispatcher.dispatch(
+        outbound_message(
+            row['lead_id'], row['phone_e164'] or format_phone_number(row['phone_number']), row['content'],
+            message_id=row['message_id'], attempts=row['attempts'], claimed_by=row['claimed_by']
+        )
+        for row in claimed
+    )
+
+    # Una fila por mensaje y un solo commit; las que perdieron el lease no se escriben
+    totals = {'claimed': len(claimed), 'sent': 0, 'retrying': 0, 'failed': 0, 'lost': 0}
+    for outcome in (_outcome(result) for result in report['results']):
+        if db.session.execute(_STORE_OUTCOME, outcome).rowcount:
+            totals[{'sent': 'sent', 'pending': 'retrying', 'failed': 'failed'}[outcome['new_status']]] += 1
+        else:
+            totals['lost'] += 1
+    db.session.commit()
+    if totals['lost']:
+        logger.warning(f"Outbox: {totals['lost']} mensajes ya no estaban reclamados por este proceso; resultado descartado")
+    for result in report['results']:
+        if result['error']:
+            logger.warning(f"Envío del mensaje {result['message_id']} falló (intento {result['attempts']}): {result['error']}")
+    return totals
+
+def run_sender(dispatcher: OutboundDispatcher, format_phone_number, batch_size: int = OUTBOX_BATCH_SIZE,
+               poll_interval: float = 2.0, once: bool = False) -> Dict:
+    """Bucle del proceso de envío: procesa lotes mientras haya trabajo y espera cuando la cola está vacía"""
+    totals = {'claimed': 0, 'sent': 0, 'retrying': 0, 'failed': 0, 'lost': 0}
+    budget = dispatcher.worst_case_seconds(batch_size)
+    if budget > OUTBOX_CLAIM_TIMEOUT_SECONDS / 2:
+        logger.warning(
+            f"Outbox: un lote de {batch_size} puede tardar hasta {budget:.0f}s y el lease dura "
+            f"{OUTBOX_CLAIM_TIMEOUT_SECONDS}s; bajar OUTBOX_BATCH_SIZE o TWILIO_HTTP_TIMEOUT_SECONDS"
+        )
+    started = time.monotonic()
+    while True:
+        try:
+            promote_due_scheduled(batch_size)
+            batch = process_batch(dispatcher, format_phone_number, batch_size)
+        except Exception as e:
+            logger.error(f"Error procesando el outbox: {e}")
+            db.session.rollback()
+            batch = {'claimed': 0}
+
+        for key, value in batch.items():
+            totals[key] += value
+        if batch['claimed']:
+            elapsed = time.monotonic() - started
+            logger.info(
+                f"Outbox: lote de {batch['claimed']} ({batch.get('sent', 0)} enviados, "
+                f"{batch.get('retrying', 0)} reintentos, {batch.get('failed', 0)} fallidos); "
+                f"{totals['sent'] / elapsed:.1f} msg/s acumulado"
+            )
+            continue
+        if once:
+            return totals
+        time.sleep(poll_interval)
+
+def start_sender_in_background(app, dispatcher: OutboundDispatcher, format_phone_number, **kwargs) -> threading.Thread:
+    """Ejecutar el bucle de envío en un hilo del proceso actual (despliegues de un solo servicio)"""
+    def run():
+        with app.app_context():
+            run_sender(dispatcher, format_phone_number, **kwargs)
+    thread = threading.Thread(target=run, name='outbox-sender', daemon=True)
+    thread.start()
+    return thread
+
+def get_outbox_stats(now: Optional[datetime] = None) -> Dict:
+    """Profundidad de la cola, antigüedad del mensaje más viejo y mensajes enviados por minuto"""
+    now = now or datetime.utcnow()
+    queued = Message.next_attempt_at.isnot(None)
+
+    depth = dict(db.session.query(Message.status, func.count(Message.id)).filter(
+        queued, Message.status.in_(['pending', 'sending'])
+    ).group_by(Message.status).all())
+    ready = db.session.query(func.count(Message.id)).filter(
+        Message.status == 'pending', Message.next_attempt_at <= now
+    ).scalar()
+    retrying = db.session.query(func.count(Message.id)).filter(
+        Message.status == 'pending', queued, Message.attempts > 0
+    ).scalar()
+    oldest = db.session.query(func.min(Message.next_attempt_at)).filter(
+        Message.status == 'pending', Message.next_attempt_at <= now
+    ).scalar()
+    failed = db.session.query(func.count(Message.id)).filter(
+        Message.status == 'failed', queued, Message.created_at >= now - timedelta(days=1)
+    ).scalar()
+
+    throughput = {}
+    for minutes in (1, 5, 60):
+        sent = db.session.query(func.count(Message.id)).filter(
+            Message.sent_at >= now - timedelta(minutes=minutes), queued
+        ).scalar()
+        throughput[f'last_{minutes}m_per_minute'] = round(sent / minutes, 2)
+
+    overdue, oldest_scheduled = db.session.query(func.count(Message.id), func.min(Message.scheduled_at)).filter(
+        Message.status == 'scheduled', Message.scheduled_at <= now
+    ).one()
+
+    return {
+        'queue_depth': depth.get('pending', 0),
+        'ready': ready,
+        'in_flight': depth.get('sending', 0),
+        'retrying': retrying,
+        'failed_last_24h': failed,
+        'oldest_ready_age_seconds': round((now - oldest).total_seconds(), 1) if oldest else 0,
+        'throughput': throughput,
+        'scheduled': {
+            'overdue': overdue,
+            'oldest_overdue_seconds': round((now - oldest_scheduled).total_seconds(), 1) if oldest_scheduled else 0,
+            'lateness_last_hour': get_scheduled_lateness(now - timedelta(hours=1))
+        }
+    }
+
+def get_scheduled_lateness(since: datetime) -> Dict:
+    """Retraso (segundos entre scheduled_at y sent_at) de los mensajes programados enviados desde `since`"""
+    lateness = (func.julianday(Message.sent_at) - func.julianday(Message.scheduled_at)) * 86400
+    base = db.session.query(lateness).filter(
+        Message.sent_at >= since,
+        Message.scheduled_at.isnot(None)
+    )
+    count, average, maximum = base.with_entities(
+        func.count(Message.id), func.avg(lateness), func.max(lateness)
+    ).one()
+
+    def percentile(fraction: float) -> Optional[float]:
+        value = base.order_by(lateness).offset(int((count - 1) * fraction)).limit(1).scalar()
+        return round(value, 1) if value is not None else None
+
+    return {
+        'count': count,
+        'avg_seconds': round(average, 1) if average is not None else None,
+        'p50_seconds': percentile(0.5) if count else None,
+        'p95_seconds': percentile(0.95) if count else None,
+        'max_seconds': round(maximum, 1) if maximum is not None else None
+    }
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Tablas de rollup diario para analytics de leads y mensajes
+Los días cerrados se leen de lead_daily_stats / message_daily_stats y el día en curso
+se agrega en vivo, de modo que una consulta por rango lee pocas filas; cuando un lead cambia
+de estado, fuente, asignación o valor, su día de creación se vuelve a agregar en el mismo flush
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, date
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import delete, event, func, insert, inspect, select, literal
+from models import db, Lead, LeadStatus, LeadSource, Message, LeadDailyStat, MessageDailyStat
+
+logger = logging.getLogger(__name__)
+
+# Días hacia atrás que la tarea nocturna vuelve a agregar (los leads cambian de estado)
+TRAILING_REFRESH_DAYS = int(os.getenv('ROLLUP_TRAILING_DAYS', 30))
+
+# Atributos de Lead que forman la clave o los valores de lead_daily_stats
+ROLLUP_LEAD_ATTRS = ('status', 'source', 'assigned_to_id', 'estimated_value')
+
+def _day_bounds(start_day: date, end_day: date) -> Tuple[datetime, datetime]:
+    return datetime.combine(start_day, datetime.min.time()), datetime.combine(end_day, datetime.min.time())
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+def _lead_rollup_select(start: datetime, end: datetime):
+    """SELECT agregado de leads creados en [start, end)"""
+    day = func.date(Lead.created_at)
+    status = func.coalesce(Lead.status, literal(LeadStatus.NUEVO, Lead.status.type))
+    source = func.coalesce(Lead.source, literal(LeadSource.OTRO, Lead.source.type))
+    assigned = func.coalesce(Lead.assigned_to_id, 0)
+    return select(
+        day, status, source, assigned,
+        func.count(Lead.id),
+        func.coalesce(func.sum(Lead.estimated_value), 0)
+    ).where(
+        Lead.created_at >= start,
+        Lead.created_at < end
+    ).group_by(day, status, source, assigned)
+
+def _message_rollup_select(start: datetime, end: datetime):
+    """SELECT agregado de mensajes creados en [start, end)"""
+    day = func.date(Message.created_at)
+    message_type = func.coalesce(Message.message_type, 'outbound')
+    status = func.coalesce(Message.status, 'pending')
+    source = func.coalesce(Lead.source, literal(LeadSource.OTRO, Lead.source.type))
+    assigned = func.coalesce(Lead.assigned_to_id, 0)
+    return select(
+        day, message_type, status, source, assigned,
+        func.count(Message.id)
+    ).select_from(Message).join(Lead, Lead.id == Message.lead_id).where(
+        Message.created_at >= start,
+        Message.created_at < end
+    ).group_by(day, message_type, status, source, assigned)
+
+def _refresh_lead_rollup(connection, start_day: date, end_day: date):
+    """Reemplazar las filas de lead_daily_stats de los días [start_day, end_day)"""
+    start, end = _day_bounds(start_day, end_day)
+    table = LeadDailyStat.__table__
+    connection.execute(delete(table).where(table.c.day >= start_day, table.c.day < end_day))
+    connection.execute(insert(table).from_select(
+        ['day', 'status', 'source', 'assigned_to_id', 'lead_count', 'estimated_value'],
+        _lead_rollup_select(start, end)
+    ))
+
+def refresh_lead_days(connection, days: Iterable[date]):
+    """Re-agregar días sueltos del rollup de leads (un lead viejo cambió de estado, fuente o asignación)"""
+    for day in sorted(set(days)):
+        _refresh_lead_rollup(connection, day, day + timedelta(days=1))
+
+def _rollup_inputs_changed(obj) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in ROLLUP_LEAD_ATTRS)
+
+@event.listens_for(db.session, 'after_flush')
+def _refresh_changed_lead_days(session, flush_context):
+    """Mantener los días cerrados al día cuando cambian sus leads (después del UPDATE/DELETE, mismo flush)"""
+    # El día en curso se agrega en vivo al leer; solo los días cerrados se leen de la tabla
+    today = datetime.utcnow().date()
+    days = set()
+    for obj in session.dirty:
+        if isinstance(obj, Lead) and obj.created_at and _rollup_inputs_changed(obj):
+            days.add(obj.created_at.date())
+    for obj in session.deleted:
+        if isinstance(obj, Lead) and obj.created_at:
+            days.add(obj.created_at.date())
+    days = {day for day in days if day < today}
+    if days:
+        refresh_lead_days(session.connection(), days)
+
+def refresh_rollups(start_day: date, end_day: date):
+    """Recalcular los rollups de los días [start_day, end_day) en una transacción"""
+    start, end = _day_bounds(start_day, end_day)
+
+    _refresh_lead_rollup(db.session.connection(), start_day, end_day)
+
+    MessageDailyStat.query.filter(MessageDailyStat.day >= start_day, MessageDailyStat.day < end_day).delete()
+    db.session.execute(insert(MessageDailyStat).from_select(
+        ['day', 'message_type', 'status', 'source', 'assigned_to_id', 'message_count'],
+        _message_rollup_select(start, end)
+    ))
+
+    db.session.commit()
+
+def refresh_recent_rollups(days: int = 1):
+    """Tarea programada: actualizar hoy y los N días anteriores"""
+    today = datetime.utcnow().date()
+    try:
+        refresh_rollups(today - timedelta(days=days), today + timedelta(days=1))
+        logger.info(f"Rollups actualizados: últimos {days + 1} días")
+    except Exception as e:
+        logger.error(f"Error actualizando rollups: {e}")
+        db.session.rollback()
+
+def refresh_trailing_rollups():
+    """Tarea nocturna: re-agregar la ventana reciente (red de seguridad para escrituras fuera del ORM)"""
+    refresh_recent_rollups(TRAILING_REFRESH_DAYS)
+
+def backfill_rollups(since: Optional[date] = None, chunk_days: int = 30) -> int:
+    """Reconstruir el histórico de rollups en bloques de chunk_days días; devuelve los bloques procesados"""
+    if since is None:
+        first_lead = db.session.query(func.min(Lead.created_at)).scalar()
+        first_message = db.session.query(func.min(Message.created_at)).scalar()
+        candidates = [_as_date(value) for value in (first_lead, first_message) if value]
+        if not candidates:
+            return 0
+        since = min(candidates)
+
+    end_day = datetime.utcnow().date() + timedelta(days=1)
+    chunks = 0
+    current = since
+    while current < end_day:
+        chunk_end = min(current + timedelta(days=chunk_days), end_day)
+        refresh_rollups(current, chunk_end)
+        chunks += 1
+        logger.info(f"Rollups reconstruidos: {current} → {chunk_end}")
+        current = chunk_end
+    return chunks
+
+def ensure_rollups():
+    """Construir el histórico si la tabla de rollups está vacía y ya hay datos"""
+    if not db.session.query(LeadDailyStat.day).first() and db.session.query(Lead.id).first():
+        backfill_rollups()
+
+def lead_rollup_rows(start_day: date) -> List[Tuple]:
+    """Filas (día, estado, fuente, asignado, cantidad) desde start_day: rollups + día en curso en vivo"""
+    today = datetime.utcnow().date()
+    rows = [
+        (_as_date(day), status, source, assigned, count)
+        for day, status, source, assigned, count in db.session.query(
+            LeadDailyStat.day, LeadDailyStat.status, LeadDailyStat.source,
+            LeadDailyStat.assigned_to_id, LeadDailyStat.lead_count
+        ).filter(LeadDailyStat.day >= start_day, LeadDailyStat.day < today)
+    ]
+
+    if start_day <= today:
+        assigned = func.coalesce(Lead.assigned_to_id, 0)
+        live = db.session.query(Lead.status, Lead.source, assigned, func.count(Lead.id)).filter(
+            Lead.created_at >= datetime.combine(today, datetime.min.time())
+        ).group_by(Lead.status, Lead.source, assigned)
+        rows += [(today, status, source, assigned_id, count) for status, source, assigned_id, count in live]
+    return rows
+
+def count_messages_since(start_day: date, message_type: str = 'outbound') -> int:
+    """Mensajes de un tipo creados desde start_day (rollups + día en curso en vivo)"""
+    today = datetime.utcnow().date()
+    closed = db.session.query(func.coalesce(func.sum(MessageDailyStat.message_count), 0)).filter(
+        MessageDailyStat.day >= start_day,
+        MessageDailyStat.day < today,
+        MessageDailyStat.message_type == message_type
+    ).scalar()
+    live = Message.query.filter(
+        Message.created_at >= datetime.combine(max(start_day, today), datetime.min.time()),
+        Message.message_type == message_type
+    ).count()
+    return int(closed or 0) + live
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Programador de tareas con líder único para Nexa Lead Manager
+Un solo proceso (el que tiene el lease en scheduler_lease) ejecuta las tareas;
+los trabajos se guardan en la base de datos (SQLAlchemyJobStore) y sobreviven a reinicios
+"""
+
+import os
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from sqlalchemy import text
+from models import db, SchedulerLease
+from lead_manager import lead_manager
+from rollups import refresh_recent_rollups, refresh_trailing_rollups
+from lead_scores import refresh_queued_scores, refresh_all_scores
+from lead_import import resume_stale_import_jobs
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'scheduler'
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 60))
+SCHEDULER_MISFIRE_GRACE_SECONDS = int(os.getenv('SCHEDULER_MISFIRE_GRACE_SECONDS', 3600))
+JOBS_TABLE = 'apscheduler_jobs'
+
+# Tareas por nombre: el job store guarda solo la referencia textual y el nombre
+TASKS = {
+    # Recordatorios: planificación de turnos y envío continuo de los turnos vencidos
+    'plan_follow_ups': lambda: lead_manager.plan_follow_up_slots(),
+    'follow_up_reminders': lambda: lead_manager.send_follow_up_reminders(),
+    'weekly_summary': lambda: lead_manager.send_weekly_summary(),
+    # Rollups de analytics: día en curso cada 15 minutos y ventana reciente de madrugada
+    'refresh_rollups': refresh_recent_rollups,
+    'refresh_trailing_rollups': refresh_trailing_rollups,
+    # Campañas programadas y campañas interrumpidas (worker reciclado o caído)
+    'run_due_campaigns': lambda: lead_manager.run_due_campaigns(),
+    'resume_interrupted_campaigns': lambda: lead_manager.resume_interrupted_campaigns(),
+    # Importaciones CSV cuyo hilo murió con el worker: se reanudan desde la última fila confirmada
+    'resume_import_jobs': resume_stale_import_jobs,
+    # Scores de conversión: leads encolados cada minuto y barrido nocturno por el decaimiento temporal
+    'refresh_lead_scores': refresh_queued_scores,
+    'sweep_lead_scores': refresh_all_scores,
+}
+
+def _job_triggers():
+    return {
+        'plan_follow_ups': IntervalTrigger(minutes=15),
+        'follow_up_reminders': IntervalTrigger(minutes=1),
+        'weekly_summary': CronTrigger(day_of_week='mon', hour=8, minute=0),
+        'refresh_rollups': IntervalTrigger(minutes=15),
+        'refresh_trailing_rollups': CronTrigger(hour=2, minute=30),
+        'run_due_campaigns': IntervalTrigger(minutes=1),
+        'resume_interrupted_campaigns': IntervalTrigger(minutes=5),
+        'resume_import_jobs': IntervalTrigger(minutes=5),
+        'refresh_lead_scores': IntervalTrigger(minutes=1),
+        'sweep_lead_scores': CronTrigger(hour=3, minute=0),
+    }
+
+_app = None
+
+def run_task(name: str):
+    """Punto de entrada de todos los trabajos programados (ejecuta la tarea en contexto de app)"""
+    with _app.app_context():
+        try:
+            TASKS[name]()
+        finally:
+            db.session.remove()
+
+_UPSERT_LEASE_SQL = text("""
+    INSERT INTO scheduler_lease (name, owner, expires_at) VALUES (:name, :owner, :expires_at)
+    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE scheduler_lease.owner = excluded.owner OR scheduler_lease.expires_at < :now
+""")
+
+def acquire_lease(owner: str, ttl: int = SCHEDULER_LEASE_SECONDS) -> bool:
+    """Tomar o renovar el lease de líder; True si este proceso es el líder"""
+    now = datetime.utcnow()
+    try:
+        db.session.execute(_UPSERT_LEASE_SQL, {
+            'name': LEASE_NAME, 'owner': owner, 'expires_at': now + timedelta(seconds=ttl), 'now': now
+        })
+        current = db.session.query(SchedulerLease.owner).filter_by(name=LEASE_NAME).scalar()
+        db.session.commit()
+        return current == owner
+    except Exception as e:
+        logger.error(f"Error renovando el lease del scheduler: {e}")
+        db.session.rollback()
+        return False
+
+def release_lease(owner: str):
+    """Liberar el lease para que otro proceso tome el liderazgo sin esperar a que venza"""
+    SchedulerLease.query.filter_by(name=LEASE_NAME, owner=owner).delete()
+    db.session.commit()
+
+# Locks de archivo tomados por este proceso (se liberan al cerrar el archivo o al terminar el proceso)
+_process_locks = {}
+
+def start_when_lock_acquired(lock_path: str, start) -> threading.Thread:
+    """Esperar en un hilo el lock exclusivo de lock_path y llamar a start() al obtenerlo
+
+    Entre los workers de gunicorn de una máquina solo el dueño del lock arranca los bucles embebidos;
+    los demás quedan esperando y, cuando ese worker se recicla (max_requests), otro toma el relevo
+    """
+    import fcntl
+
+    def wait():
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        _process_locks[lock_path] = lock_file
+        logger.info(f"Lock {lock_path} tomado por el proceso {os.getpid()}")
+        start()
+    thread = threading.Thread(target=wait, name='embedded-workers-lock', daemon=True)
+    thread.start()
+    return thread
+
+def release_process_lock(lock_path: str):
+    lock_file = _process_locks.pop(lock_path, None)
+    if lock_file:
+        lock_file.close()
+
+def register_jobs(scheduler: BackgroundScheduler):
+    """Registrar los trabajos; los que ya existen con el mismo trigger conservan su próxima ejecución"""
+    for name, trigger in _job_triggers().items():
+        existing = scheduler.get_job(name)
+        if existing and str(existing.trigger) == str(trigger):
+            continue
+        scheduler.add_job(
+            'scheduler:run_task', trigger, args=[name], id=name, name=name, replace_existing=True
+        )
+    for job in scheduler.get_jobs():
+        if job.id not in TASKS:
+            job.remove()
+
+class LeaderScheduler:
+    """Elección de líder por lease en la base de datos; solo el líder arranca APScheduler"""
+
+    def __init__(self, app, lease_seconds: int = SCHEDULER_LEASE_SECONDS):
+        global _app
+        _app = app
+        self.app = app
+        self.lease_seconds = lease_seconds
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.scheduler = None
+        self.stop_event = threading.Event()
+
+    def _start_jobs(self):
+        self.scheduler = BackgroundScheduler(
+            jobstores={'default': SQLAlchemyJobStore(engine=db.engine, tablename=JOBS_TABLE)},
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_SECONDS}
+        )
+        self.scheduler.start(paused=True)
+        register_jobs(self.scheduler)
+        self.scheduler.resume()
+        logger.info(f"Scheduler líder: {self.owner} ({len(self.scheduler.get_jobs())} trabajos)")
+
+    def _stop_jobs(self):
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.scheduler is not None
+
+    def tick(self):
+        """Renovar el lease y arrancar o detener los trabajos según el resultado"""
+        with self.app.app_context():
+            leader = acquire_lease(self.owner, self.lease_seconds)
+            if leader and not self.is_leader:
+                self._start_jobs()
+            elif not leader and self.is_leader:
+                logger.warning(f"Lease del scheduler perdido por {self.owner}; se detienen los trabajos")
+                self._stop_jobs()
+            db.session.remove()
+
+    def run_forever(self):
+        """Bucle de elección: renueva el lease cada tercio de su duración"""
+        interval = max(1, self.lease_seconds // 3)
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Error en el scheduler: {e}")
+                self._stop_jobs()
+            if self.stop_event.wait(interval):
+                break
+
+    def start_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run_forever, name='scheduler-leader', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stop_event.set()
+        self._stop_jobs()
+        with self.app.app_context():
+            release_lease(self.owner)
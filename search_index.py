@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Índice de búsqueda full-text (SQLite FTS5) para leads
+Tabla virtual lead_fts sincronizada con la tabla lead mediante triggers
+"""
+
+import logging
+import re
+from sqlalchemy import text, select, table, column, literal_column
+from models import db, Lead, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'lead_fts'
+FTS_COLUMNS = ['name', 'company', 'email', 'phone_number', 'notes', 'project_type', 'location']
+# Pesos de bm25 en el mismo orden que FTS_COLUMNS (mayor peso = más relevante)
+FTS_WEIGHTS = [10.0, 5.0, 5.0, 5.0, 1.0, 2.0, 2.0]
+
+# Búsquedas con al menos estos dígitos y sin letras se tratan también como teléfono
+PHONE_SEARCH_MIN_DIGITS = 4
+_PHONE_SEARCH_RE = re.compile(r'^[\d\s+().-]+$')
+
+_fts_available = None
+
+def _columns(prefix: str = '') -> str:
+    return ', '.join(f'{prefix}{name}' for name in FTS_COLUMNS)
+
+def _create_statements():
+    """DDL de la tabla virtual y los triggers de sincronización"""
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            {_columns()},
+            content='lead', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON lead BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, {_columns()}) VALUES (new.id, {_columns('new.')});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON lead BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns()}) VALUES ('delete', old.id, {_columns('old.')});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {_columns()} ON lead BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns()}) VALUES ('delete', old.id, {_columns('old.')});
+            INSERT INTO {FTS_TABLE}(rowid, {_columns()}) VALUES (new.id, {_columns('new.')});
+        END""",
+    ]
+
+def _fts_table_exists(connection) -> bool:
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}
+    ).first() is not None
+
+def ensure_search_index() -> bool:
+    """Crear el índice FTS5 y sus triggers si el motor lo soporta (idempotente)"""
+    global _fts_available
+    if db.engine.dialect.name != 'sqlite':
+        _fts_available = False
+        return False
+
+    try:
+        with db.engine.begin() as connection:
+            created = not _fts_table_exists(connection)
+            for statement in _create_statements():
+                connection.execute(text(statement))
+            if created:
+                # Indexar los leads existentes
+                connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+                logger.info("Índice de búsqueda FTS5 creado")
+        _fts_available = True
+    except Exception as e:
+        logger.warning(f"FTS5 no disponible, se usará búsqueda LIKE: {e}")
+        _fts_available = False
+    return _fts_available
+
+def rebuild_search_index():
+    """Reconstruir el índice FTS5 completo desde la tabla lead"""
+    if not search_index_available():
+        return False
+    with db.engine.begin() as connection:
+        connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    return True
+
+def search_index_available() -> bool:
+    """Indicar si la tabla FTS5 existe en la base actual"""
+    global _fts_available
+    if _fts_available is None:
+        try:
+            _fts_available = db.engine.dialect.name == 'sqlite' and _fts_table_exists(db.session.connection())
+        except Exception:
+            _fts_available = False
+    return _fts_available
+
+def build_match_query(term: str) -> str:
+    """Convertir el texto del buscador en una consulta MATCH por prefijos ("jua"* "pere"*)"""
+    tokens = re.findall(r'\w+', term or '', re.UNICODE)
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+def build_phone_filter(term: str):
+    """Condición sobre phone_e164 si el texto parece un teléfono (parcial o en formato local); None si no"""
+    if not term or not _PHONE_SEARCH_RE.match(term.strip()):
+        return None
+    digits = re.sub(r'\D', '', term).lstrip('0')
+    if len(digits) < PHONE_SEARCH_MIN_DIGITS:
+        return None
+    # Subcadena de dígitos: "5551234", "11 5555 1234" o "011 5555-1234" encuentran +5491155551234
+    conditions = [Lead.phone_e164.contains(digits, autoescape=True)]
+    phone_e164 = normalize_phone(term)
+    if phone_e164:
+        conditions.append(Lead.phone_e164 == phone_e164)
+    return db.or_(*conditions)
+
+def apply_lead_search(query, search: str):
+    """Filtrar una consulta de leads por texto; devuelve (query, columna de ranking o None)"""
+    match_query = build_match_query(search)
+    phone_filter = build_phone_filter(search)
+    if match_query and search_index_available():
+        weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+        fts = table(FTS_TABLE, column('rowid'))
+        matches = select(
+            fts.c.rowid.label('lead_id'),
+            literal_column(f'bm25({FTS_TABLE}, {weights})').label('rank')
+        ).select_from(fts).where(literal_column(FTS_TABLE).op('MATCH')(match_query)).subquery()
+        if phone_filter is None:
+            query = query.join(matches, matches.c.lead_id == Lead.id)
+        else:
+            # Los tokens FTS5 son prefijos: un número parcial o con otro formato solo coincide por phone_e164
+            query = query.outerjoin(matches, matches.c.lead_id == Lead.id).filter(
+                db.or_(matches.c.lead_id.isnot(None), phone_filter)
+            )
+        return query, matches.c.rank
+
+    # Fallback sin FTS5: búsqueda por subcadena
+    conditions = [
+        Lead.name.contains(search),
+        Lead.phone_number.contains(search),
+        Lead.email.contains(search),
+        Lead.company.contains(search)
+    ]
+    if phone_filter is not None:
+        conditions.append(phone_filter)
+    return query.filter(db.or_(*conditions)), None
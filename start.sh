@@ -0,0 +1,17 @@
+#!/bin/bash
+# Arranque del servicio web en Render: los procesos del Procfile en el mismo contenedor.
+# La base SQLite vive en el disco de este servicio, así que scheduler y outbox corren aquí
+# como procesos aparte (no dentro de los workers de gunicorn) y se reinician si terminan.
+
+run_forever() {
+    while true; do
+        "$@"
+        echo "⚠️ $* terminó con código $?; reiniciando en 5s..."
+        sleep 5
+    done
+}
+
+run_forever flask --app app scheduler &
+run_forever flask --app app outbox-worker &
+
+exec gunicorn app:app
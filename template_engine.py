@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Motor de plantillas compiladas para Nexa Lead Manager
+Cada plantilla se analiza una sola vez en una lista de segmentos (literales y variables)
+y se guarda en caché por id y versión; el render de un lote de leads reutiliza la misma compilación
+"""
+
+import re
+import json
+import threading
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+WEBSITE_URL = 'https://nexaconstructora.com.ar'
+
+# Variables que el sistema completa a partir del lead (además de las declaradas en la plantilla)
+LEAD_VARIABLES = ('name', 'company', 'phone', 'email', 'date', 'website', 'days_since_contact')
+
+class CompiledTemplate:
+    """Plantilla analizada: los índices pares de `segments` son literales y los impares nombres de variables"""
+
+    __slots__ = ('source', 'segments', 'variables', '_pattern')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.segments = PLACEHOLDER_RE.split(source)
+        self.variables = frozenset(self.segments[1::2])
+
+    def unknown_variables(self, declared: Iterable[str] = ()) -> List[str]:
+        """Variables usadas en la plantilla que no completa el sistema ni están declaradas"""
+        known = set(LEAD_VARIABLES) | set(declared)
+        return sorted(self.variables - known)
+
+    def render(self, values: Dict) -> str:
+        """Completar la plantilla; las variables sin valor quedan tal cual en el texto"""
+        parts = self.segments[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = str(values[name]) if name in values else '{' + name + '}'
+        return ''.join(parts)
+
+    def render_many(self, rows: Iterable[Dict], extra: Dict = None) -> List[str]:
+        """Completar la plantilla para muchos leads en una pasada (`extra` se aplica a todos)"""
+        if len(self.segments) == 1:
+            return [self.source for _ in rows]
+        if extra:
+            return [self.render(dict(row, **extra)) for row in rows]
+        return [self.render(row) for row in rows]
+
+    def pack(self, values: Dict) -> str:
+        """JSON compacto con solo las variables que usa la plantilla (lo que se guarda por mensaje)"""
+        used = {name: values[name] for name in sorted(self.variables) if name in values}
+        return json.dumps(used, ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def match(self, text: str) -> Optional[Dict]:
+        """Recuperar las variables de un texto ya renderizado (None si no sale de esta plantilla)"""
+        pattern = getattr(self, '_pattern', None)
+        if pattern is None:
+            groups, parts = {}, []
+            for i, segment in enumerate(self.segments):
+                if i % 2 == 0:
+                    parts.append(re.escape(segment))
+                elif segment in groups:
+                    parts.append(f'(?P={groups[segment]})')
+                else:
+                    groups[segment] = f'v{len(groups)}'
+                    parts.append(f'(?P<{groups[segment]}>.*?)')
+            pattern = self._pattern = (re.compile(''.join(parts), re.DOTALL), groups)
+        regex, groups = pattern
+        found = regex.fullmatch(text)
+        if not found:
+            return None
+        return {name: found.group(group) for name, group in groups.items()}
+
+@lru_cache(maxsize=512)
+def compile_template(content: str) -> CompiledTemplate:
+    """Compilar un texto de plantilla (caché por contenido para textos sin id)"""
+    return CompiledTemplate(content or '')
+
+_compiled: Dict[int, tuple] = {}
+_compiled_lock = threading.Lock()
+
+def get_compiled(template) -> CompiledTemplate:
+    """Plantilla compilada de un MessageTemplate, en caché por id y versión"""
+    key = template.version or 0
+    cached = _compiled.get(template.id)
+    if cached and cached[0] == key:
+        return cached[1]
+    compiled = compile_template(template.content)
+    with _compiled_lock:
+        _compiled[template.id] = (key, compiled)
+    return compiled
+
+def forget_compiled(template_id: int):
+    """Quitar de la caché una plantilla borrada"""
+    with _compiled_lock:
+        _compiled.pop(template_id, None)
+
+def declared_variables(variables: Optional[str]) -> Dict:
+    """Variables declaradas en el JSON de la plantilla (vacío si no es JSON válido)"""
+    try:
+        parsed = json.loads(variables) if variables else {}
+    except (TypeError, ValueError):
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def sample_values(variables: Optional[str]) -> Dict:
+    """Valores de ejemplo para previsualizar las variables propias de la plantilla"""
+    return {
+        name: value for name, value in declared_variables(variables).items()
+        if name not in LEAD_VARIABLES
+    }
+
+def validate_template(content: str, variables: Optional[str] = None) -> List[str]:
+    """Variables desconocidas de un contenido de plantilla (lista vacía si es válido)"""
+    return compile_template(content).unknown_variables(declared_variables(variables))
+
+def lead_variables(lead, today: str = None) -> Dict:
+    """Valores estándar de un lead para las plantillas (acepta modelos o filas con esos atributos)"""
+    return {
+        'name': lead.name or 'estimado cliente',
+        'company': lead.company or 'tu empresa',
+        'phone': lead.phone_number,
+        'email': lead.email or 'tu email',
+        'date': today or datetime.now().strftime('%d/%m/%Y'),
+        'website': WEBSITE_URL
+    }
+
+def render_for_leads(compiled: CompiledTemplate, leads: Iterable, extra: Dict = None) -> List[str]:
+    """Render de una plantilla compilada para una lista de leads, calculando la fecha una sola vez"""
+    today = datetime.now().strftime('%d/%m/%Y')
+    return compiled.render_many((lead_variables(lead, today) for lead in leads), extra)
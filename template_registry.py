@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Registro en memoria de plantillas de mensaje para Nexa Lead Manager
+Cada proceso guarda una copia de las plantillas indexada por id, nombre y categoría;
+un contador de versión en stat_counter (incrementado en la misma transacción que cualquier
+alta, edición o baja de plantillas) se consulta una vez por request para invalidar la copia.
+Los mensajes de plantilla guardan versión y variables; el texto se renderiza al leerlos
+"""
+
+import json
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from itertools import chain
+from typing import Dict, Iterable, List, Optional
+from flask import g, has_app_context
+from sqlalchemy import event, inspect, text, tuple_, update
+from models import db, Message, MessageTemplate, MessageTemplateVersion
+from counters import apply_deltas, read_counters, TEMPLATES_VERSION_KEY
+from template_engine import CompiledTemplate, compile_template, forget_compiled, get_compiled
+
+logger = logging.getLogger(__name__)
+
+# Copia inmutable de una fila de message_template (segura de compartir entre hilos y requests)
+TemplateSnapshot = namedtuple('TemplateSnapshot', [
+    'id', 'name', 'category', 'content', 'variables', 'is_active', 'created_at', 'version'
+])
+
+class TemplateRegistry:
+    """Plantillas por id, nombre y categoría; se recargan solo cuando cambia el contador de versión"""
+
+    def __init__(self):
+        self.version = None
+        self.by_id: Dict[int, TemplateSnapshot] = {}
+        self.by_name: Dict[str, TemplateSnapshot] = {}
+        self.by_category: Dict[str, TemplateSnapshot] = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """Forzar la recarga en la próxima consulta"""
+        self.version = None
+
+    def _load(self, version: int):
+        templates = [
+            TemplateSnapshot(*row) for row in db.session.query(
+                MessageTemplate.id, MessageTemplate.name, MessageTemplate.category, MessageTemplate.content,
+                MessageTemplate.variables, MessageTemplate.is_active, MessageTemplate.created_at,
+                MessageTemplate.version
+            ).order_by(MessageTemplate.id)
+        ]
+        by_name, by_category = {}, {}
+        # Igual que filter_by(..., is_active=True).first(): gana la plantilla activa de menor id
+        for template in templates:
+            if template.is_active:
+                by_name.setdefault(template.name, template)
+                by_category.setdefault(template.category, template)
+        self.by_id = {template.id: template for template in templates}
+        self.by_name = by_name
+        self.by_category = by_category
+        self.version = version
+        logger.info(f"Registro de plantillas cargado: {len(templates)} plantillas (versión {version})")
+
+    def refresh(self):
+        """Comparar el contador de versión (una vez por request o contexto) y recargar si cambió"""
+        if has_app_context():
+            if g.get('templates_checked'):
+                return
+            g.templates_checked = True
+        version = read_counters([TEMPLATES_VERSION_KEY])[TEMPLATES_VERSION_KEY]
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self._load(version)
+
+    def get(self, template_id: int) -> Optional[TemplateSnapshot]:
+        self.refresh()
+        return self.by_id.get(template_id)
+
+    def get_by_name(self, name: str) -> Optional[TemplateSnapshot]:
+        """Plantilla activa con ese nombre"""
+        self.refresh()
+        return self.by_name.get(name)
+
+    def get_by_category(self, category: str) -> Optional[TemplateSnapshot]:
+        """Plantilla activa de esa categoría"""
+        self.refresh()
+        return self.by_category.get(category)
+
+    def active(self) -> List[TemplateSnapshot]:
+        self.refresh()
+        return [template for template in self.by_id.values() if template.is_active]
+
+template_registry = TemplateRegistry()
+
+@event.listens_for(db.session, 'before_flush')
+def _bump_templates_version(session, flush_context, instances):
+    """Incrementar el contador de versión en la misma transacción que el cambio de plantillas"""
+    changed = False
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, MessageTemplate):
+            continue
+        if obj in session.deleted and obj.id is not None:
+            session.info.setdefault('templates_deleted', set()).add(obj.id)
+        if obj in session.dirty:
+            if not session.is_modified(obj):
+                continue
+            # Cada contenido nuevo es una versión nueva: los mensajes guardados apuntan a (id, versión)
+            if inspect(obj).attrs.content.history.has_changes() and not inspect(obj).attrs.version.history.has_changes():
+                obj.version = (obj.version or 1) + 1
+        changed = True
+    if changed:
+        apply_deltas(session.connection(), {TEMPLATES_VERSION_KEY: 1})
+        session.info['templates_changed'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_after_commit(session):
+    """El proceso que hizo el cambio no espera a la próxima request para verlo"""
+    if session.info.pop('templates_changed', False):
+        template_registry.invalidate()
+        if has_app_context():
+            g.pop('templates_checked', None)
+    deleted = session.info.pop('templates_deleted', None)
+    if deleted:
+        forget_template_versions(deleted)
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('templates_changed', None)
+    session.info.pop('templates_deleted', None)
+
+# Versiones de plantilla referenciadas por los mensajes (contenido inmutable, se guarda una vez)
+_INSERT_VERSION_SQL = text("""
+    INSERT INTO message_template_version (template_id, version, content, created_at)
+    VALUES (:template_id, :version, :content, :created_at)
+    ON CONFLICT (template_id, version) DO NOTHING
+""")
+
+_versions: Dict[tuple, CompiledTemplate] = {}
+
+class TemplateVersionConflict(Exception):
+    """La versión de la plantilla ya está guardada con otro contenido"""
+
+def forget_template_versions(template_ids: Iterable[int]):
+    """Quitar de las cachés del proceso las versiones de plantillas borradas"""
+    template_ids = set(template_ids)
+    for key in [key for key in list(_versions) if key[0] in template_ids]:
+        _versions.pop(key, None)
+    for template_id in template_ids:
+        forget_compiled(template_id)
+
+def store_template_version(template):
+    """Guardar el contenido de la versión actual de la plantilla (sin commit; idempotente)"""
+    key = (template.id, template.version or 0)
+    inserted = db.session.execute(_INSERT_VERSION_SQL, {
+        'template_id': key[0],
+        'version': key[1],
+        'content': template.content,
+        'created_at': datetime.utcnow()
+    }).rowcount
+    if inserted:
+        return
+    # Ya existía: solo vale si es el mismo texto; si no, los mensajes nuevos se renderizarían con el viejo
+    stored = _versions.get(key)
+    if stored is None:
+        content = db.session.query(MessageTemplateVersion.content).filter_by(
+            template_id=key[0], version=key[1]
+        ).scalar()
+        stored = _versions[key] = compile_template(content)
+    if stored.source != (template.content or ''):
+        raise TemplateVersionConflict(
+            f"La versión {key[1]} de la plantilla {key[0]} ya está guardada con otro contenido"
+        )
+
+def template_message_columns(template, values: Dict) -> Dict:
+    """Columnas de un mensaje de plantilla: referencia a la versión y variables, sin el texto completo"""
+    return {
+        'content': '',
+        'template_id': template.id,
+        'template_version': template.version or 0,
+        'variables': get_compiled(template).pack(values)
+    }
+
+def _compiled_versions(keys: Iterable[tuple]) -> Dict[tuple, CompiledTemplate]:
+    """Plantillas compiladas por (id, versión), cargando de una vez las que no están en memoria"""
+    keys = set(keys)
+    missing = keys - _versions.keys()
+    if missing:
+        for template_id, version, content in db.session.query(
+            MessageTemplateVersion.template_id, MessageTemplateVersion.version, MessageTemplateVersion.content
+        ).filter(tuple_(MessageTemplateVersion.template_id, MessageTemplateVersion.version).in_(missing)):
+            _versions[(template_id, version)] = compile_template(content)
+    return {key: _versions[key] for key in keys if key in _versions}
+
+def render_stored(messages: Iterable) -> List[str]:
+    """Texto de cada mensaje: el guardado (mensajes sueltos) o el render de su versión de plantilla"""
+    messages = list(messages)
+    compiled = _compiled_versions(
+        (message.template_id, message.template_version) for message in messages if message.template_id is not None
+    )
+    contents = []
+    for message in messages:
+        template = compiled.get((message.template_id, message.template_version))
+        if template is None:
+            contents.append(message.content)
+        else:
+            contents.append(template.render(json.loads(message.variables or '{}')))
+    return contents
+
+def compact_template_messages(chunk_size: int = 1000) -> Dict:
+    """Migrar mensajes salientes guardados con el texto completo a referencia de plantilla + variables"""
+    # Solo se compactan los textos que la versión actual de alguna plantilla reproduce exactamente
+    # y que ocupan más que sus variables; un commit por bloque
+    template_registry.refresh()
+    templates = list(template_registry.by_id.values())
+    for template in templates:
+        store_template_version(template)
+    db.session.commit()
+    # Plantillas con más texto fijo primero: descartan antes y son las más específicas
+    candidates = sorted(
+        ((template, get_compiled(template)) for template in templates),
+        key=lambda pair: -sum(len(segment) for segment in pair[1].segments[::2])
+    )
+    totals = {'scanned': 0, 'compacted': 0, 'bytes_saved': 0}
+    last_id = 0
+    while True:
+        rows = db.session.query(Message.id, Message.content).filter(
+            Message.id > last_id,
+            Message.template_id.is_(None),
+            Message.message_type == 'outbound',
+            Message.content != ''
+        ).order_by(Message.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        totals['scanned'] += len(rows)
+
+        updates = []
+        for row in rows:
+            for template, compiled in candidates:
+                if not (row.content.startswith(compiled.segments[0]) and row.content.endswith(compiled.segments[-1])):
+                    continue
+                values = compiled.match(row.content)
+                if values is None:
+                    continue
+                columns = template_message_columns(template, values)
+                if len(columns['variables'].encode()) < len(row.content.encode()):
+                    updates.append(dict(columns, id=row.id))
+                    totals['bytes_saved'] += len(row.content.encode()) - len(columns['variables'].encode())
+                break
+        if updates:
+            db.session.execute(update(Message), updates)
+        db.session.commit()
+        totals['compacted'] += len(updates)
+        logger.info(f"Compactación de mensajes: {totals['compacted']}/{totals['scanned']} hasta el id {last_id}")
+    return totals
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la ejecución de campañas por bloques, con inserts masivos y checkpoint reanudable
+"""
+
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import event
+from models import db, LeadStatus, Message, Interaction, Campaign, CampaignResult, CampaignRun, MessageTemplate
+from dispatcher import OutboundDispatcher, build_twilio_client
+from fake_twilio import FakeTwilioServer
+from lead_manager import CAMPAIGN_RUN_MAX_RESUMES, CAMPAIGN_RUN_STALE_SECONDS, NexaLeadManager
+from counters import get_dashboard_counters
+from template_registry import render_stored
+
+@pytest.fixture
+def twilio_server():
+    with FakeTwilioServer() as server:
+        yield server
+
+@pytest.fixture
+def manager(app, twilio_server):
+    manager = NexaLeadManager(app)
+    client = build_twilio_client('ACtest', 'token', pool_size=4, base_url=twilio_server.base_url)
+    manager.dispatcher = OutboundDispatcher(client, '+5491100000000', workers=4, rate=0)
+    return manager
+
+@pytest.fixture
+def make_campaign(app):
+    def make(content='Hola {name} de {company}', **values):
+        template = MessageTemplate(name='Promo', category='offer', content=content)
+        db.session.add(template)
+        db.session.commit()
+        campaign = Campaign(name='Promo', template_id=template.id, **values)
+        db.session.add(campaign)
+        db.session.commit()
+        return campaign
+    return make
+
+def _count_statements(callback):
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        result = callback()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return result, len(statements)
+
+def test_campaign_sends_to_targeted_leads_and_records_everything(manager, make_lead, make_campaign, twilio_server):
+    targeted = [make_lead(status=LeadStatus.INTERESADO, company=f'Empresa {i}') for i in range(5)]
+    make_lead(status=LeadStatus.PERDIDO)
+    campaign = make_campaign(target_status=LeadStatus.INTERESADO)
+
+    totals = manager.execute_campaign(campaign.id, chunk_size=2)
+
+    assert (totals['processed'], totals['sent'], totals['failed']) == (5, 5, 0)
+    assert [chunk['leads'] for chunk in totals['chunks']] == [2, 2, 1]
+    assert len(twilio_server.received) == 5
+    assert CampaignResult.query.filter_by(campaign_id=campaign.id, status='sent').count() == 5
+    assert Interaction.query.filter_by(interaction_type='campaign_message_sent').count() == 5
+
+    messages = Message.query.order_by(Message.lead_id).all()
+    assert render_stored(messages) == [f'Hola {lead.name} de {lead.company}' for lead in targeted]
+    for lead in targeted:
+        db.session.refresh(lead)
+        assert lead.last_contact_date is not None
+        assert (lead.message_count, lead.interaction_count) == (1, 1)
+    assert get_dashboard_counters()['messages_today'] == 5
+
+def test_statements_per_chunk_do_not_grow_with_the_number_of_leads(manager, make_lead, make_campaign):
+    for _ in range(3):
+        make_lead()
+    _, small = _count_statements(lambda: manager.execute_campaign(make_campaign().id, chunk_size=50))
+    for _ in range(30):
+        make_lead()
+    _, large = _count_statements(lambda: manager.execute_campaign(make_campaign().id, chunk_size=50))
+
+    # Sin N+1: el mismo número de sentencias para 3 o 33 leads en un bloque
+    assert large == small
+
+def test_failed_sends_are_counted_but_not_stored(app, make_lead, make_campaign):
+    make_lead()
+    with FakeTwilioServer(failure_rate=1.0) as server:
+        manager = NexaLeadManager(app)
+        client = build_twilio_client('ACtest', 'token', base_url=server.base_url)
+        manager.dispatcher = OutboundDispatcher(client, '+5491100000000', rate=0)
+        totals = manager.execute_campaign(make_campaign().id)
+
+    assert (totals['sent'], totals['failed']) == (0, 1)
+    assert Message.query.count() == 0 and CampaignResult.query.count() == 0
+
+def _interrupted_run(campaign, last_lead_id, heartbeat_age_seconds):
+    run = CampaignRun(
+        campaign_id=campaign.id, status='running', last_lead_id=last_lead_id, processed=0, sent=0, failed=0,
+        resumed_count=0, owner='otro-host:1:dead', started_at=datetime.utcnow(),
+        heartbeat_at=datetime.utcnow() - timedelta(seconds=heartbeat_age_seconds)
+    )
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+def test_interrupted_run_resumes_after_its_checkpoint(manager, make_lead, make_campaign, twilio_server):
+    leads = [make_lead() for _ in range(5)]
+    campaign = make_campaign()
+    run = _interrupted_run(campaign, leads[1].id, CAMPAIGN_RUN_STALE_SECONDS + 60)
+
+    manager.resume_interrupted_campaigns()
+
+    db.session.refresh(run)
+    assert (run.status, run.resumed_count, run.processed, run.last_lead_id) == ('completed', 1, 3, leads[-1].id)
+    # Lo confirmado antes de la interrupción no se reenvía
+    assert sorted(message['to'] for message in twilio_server.received) == sorted(
+        f'whatsapp:{lead.phone_e164}' for lead in leads[2:]
+    )
+
+def test_run_with_a_live_heartbeat_is_not_taken_over(manager, make_lead, make_campaign, twilio_server):
+    make_lead()
+    campaign = make_campaign()
+    run = _interrupted_run(campaign, 0, heartbeat_age_seconds=5)
+
+    assert manager.execute_campaign(campaign.id) is None
+    manager.resume_interrupted_campaigns()
+
+    db.session.refresh(run)
+    assert (run.status, run.owner, run.resumed_count) == ('running', 'otro-host:1:dead', 0)
+    assert twilio_server.received == []
+
+def test_checkpoint_is_rejected_once_another_worker_owns_the_run(manager, make_lead, make_campaign):
+    make_lead()
+    run = _interrupted_run(make_campaign(), 0, heartbeat_age_seconds=0)
+    assert manager._checkpoint_campaign_run(run.id, 'este-host:2:old', 99, 1, 1, 0) is False
+    db.session.rollback()
+    db.session.refresh(run)
+    assert run.last_lead_id == 0
+
+def test_worker_checks_its_lease_before_sending_each_chunk(manager, make_lead, make_campaign, twilio_server, monkeypatch):
+    leads = [make_lead() for _ in range(3)]
+    campaign = make_campaign()
+    checkpoint = manager._checkpoint_campaign_run
+
+    def checkpoint_then_lose_lease(run_id, *args):
+        saved = checkpoint(run_id, *args)
+        # Otro proceso reanuda la ejecución entre el primer y el segundo bloque
+        CampaignRun.query.filter_by(id=run_id).update({'owner': 'otro-host:1:nuevo'})
+        return saved
+    monkeypatch.setattr(manager, '_checkpoint_campaign_run', checkpoint_then_lose_lease)
+
+    totals = manager.execute_campaign(campaign.id, chunk_size=1)
+
+    assert (totals['processed'], len(totals['chunks'])) == (1, 1)
+    assert [message['to'] for message in twilio_server.received] == [f'whatsapp:{leads[0].phone_e164}']
+    run = CampaignRun.query.filter_by(campaign_id=campaign.id).one()
+    assert (run.status, run.owner, run.last_lead_id) == ('running', 'otro-host:1:nuevo', leads[0].id)
+
+def test_run_interrupted_too_many_times_is_marked_failed(manager, make_lead, make_campaign, twilio_server):
+    make_lead()
+    campaign = make_campaign()
+    run = _interrupted_run(campaign, 0, CAMPAIGN_RUN_STALE_SECONDS + 60)
+    run.resumed_count = CAMPAIGN_RUN_MAX_RESUMES
+    run.last_error = 'timeout'
+    db.session.commit()
+
+    manager.resume_interrupted_campaigns()
+
+    db.session.refresh(run)
+    assert run.status == 'failed' and run.finished_at is not None
+    assert run.last_error == f'Interrumpida {CAMPAIGN_RUN_MAX_RESUMES + 1} veces sin completarse: timeout'
+    assert twilio_server.received == []
+    # Ya no está en 'running': las siguientes pasadas no la vuelven a tomar
+    manager.resume_interrupted_campaigns()
+    assert CampaignRun.query.filter_by(status='running').count() == 0
+
+def test_campaign_does_not_send_when_the_stored_version_has_other_content(manager, make_lead, make_campaign, twilio_server):
+    from models import MessageTemplateVersion
+    make_lead()
+    campaign = make_campaign(content='Hola {name}, OFERTA NUEVA')
+    db.session.add(MessageTemplateVersion(template_id=campaign.template_id, version=1, content='Hola {name}, OFERTA VIEJA'))
+    db.session.commit()
+
+    assert manager.execute_campaign(campaign.id) is None
+    assert twilio_server.received == []
+    assert CampaignRun.query.count() == 0
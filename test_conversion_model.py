@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Pruebas del entrenamiento y la publicación del modelo de conversión (conversion_model.py)
+"""
+
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from models import db, ConversionModelVersion, LeadSource, LeadStatus, Message
+from conversion_model import ConversionModelRegistry, conversion_model_registry, load_training_inputs, train_conversion_model
+from lead_scoring import score_leads
+
+def _close(lead, status, messages_after=0):
+    lead.status = status
+    db.session.commit()
+    # Postventa: actividad posterior al cierre que no debe llegar a las features
+    later = datetime.utcnow() + timedelta(hours=1)
+    for _ in range(messages_after):
+        db.session.add(Message(lead_id=lead.id, content='Gracias por elegirnos', message_type='outbound', created_at=later))
+    lead.last_contact_date = later
+    db.session.commit()
+
+def _closed_leads(make_lead, count=30):
+    rng = np.random.default_rng(1)
+    leads = []
+    for index in range(count):
+        converted = index % 2 == 0
+        interest = int(np.clip(rng.normal(4 if converted else 2, 1), 0, 5))
+        lead = make_lead(interest_level=interest, source=LeadSource.REFERIDO if converted else LeadSource.OTRO)
+        db.session.add(Message(lead_id=lead.id, content='Hola', message_type='inbound',
+                               created_at=datetime.utcnow() - timedelta(days=2)))
+        db.session.commit()
+        _close(lead, LeadStatus.CONVERTIDO if converted else LeadStatus.PERDIDO, messages_after=5 if converted else 0)
+        leads.append(lead)
+    return leads
+
+def test_training_features_are_taken_as_of_the_close(app, make_lead):
+    converted, lost = make_lead(), make_lead()
+    db.session.add(Message(lead_id=converted.id, content='Hola', message_type='inbound',
+                           created_at=datetime.utcnow() - timedelta(days=3)))
+    db.session.commit()
+    _close(converted, LeadStatus.CONVERTIDO, messages_after=4)
+    _close(lost, LeadStatus.PERDIDO)
+    make_lead(status=LeadStatus.INTERESADO)  # abierto: no entra
+
+    inputs = load_training_inputs()
+    assert inputs['ids'].tolist() == [converted.id, lost.id]
+    assert inputs['converted'].tolist() == [True, False]
+    # Solo el mensaje anterior al cierre; el contacto de postventa se reemplaza por ese mensaje
+    assert inputs['messages'].tolist() == [1, 0]
+    assert np.floor(inputs['as_of_day'][0] - inputs['contact_day'][0]) == 3
+    assert np.isnan(inputs['contact_day'][1])
+
+def test_model_is_published_in_the_database_and_used_for_scoring(app, make_lead):
+    _closed_leads(make_lead)
+    open_lead = make_lead(interest_level=5, source=LeadSource.REFERIDO)
+
+    metadata = train_conversion_model()
+    assert metadata['version'] == 1 and metadata['samples'] == 30
+    # Ni la cantidad de mensajes ni el contacto posterior al cierre separan las clases
+    assert abs(metadata['weights']['log_messages']) < abs(metadata['weights']['interest_level'])
+    stored = db.session.get(ConversionModelVersion, 1)
+    assert stored is not None and stored.params
+
+    # Otro proceso (sin archivos locales) carga la misma versión desde la base
+    other_process = ConversionModelRegistry()
+    with app.app_context():
+        model = other_process.current()
+    assert model.version == 1
+    assert np.array_equal(model.params, conversion_model_registry.current().params)
+
+    scores = score_leads([open_lead.id])
+    assert scores['model_version'] == 1 and 50 < scores['probabilities'][0] <= 100
+
+def test_missing_version_falls_back_to_the_heuristic(app, make_lead):
+    _closed_leads(make_lead, count=20)
+    train_conversion_model()
+    ConversionModelVersion.query.delete()
+    db.session.commit()
+
+    registry = ConversionModelRegistry()
+    with app.app_context():
+        assert registry.current() is None
+
+def test_training_requires_both_classes(app, make_lead):
+    for _ in range(25):
+        _close(make_lead(), LeadStatus.PERDIDO)
+    with pytest.raises(ValueError):
+        train_conversion_model()
+    assert ConversionModelVersion.query.count() == 0
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Pruebas de los contadores incrementales de /api/stats (counters.py)
+"""
+
+from datetime import datetime, timedelta
+from models import db, Lead, LeadStatus, LeadSource, Message, StatCounter
+from counters import (
+    TOTAL_LEADS_KEY, REBUILT_AT_KEY, get_dashboard_counters, rebuild_counters, read_counters,
+    status_key, source_key, conversions_day_key
+)
+
+def _stored_counters():
+    return {
+        name: value for name, value in db.session.query(StatCounter.name, StatCounter.value)
+        if value and name != REBUILT_AT_KEY
+    }
+
+def test_incremental_counters_match_rebuild(app, make_lead):
+    leads = [make_lead() for _ in range(5)]
+    make_lead(source=LeadSource.WEBSITE, status=LeadStatus.INTERESADO)
+
+    leads[0].status = LeadStatus.CONVERTIDO
+    leads[1].source = LeadSource.REFERIDO
+    leads[2].status = LeadStatus.PERDIDO
+    db.session.add(Message(lead_id=leads[3].id, content='Hola', message_type='inbound'))
+    db.session.add(Message(lead_id=leads[3].id, content='Ayer', message_type='outbound',
+                           created_at=datetime.utcnow() - timedelta(days=1)))
+    db.session.commit()
+    db.session.delete(leads[4])
+    db.session.commit()
+
+    incremental = _stored_counters()
+    rebuilt = {name: value for name, value in rebuild_counters().items() if value and name != REBUILT_AT_KEY}
+    assert incremental == rebuilt
+    assert incremental[TOTAL_LEADS_KEY] == 5
+    assert incremental[status_key(LeadStatus.CONVERTIDO)] == 1
+    assert incremental[source_key(LeadSource.REFERIDO)] == 1
+
+def test_status_change_on_expired_lead_is_counted_once(app, make_lead):
+    # Después del commit el lead queda expirado: el valor anterior del estado no está cargado
+    lead = make_lead()
+    today = datetime.utcnow().date()
+
+    lead.status = LeadStatus.CONVERTIDO
+    db.session.commit()
+    lead.status = LeadStatus.CONVERTIDO  # sin cambio real: no suma
+    db.session.commit()
+
+    values = read_counters([status_key(LeadStatus.NUEVO), status_key(LeadStatus.CONVERTIDO), conversions_day_key(today)])
+    assert values == {
+        status_key(LeadStatus.NUEVO): 0,
+        status_key(LeadStatus.CONVERTIDO): 1,
+        conversions_day_key(today): 1
+    }
+
+def test_rolled_back_writes_leave_counters_untouched(app, make_lead):
+    make_lead()
+    before = _stored_counters()
+
+    db.session.add(Lead(name='Temporal', phone_number='+5491199999999'))
+    db.session.flush()
+    db.session.rollback()
+
+    assert _stored_counters() == before
+
+def test_dashboard_counters_read_today_and_week(app, make_lead):
+    lead = make_lead()
+    db.session.add(Message(lead_id=lead.id, content='Hola', message_type='inbound'))
+    lead.status = LeadStatus.CONVERTIDO
+    db.session.commit()
+
+    values = get_dashboard_counters()
+    assert values['total_leads'] == 1
+    assert values['messages_today'] == 1
+    assert values['status'][LeadStatus.CONVERTIDO.value] == 1
+    assert values['weekly_conversions'] == 1
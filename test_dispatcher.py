@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Pruebas del despachador concurrente de mensajes contra el servidor falso de Twilio (dispatcher.py)
+"""
+
+import time
+from dispatcher import OutboundDispatcher, TokenBucket, build_twilio_client, outbound_message
+from fake_twilio import FakeTwilioServer
+
+FROM_NUMBER = '+5491100000000'
+
+def _dispatcher(server, **kwargs):
+    client = build_twilio_client('ACtest', 'token', pool_size=kwargs.get('workers', 4), base_url=server.base_url)
+    return OutboundDispatcher(client, FROM_NUMBER, **kwargs)
+
+def _messages(count):
+    return [outbound_message(i, f'+54911{i:08d}', f'Mensaje {i}', message_id=i) for i in range(count)]
+
+def test_every_message_is_sent_once_in_batches():
+    progress = []
+    with FakeTwilioServer() as server:
+        report = _dispatcher(server, workers=4, rate=0, batch_size=5).dispatch(_messages(12), on_progress=progress.append)
+        received = sorted(message['to'] for message in server.received)
+
+    assert (report['total'], report['sent'], report['failed']) == (12, 12, 0)
+    assert received == sorted(f'whatsapp:+54911{i:08d}' for i in range(12))
+    assert [item['processed'] for item in progress] == [5, 10, 12]
+    assert all(result['sid'].startswith('SM') and result['message_id'] is not None for result in report['results'])
+
+def test_client_errors_are_final_and_server_errors_retryable():
+    with FakeTwilioServer(failure_rate=1.0, error_status=400) as server:
+        rejected = _dispatcher(server, rate=0).dispatch(_messages(2))
+    with FakeTwilioServer(failure_rate=1.0, error_status=503) as server:
+        unavailable = _dispatcher(server, rate=0).dispatch(_messages(2))
+
+    assert rejected['failed'] == 2 and not any(result['retryable'] for result in rejected['results'])
+    assert unavailable['failed'] == 2 and all(result['retryable'] for result in unavailable['results'])
+
+def test_token_bucket_caps_the_send_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # El primer token está disponible; los otros 10 llegan a 20 por segundo
+    assert time.monotonic() - started >= 0.45
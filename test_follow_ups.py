@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la planificación y el envío por lotes de los recordatorios de seguimiento (lead_manager.py)
+"""
+
+from datetime import datetime, timedelta
+import pytest
+from models import db, Lead, LeadStatus, Message, MessageTemplate
+import lead_manager as lead_manager_module
+from lead_manager import lead_manager
+
+@pytest.fixture
+def follow_up_template(app):
+    template = MessageTemplate(name='Seguimiento', category='follow_up', content='Hola {name}, ¿seguimos?')
+    db.session.add(template)
+    db.session.commit()
+    return template
+
+def _due_lead(make_lead, minutes_ago):
+    now = datetime.utcnow()
+    return make_lead(status=LeadStatus.CONTACTADO, next_follow_up=now - timedelta(days=1),
+                     follow_up_slot_at=now - timedelta(minutes=minutes_ago))
+
+def test_due_slots_are_enqueued_and_rescheduled(app, make_lead, follow_up_template):
+    leads = [_due_lead(make_lead, minutes) for minutes in (3, 2, 1)]
+    make_lead(status=LeadStatus.CONTACTADO, next_follow_up=datetime.utcnow() - timedelta(days=1))  # sin turno
+
+    assert lead_manager.send_follow_up_reminders(batch_size=2) == 3
+    assert Message.query.filter_by(status='pending').count() == 3
+    for lead in leads:
+        db.session.refresh(lead)
+        assert lead.follow_up_slot_at is None and lead.next_follow_up > datetime.utcnow() + timedelta(days=6)
+
+def test_failing_lead_does_not_block_the_remaining_reminders(app, make_lead, follow_up_template, monkeypatch):
+    leads = [_due_lead(make_lead, minutes) for minutes in (4, 3, 2, 1)]
+    broken_id = leads[1].id
+    enqueue = lead_manager_module.enqueue_message
+
+    def failing_enqueue(lead_id, **kwargs):
+        if lead_id == broken_id:
+            raise RuntimeError('fallo de prueba')
+        return enqueue(lead_id, **kwargs)
+    monkeypatch.setattr(lead_manager_module, 'enqueue_message', failing_enqueue)
+
+    # El lote del lead roto se reintenta lead por lead y los lotes siguientes se procesan igual
+    assert lead_manager.send_follow_up_reminders(batch_size=2) == 3
+    assert sorted(message.lead_id for message in Message.query) == sorted(
+        lead.id for lead in leads if lead.id != broken_id
+    )
+    broken = db.session.get(Lead, broken_id)
+    assert broken.follow_up_slot_at is None and broken.next_follow_up < datetime.utcnow()
+
+    # Sin turno y todavía vencido: la próxima planificación le asigna uno nuevo
+    assert lead_manager.plan_follow_up_slots() == 1
+    db.session.refresh(broken)
+    assert broken.follow_up_slot_at is not None
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Pruebas del registro de cambios de estado y del funnel incremental (funnel.py)
+"""
+
+from datetime import datetime, timedelta
+from models import db, LeadStatus, LeadStatusChange, FunnelTransitionStat
+from funnel import CREATED_STAGE, count_transitions_since, get_funnel, rebuild_funnel_stats
+
+def _stats():
+    return {
+        (stat.from_stage, stat.to_stage): (stat.transition_count, round(stat.total_seconds, 3))
+        for stat in FunnelTransitionStat.query
+    }
+
+def _move(lead, status, hours_in_previous=0):
+    lead.status_changed_at = datetime.utcnow() - timedelta(hours=hours_in_previous)
+    lead.status = status
+    db.session.commit()
+
+def test_transitions_are_logged_with_time_in_previous_stage(app, make_lead):
+    lead = make_lead()
+    _move(lead, LeadStatus.CONTACTADO, hours_in_previous=2)
+    _move(lead, LeadStatus.CONTACTADO)  # mismo estado: no es una transición
+
+    changes = LeadStatusChange.query.filter_by(lead_id=lead.id).order_by(LeadStatusChange.id).all()
+    assert [(change.from_status, change.to_status) for change in changes] == [
+        (None, LeadStatus.NUEVO), (LeadStatus.NUEVO, LeadStatus.CONTACTADO)
+    ]
+    assert abs(changes[1].seconds_in_previous - 7200) < 5
+
+def test_incremental_stats_match_rebuild_and_funnel_rates(app, make_lead):
+    leads = [make_lead() for _ in range(4)]
+    for lead in leads:
+        _move(lead, LeadStatus.CONTACTADO, hours_in_previous=1)
+    for lead in leads[:2]:
+        _move(lead, LeadStatus.INTERESADO, hours_in_previous=3)
+    _move(leads[0], LeadStatus.CONVERTIDO)
+    _move(leads[3], LeadStatus.PERDIDO)
+    incremental = _stats()
+
+    rebuild_funnel_stats()
+    assert _stats().keys() == incremental.keys()
+    for key, (count, seconds) in incremental.items():
+        assert _stats()[key][0] == count
+        assert abs(_stats()[key][1] - seconds) < 1
+
+    funnel = get_funnel()
+    stages = {stage['stage']: stage for stage in funnel['stages']}
+    assert stages['contactado']['entered'] == 4 and stages['contactado']['exited'] == 3
+    assert stages['contactado']['current'] == 1
+    assert stages['contactado']['avg_hours_in_stage'] == 2.0  # (3 h + 3 h + 0 h) / 3 salidas
+    to_interested = next(item for item in funnel['transitions'] if item['to'] == 'interesado')
+    assert to_interested['rate'] == 50.0
+    assert incremental[(CREATED_STAGE, 'nuevo')][0] == 4
+
+def test_rolled_back_transition_is_not_logged(app, make_lead):
+    lead = make_lead()
+    lead.status = LeadStatus.CONVERTIDO
+    db.session.flush()
+    db.session.rollback()
+
+    assert count_transitions_since(LeadStatus.CONVERTIDO, datetime.utcnow() - timedelta(days=1)) == 0
+    assert (('nuevo', 'convertido') in _stats()) is False
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Pruebas de los contadores de actividad por lead frente a las tablas hijas (lead_activity.py)
+"""
+
+from datetime import datetime, timedelta
+from models import db, Interaction, Lead, Message
+from lead_activity import check_lead_activity, record_bulk_activity
+
+def _message(lead, message_type, minutes_ago):
+    message = Message(lead_id=lead.id, content='Hola', message_type=message_type,
+                      created_at=datetime.utcnow() - timedelta(minutes=minutes_ago))
+    db.session.add(message)
+    return message
+
+def test_counters_follow_inserts_and_deletes(app, make_lead):
+    lead, other = make_lead(), make_lead()
+    older = _message(lead, 'inbound', 30)
+    latest = _message(lead, 'inbound', 10)
+    _message(lead, 'outbound', 5)
+    _message(other, 'outbound', 1)
+    db.session.add(Interaction(lead_id=lead.id, interaction_type='call', description='Llamada'))
+    db.session.commit()
+
+    db.session.refresh(lead)
+    assert (lead.message_count, lead.interaction_count, lead.last_inbound_at) == (3, 1, latest.created_at)
+    assert check_lead_activity()['mismatched'] == 0
+
+    # Borrar el último entrante obliga a buscar el anterior
+    db.session.delete(latest)
+    db.session.commit()
+    db.session.refresh(lead)
+    assert (lead.message_count, lead.last_inbound_at) == (2, older.created_at)
+    assert check_lead_activity()['mismatched'] == 0
+
+def test_bulk_writes_and_drift_are_detected_and_repaired(app, make_lead):
+    lead = make_lead()
+    record_bulk_activity(db.session.connection(), [lead.id, lead.id], messages=1, interactions=1)
+    db.session.commit()
+    db.session.refresh(lead)
+    assert (lead.message_count, lead.interaction_count) == (2, 2)  # sin filas reales detrás
+
+    report = check_lead_activity()
+    assert report['mismatched'] == 1
+    assert report['sample'][0]['message_count'] == [2, 0]
+
+    assert check_lead_activity(repair=True)['repaired'] == 1
+    db.session.refresh(lead)
+    assert (lead.message_count, lead.interaction_count) == (0, 0)
+    assert check_lead_activity()['mismatched'] == 0
+    assert db.session.get(Lead, lead.id).last_inbound_at is None
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Pruebas de NexaLeadManager.get_lead_analytics (agregación por ventana de días)
+"""
+
+from datetime import datetime, timedelta
+from models import db, LeadStatus, LeadSource, Message
+from rollups import backfill_rollups
+from lead_manager import lead_manager
+
+def _days_ago(days):
+    return datetime.utcnow() - timedelta(days=days)
+
+def test_window_counts_only_leads_created_inside_it(app, make_lead):
+    make_lead(created_at=_days_ago(40), status=LeadStatus.CONVERTIDO)
+    recent = make_lead(created_at=_days_ago(10), status=LeadStatus.CONVERTIDO, source=LeadSource.WEBSITE)
+    make_lead(created_at=_days_ago(3), status=LeadStatus.CONTACTADO, source=LeadSource.WEBSITE)
+    make_lead(status=LeadStatus.NUEVO)  # hoy: se agrega en vivo
+    db.session.add(Message(lead_id=recent.id, content='Hola', message_type='outbound', created_at=_days_ago(2)))
+    db.session.add(Message(lead_id=recent.id, content='Gracias', message_type='inbound', created_at=_days_ago(2)))
+    db.session.commit()
+    backfill_rollups()
+
+    analytics = lead_manager.get_lead_analytics(days=30)
+
+    assert analytics['total_leads'] == 3
+    assert analytics['conversions'] == 1
+    assert analytics['status_distribution'] == {'convertido': 1, 'contactado': 1, 'nuevo': 1}
+    assert analytics['source_performance']['website'] == {'total': 2, 'conversions': 1, 'conversion_rate': 50.0}
+    assert round(analytics['conversion_rate'], 2) == 33.33
+    assert analytics['messages_sent'] == 1
+
+    assert lead_manager.get_lead_analytics(days=60)['total_leads'] == 4
+
+def test_series_is_filled_with_empty_days_and_weekly_buckets(app, make_lead):
+    make_lead(created_at=_days_ago(5), status=LeadStatus.CONVERTIDO)
+    backfill_rollups()
+
+    daily = lead_manager.get_lead_analytics(days=7)['series']
+    assert len(daily) == 8
+    assert sum(period['leads'] for period in daily) == 1
+    assert [period['conversions'] for period in daily if period['leads']] == [1]
+
+    weekly = lead_manager.get_lead_analytics(days=120)
+    assert weekly['period']['bucket'] == 'week'
+    assert all(datetime.fromisoformat(period['period']).weekday() == 0 for period in weekly['series'])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la exportación de leads en streaming: CSV, NDJSON y gzip (lead_export.py)
+"""
+
+import io
+import csv
+import gzip
+import json
+from datetime import datetime, timedelta
+from models import LeadStatus
+from lead_export import EXPORT_FIELDS, export_leads
+
+def _leads(make_lead, count):
+    now = datetime.utcnow()
+    return [make_lead(name=f'Lead {i}', company='Obras, "SA"', created_at=now - timedelta(minutes=i)) for i in range(count)]
+
+def test_csv_export_has_every_lead_newest_first(app, make_lead):
+    leads = _leads(make_lead, 5)
+    chunks = list(export_leads('csv', batch_size=2))
+
+    assert len(chunks) == 4  # encabezado y tres bloques de hasta dos filas
+    rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+    assert list(rows[0].keys()) == EXPORT_FIELDS
+    assert [int(row['id']) for row in rows] == [lead.id for lead in leads]
+    assert rows[0]['company'] == 'Obras, "SA"' and rows[0]['status'] == 'nuevo'
+
+def test_ndjson_export_applies_filters(app, make_lead):
+    _leads(make_lead, 3)
+    make_lead(name='Cliente', status=LeadStatus.CONVERTIDO)
+
+    lines = b''.join(export_leads('ndjson', status=LeadStatus.CONVERTIDO)).decode('utf-8').splitlines()
+    assert [json.loads(line)['name'] for line in lines] == ['Cliente']
+    assert json.loads(lines[0])['created_at'].startswith(str(datetime.utcnow().year))
+
+def test_gzip_stream_decompresses_to_the_plain_export(app, make_lead):
+    _leads(make_lead, 3)
+    plain = b''.join(export_leads('csv', batch_size=1))
+    compressed = b''.join(export_leads('csv', gzip=True, batch_size=1))
+    assert gzip.decompress(compressed) == plain
+
+def test_empty_export_still_has_the_csv_header(app):
+    assert b''.join(export_leads('csv')).decode('utf-8').strip() == ','.join(EXPORT_FIELDS)
+    assert b''.join(export_leads('ndjson')) == b''
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la importación de leads desde CSV y de la reanudación de trabajos interrumpidos (lead_import.py)
+"""
+
+import json
+from datetime import datetime, timedelta
+from models import db, Lead, ImportJob
+from counters import get_dashboard_counters
+import lead_import
+from lead_import import (
+    IMPORT_JOB_MAX_RESUMES, IMPORT_JOB_STALE_SECONDS, import_leads_from_csv, resume_stale_import_jobs, run_import_job
+)
+
+def _csv(tmp_path, rows):
+    path = tmp_path / 'leads.csv'
+    path.write_text('name,phone_number,email\n' + ''.join(f'{name},{phone},\n' for name, phone in rows), encoding='utf-8')
+    return str(path)
+
+def _job(path, heartbeat_age_seconds=None, **values):
+    heartbeat = datetime.utcnow() - timedelta(seconds=heartbeat_age_seconds) if heartbeat_age_seconds is not None else None
+    job = ImportJob(filename='leads.csv', file_path=path, heartbeat_at=heartbeat, **values)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def test_duplicates_in_file_and_in_database_are_skipped(app, make_lead, tmp_path):
+    make_lead(phone_number='+54 9 11 5555-0001')
+    path = _csv(tmp_path, [
+        ('Ana', '+5491155550001'),    # ya existe escrito de otra forma
+        ('Luis', '+5491155550002'),
+        ('Luis bis', '+54 9 11 5555 0002'),  # duplicado dentro del archivo
+        ('Sin teléfono', ''),
+        ('Eva', '123'),
+        ('Juan', '+5491155550003'),
+    ])
+
+    totals = import_leads_from_csv(path, chunk_size=2)
+
+    assert (totals['processed'], totals['imported'], totals['skipped']) == (6, 2, 4)
+    assert totals['skip_reasons'] == {
+        'ya_existe': 1, 'duplicado_en_archivo': 1, 'sin_telefono': 1, 'telefono_invalido': 1
+    }
+    assert Lead.query.count() == 3
+    assert get_dashboard_counters()['total_leads'] == 3  # los INSERT masivos actualizan los contadores
+
+def test_interrupted_job_resumes_after_its_last_processed_row(app, make_lead, tmp_path):
+    rows = [(f'Lead {i}', f'+54911666600{i:02d}') for i in range(5)]
+    path = _csv(tmp_path, rows + [('Repetido', rows[0][1])])
+    # El worker se recicló después de confirmar el primer bloque de dos filas
+    for name, phone in rows[:2]:
+        make_lead(name=name, phone_number=phone)
+    job = _job(path, IMPORT_JOB_STALE_SECONDS + 60, status='running', processed=2, imported=2, skipped=0,
+               skip_reasons='{}', skipped_rows='[]', owner='otro-host:1:dead', resumed_count=0)
+
+    assert resume_stale_import_jobs() == 1
+
+    db.session.refresh(job)
+    assert (job.status, job.resumed_count) == ('completed', 1)
+    assert (job.processed, job.imported, job.skipped) == (6, 5, 1)
+    # Las filas ya confirmadas no se cuentan como existentes, pero sí detectan duplicados posteriores
+    assert json.loads(job.skip_reasons) == {'duplicado_en_archivo': 1}
+    assert Lead.query.count() == 5
+
+def test_job_with_a_live_heartbeat_is_left_alone(app, tmp_path):
+    job = _job(_csv(tmp_path, [('Ana', '+5491155550001')]), heartbeat_age_seconds=5,
+               status='running', owner='otro-host:1:alive')
+
+    assert resume_stale_import_jobs() == 0
+    assert run_import_job(job.id).status == 'running'
+    assert Lead.query.count() == 0
+
+def test_stale_jobs_fail_when_they_cannot_be_resumed(app, tmp_path):
+    missing = _job(str(tmp_path / 'borrado.csv'), IMPORT_JOB_STALE_SECONDS + 60, status='running')
+    looping = _job(_csv(tmp_path, [('Ana', '+5491155550001')]), IMPORT_JOB_STALE_SECONDS + 60,
+                   status='running', resumed_count=IMPORT_JOB_MAX_RESUMES)
+
+    resume_stale_import_jobs()
+
+    for job in (missing, looping):
+        db.session.refresh(job)
+        assert job.status == 'failed' and job.last_error and job.finished_at
+    assert Lead.query.count() == 0
+
+def test_worker_that_lost_the_job_stops_without_committing_its_chunk(app, tmp_path, monkeypatch):
+    job = _job(_csv(tmp_path, [('Ana', '+5491155550001'), ('Luis', '+5491155550002')]), status='queued')
+    claim = lead_import._claim_import_job
+
+    def claim_then_lose(job_id):
+        owner = claim(job_id)
+        # El heartbeat venció y otro proceso reclamó el trabajo antes del primer bloque
+        ImportJob.query.filter_by(id=job_id).update({'owner': 'otro-host:2:new'})
+        db.session.commit()
+        return owner
+    monkeypatch.setattr(lead_import, '_claim_import_job', claim_then_lose)
+
+    job = run_import_job(job.id, chunk_size=1)
+    assert (job.status, job.owner, job.processed) == ('running', 'otro-host:2:new', 0)
+    assert Lead.query.count() == 0
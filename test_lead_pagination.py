@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la paginación por keyset de /api/leads (lead_pagination.py)
+"""
+
+from datetime import datetime, timedelta
+import pytest
+from models import db, Lead
+from lead_pagination import decode_cursor, encode_cursor, keyset_page, keyset_query
+
+def _walk(query, per_page, order_by='created_at'):
+    pages, after = [], ''
+    while True:
+        leads, after, has_more = keyset_page(query, after, per_page, order_by)
+        pages.append([lead.id for lead in leads])
+        if not has_more:
+            assert after is None
+            return pages
+
+def test_pages_cover_every_lead_once_with_tied_timestamps(app, make_lead):
+    # Varios leads comparten created_at: el id desempata y ninguno se repite ni se pierde
+    same_time = datetime(2024, 5, 1, 12, 0, 0)
+    for index in range(7):
+        make_lead(created_at=same_time if index % 2 else same_time + timedelta(minutes=index))
+
+    pages = _walk(Lead.query, per_page=3)
+
+    ids = [lead_id for page in pages for lead_id in page]
+    expected = [lead.id for lead in Lead.query.order_by(Lead.created_at.desc(), Lead.id.desc())]
+    assert ids == expected
+    assert [len(page) for page in pages] == [3, 3, 1]
+
+def test_rows_inserted_ahead_of_the_cursor_do_not_shift_later_pages(app, make_lead):
+    for index in range(4):
+        make_lead(created_at=datetime(2024, 5, 1) + timedelta(hours=index))
+
+    first, after, _ = keyset_page(Lead.query, '', 2)
+    make_lead()  # más nuevo que todos: con OFFSET desplazaría la segunda página
+    second, _, has_more = keyset_page(Lead.query, after, 2)
+
+    assert not {lead.id for lead in first} & {lead.id for lead in second}
+    assert len(second) == 2 and not has_more
+
+def test_score_ordering_skips_unscored_leads(app, make_lead):
+    scored = [make_lead(conversion_score=score) for score in (40.0, 90.0, 40.0)]
+    make_lead(conversion_score=None)
+
+    query = keyset_query(Lead.query, 'score')
+    pages = _walk(query, per_page=2, order_by='score')
+
+    assert [lead_id for page in pages for lead_id in page] == [scored[1].id, scored[2].id, scored[0].id]
+    assert query.order_by(None).count() == 3
+
+def test_cursor_round_trip_and_invalid_cursors(app, make_lead):
+    lead = make_lead(created_at=datetime(2024, 5, 1, 8, 30))
+    assert decode_cursor(encode_cursor(lead)) == (lead.created_at, lead.id)
+    assert decode_cursor(f'2024-05-01T08:30:00,{lead.id}') == (lead.created_at, lead.id)
+
+    for cursor in ('no-es-un-cursor', 'Zm9vLGJhcg', '2024-13-01T00:00:00,1'):
+        with pytest.raises(ValueError):
+            keyset_page(Lead.query, cursor, 10)
+    db.session.rollback()
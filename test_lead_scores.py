@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la cola de scores y del score persistido en Lead.conversion_score (lead_scores.py)
+"""
+
+from datetime import datetime, timedelta
+from models import db, Interaction, Lead, LeadScoreQueue, LeadSource
+from lead_scoring import score_leads
+from lead_scores import refresh_all_scores, refresh_queued_scores
+
+def _queued():
+    return {lead_id for (lead_id,) in db.session.query(LeadScoreQueue.lead_id)}
+
+def _stored_scores():
+    return dict(db.session.query(Lead.id, Lead.conversion_score))
+
+def test_changes_that_affect_the_score_enqueue_the_lead(app, make_lead):
+    lead, other = make_lead(), make_lead()
+    assert _queued() == {lead.id, other.id}  # leads nuevos
+    refresh_queued_scores()
+    assert _queued() == set()
+
+    lead.notes = 'Sin efecto en el score'
+    db.session.commit()
+    assert _queued() == set()
+
+    lead.interest_level = 4
+    db.session.add(Interaction(lead_id=other.id, interaction_type='call', description='Llamada'))
+    db.session.commit()
+    assert _queued() == {lead.id, other.id}
+
+def test_queued_refresh_stores_the_batch_scores(app, make_lead):
+    leads = [make_lead(interest_level=level, source=LeadSource.REFERIDO) for level in range(5)]
+    assert refresh_queued_scores(batch_size=2) == 5
+
+    expected = score_leads()
+    assert _stored_scores() == dict(zip(expected['lead_ids'].tolist(), expected['probabilities'].tolist()))
+    leads[0].interest_level = 5
+    db.session.commit()
+    assert refresh_queued_scores() == 1
+    db.session.refresh(leads[0])
+    assert leads[0].conversion_score == score_leads([leads[0].id])['probabilities'][0] > expected['probabilities'].max()
+
+def test_sweep_writes_only_scores_that_decayed(app, make_lead):
+    fresh = make_lead(last_contact_date=datetime.utcnow())
+    stale = make_lead(last_contact_date=datetime.utcnow())
+    refresh_queued_scores()
+    # Pasan los días sin contacto: el factor de tiempo de respuesta baja
+    Lead.query.filter_by(id=stale.id).update({'last_contact_date': datetime.utcnow() - timedelta(days=20)})
+    db.session.query(LeadScoreQueue).delete()
+    db.session.commit()
+
+    assert refresh_all_scores(chunk_size=1) == {'scored': 2, 'updated': 1}
+    scores = _stored_scores()
+    assert scores[stale.id] < scores[fresh.id]
+    assert refresh_all_scores() == {'scored': 2, 'updated': 0}
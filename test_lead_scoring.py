@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Pruebas del scoring de conversión en lote frente al scoring individual de NexaAI (lead_scoring.py)
+"""
+
+from datetime import datetime, timedelta
+import numpy as np
+from models import LeadSource, LeadStatus
+from ai_features import NexaAI
+from lead_scoring import FACTOR_NAMES, score_leads, summarize_scores
+
+def _varied_leads(make_lead):
+    now = datetime.utcnow()
+    profiles = [
+        dict(source=LeadSource.REFERIDO, interest_level=5, company='Obras SA', email='a@obras.com',
+             last_contact_date=now - timedelta(hours=3), interaction_count=5),
+        dict(source=LeadSource.WEBSITE, interest_level=3, company=None, email='b@mail.com',
+             last_contact_date=now - timedelta(days=2, hours=1), interaction_count=1),
+        dict(source=LeadSource.EVENTO, interest_level=2, company='Casa', email=None,
+             last_contact_date=now - timedelta(days=6), interaction_count=3),
+        dict(source=LeadSource.REDES_SOCIALES, interest_level=1, company=None, email=None,
+             last_contact_date=now - timedelta(days=10), interaction_count=0),
+        dict(source=LeadSource.OTRO, interest_level=0, last_contact_date=now - timedelta(days=40)),
+        dict(source=LeadSource.WHATSAPP, interest_level=4, last_contact_date=None, interaction_count=2),
+    ]
+    return [make_lead(**profile) for profile in profiles]
+
+def test_batch_scores_match_the_per_lead_scorer(app, make_lead):
+    leads = _varied_leads(make_lead)
+    scores = score_leads()
+    ai = NexaAI()
+
+    assert scores['lead_ids'].tolist() == [lead.id for lead in leads]
+    for index, lead in enumerate(leads):
+        single = ai.predict_lead_conversion(lead)
+        assert scores['probabilities'][index] == single['conversion_probability']
+        assert scores['actions'][index] == single['next_best_action']
+        for name in FACTOR_NAMES:
+            assert np.isclose(scores['factors'][name][index], single['factors'][name]), name
+
+def test_filters_and_summary(app, make_lead):
+    leads = _varied_leads(make_lead)
+    leads[0].status = LeadStatus.INTERESADO
+    make_lead(status=LeadStatus.INTERESADO, source=LeadSource.REFERIDO)
+
+    scores = score_leads(status=LeadStatus.INTERESADO, source=LeadSource.REFERIDO)
+    assert len(scores['lead_ids']) == 2 and scores['model_version'] is None
+    assert score_leads(lead_ids=[leads[2].id])['lead_ids'].tolist() == [leads[2].id]
+
+    summary = summarize_scores(score_leads())
+    assert summary['count'] == 7 and sum(summary['by_action'].values()) == 7
+    assert summarize_scores(score_leads(lead_ids=[]))['average_probability'] is None
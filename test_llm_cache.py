@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la caché de respuestas del LLM y de su uso en NexaAI (llm_cache.py, ai_features.py)
+"""
+
+import json
+from types import SimpleNamespace
+import pytest
+from models import db, LLMResponseCache, LeadStatus
+from llm_cache import LLMCache, cache_key, llm_cache, parse_use_cache
+from ai_features import NexaAI
+
+class FakeOpenAI:
+    """Cliente de chat-completion que cuenta las llamadas y devuelve respuestas fijas"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+        self.ChatCompletion = self
+
+    def create(self, model, messages, max_tokens, temperature):
+        self.prompts.append(messages[0]['content'])
+        content = self.responses[min(len(self.prompts), len(self.responses)) - 1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def _ai(*responses):
+    ai = NexaAI()
+    ai.openai_client = FakeOpenAI(*responses)
+    return ai
+
+def test_keys_ignore_case_accents_and_punctuation():
+    assert cache_key('gpt', 'intent', '¿Cuánto cuesta?') == cache_key('gpt', 'intent', 'cuanto  CUESTA')
+    assert cache_key('gpt', 'intent', 'precio') != cache_key('gpt', 'message', 'precio')
+    assert cache_key('gpt', 'intent', 'precio') != cache_key('otro', 'intent', 'precio')
+
+def test_responses_are_shared_through_the_table_and_expire(app):
+    writer, reader = LLMCache(), LLMCache()
+    writer.set('k', 'intent', 'gpt', 'respuesta')
+    assert reader.get('k') == 'respuesta'  # desde la tabla (otro proceso)
+    assert reader.get('k') == 'respuesta'  # desde memoria
+    assert (reader.counters['db_hits'], reader.counters['memory_hits']) == (1, 1)
+
+    expired = LLMCache(ttl_seconds=0)
+    expired.set('v', 'intent', 'gpt', 'vieja')
+    assert expired.get('v') is None and LLMCache().get('v') is None
+
+def test_memory_and_table_are_bounded(app):
+    cache = LLMCache(memory_entries=2, max_entries=3)
+    for index in range(5):
+        cache.set(f'k{index}', 'intent', 'gpt', f'r{index}')
+    assert list(cache.memory) == ['k3', 'k4']
+    assert {row.key for row in LLMResponseCache.query} == {'k2', 'k3', 'k4'}  # las menos usadas salen
+    stats = cache.stats()
+    assert (stats['db_entries'], stats['memory_evictions'], stats['db_evictions']) == (3, 3, 2)
+
+@pytest.mark.parametrize('value, expected', [
+    (None, True), (True, True), (False, False), (1, True), (0, False),
+    ('true', True), ('False', False), ('0', False), (' 1 ', True)
+])
+def test_use_cache_flag_is_parsed_strictly(value, expected):
+    assert parse_use_cache(value) is expected
+
+@pytest.mark.parametrize('value', ['no', 'yes', '', 2, [], {}])
+def test_use_cache_flag_rejects_other_values(value):
+    with pytest.raises(ValueError):
+        parse_use_cache(value)
+
+def test_intent_analysis_is_cached_and_filled_per_lead(app):
+    response = json.dumps({'intencion': 'SOLICITA_PRESUPUESTO', 'respuesta_sugerida': 'Hola {nombre}, te cotizamos'})
+    ai = _ai(response)
+
+    first = ai.analyze_lead_intent('¿Cuánto cuesta una casa?', {'name': 'Ana'})
+    second = ai.analyze_lead_intent('cuanto cuesta una casa', {'name': 'Luis'})
+    assert len(ai.openai_client.prompts) == 1
+    assert first['respuesta_sugerida'] == 'Hola Ana, te cotizamos'
+    assert second['respuesta_sugerida'] == 'Hola Luis, te cotizamos'
+
+    ai.analyze_lead_intent('cuanto cuesta una casa', {'name': 'Eva'}, use_cache=False)
+    assert len(ai.openai_client.prompts) == 2 and llm_cache.counters['bypassed'] >= 1
+
+def test_invalid_intent_json_is_not_cached(app):
+    ai = _ai('esto no es JSON', json.dumps({'intencion': 'CONSULTA_GENERAL'}))
+    assert 'intent' in ai.analyze_lead_intent('Hola', {'name': 'Ana'})  # análisis de respaldo
+    assert ai.analyze_lead_intent('Hola', {'name': 'Ana'}) == {'intencion': 'CONSULTA_GENERAL'}
+    assert len(ai.openai_client.prompts) == 2
+
+def test_personalized_messages_are_cached_per_lead_inputs(app, make_lead):
+    ai = _ai('Mensaje para Ana', 'Mensaje para Luis', 'Mensaje nuevo para Ana', 'Mensaje para Ana interesada')
+    ana = make_lead(name='Ana', company='Obras SA', status=LeadStatus.INTERESADO, interest_level=4)
+    luis = make_lead(name='Luis', company=None, status=LeadStatus.INTERESADO, interest_level=4)
+
+    assert ai.generate_personalized_message(ana, 'offer') == 'Mensaje para Ana'
+    # Mismo perfil pero otro nombre y sin empresa: otra clave, con los datos reales en el prompt
+    assert ai.generate_personalized_message(luis, 'offer') == 'Mensaje para Luis'
+    assert 'Ana - Obras SA' in ai.openai_client.prompts[0]
+    assert 'Luis - Sin empresa' in ai.openai_client.prompts[1] and '{empresa}' not in ai.openai_client.prompts[1]
+
+    # Los mismos datos (normalizados) reutilizan la respuesta sin consultar al modelo
+    assert ai.generate_personalized_message(ana, 'offer') == 'Mensaje para Ana'
+    twin = make_lead(name='  ANA ', company='OBRAS SA.', status=LeadStatus.INTERESADO, interest_level=4)
+    assert ai.generate_personalized_message(twin, 'offer') == 'Mensaje para Ana'
+    assert len(ai.openai_client.prompts) == 2
+
+    assert ai.generate_personalized_message(ana, 'offer', use_cache=False) == 'Mensaje nuevo para Ana'
+    ana.interest_level = 5
+    assert ai.generate_personalized_message(ana, 'offer') == 'Mensaje para Ana interesada'
+    assert len(ai.openai_client.prompts) == 4
+    assert db.session.query(LLMResponseCache).filter(LLMResponseCache.kind == 'message:offer').count() == 3
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Pruebas de las migraciones idempotentes y de los índices declarados (migrations.py, db_utils.py)
+"""
+
+import os
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+from models import db, Lead, get_database_uri
+from migrations import add_missing_columns, apply_schema_upgrades, create_missing_indexes
+from db_utils import DatabaseManager, HOT_QUERIES, app_database_path
+
+def _index_names(table_name):
+    return {index['name'] for index in inspect(db.engine).get_indexes(table_name)}
+
+def test_hot_queries_use_an_index(app):
+    report = DatabaseManager(db.engine.url.database).explain_hot_queries()
+
+    assert [item['query'] for item in report] == list(HOT_QUERIES)
+    for item in report:
+        assert 'error' not in item, item
+        assert item['indexes'] and not item['full_scan'], item
+
+@pytest.mark.parametrize('render', [None, 'true'])
+def test_explain_defaults_to_the_app_database(monkeypatch, render):
+    if render:
+        monkeypatch.setenv('RENDER', render)
+    else:
+        monkeypatch.delenv('RENDER', raising=False)
+    # La misma resolución que hace Flask-SQLAlchemy para la app de dashboard.py
+    app = Flask('dashboard', root_path=os.path.dirname(os.path.abspath(__file__)))
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+    engine_db = SQLAlchemy(app)
+    with app.app_context():
+        assert app_database_path() == engine_db.engine.url.database
+        engine_db.engine.dispose()
+
+def test_missing_indexes_are_created_on_an_existing_database(app):
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_lead_created_at_id'))
+        connection.execute(text('DROP INDEX ix_message_lead_id_created_at'))
+    assert 'ix_lead_created_at_id' not in _index_names('lead')
+
+    assert set(create_missing_indexes()) == {'ix_lead_created_at_id', 'ix_message_lead_id_created_at'}
+    assert 'ix_lead_created_at_id' in _index_names('lead')
+    assert create_missing_indexes() == []
+
+def test_missing_columns_are_added_without_losing_rows(app, make_lead):
+    lead = make_lead(name='Lead Existente')
+    with db.engine.begin() as connection:
+        connection.execute(text('ALTER TABLE lead DROP COLUMN last_inbound_at'))
+    db.session.expire_all()
+
+    assert add_missing_columns() == ['lead.last_inbound_at']
+    apply_schema_upgrades()  # idempotente: una segunda pasada no cambia nada
+    assert add_missing_columns() == []
+    assert db.session.get(Lead, lead.id).name == 'Lead Existente'
+
+def test_not_null_is_dropped_keeping_rows_and_indexes(app, make_lead):
+    from migrations import relax_not_null_columns
+    from models import Message
+    lead = make_lead()
+    db.session.add(Message(lead_id=lead.id, content='Hola'))
+    db.session.commit()
+    # Tabla message como la creaban las versiones anteriores: lead_id NOT NULL
+    with db.engine.begin() as connection:
+        ddl = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'message'")).scalar()
+        connection.execute(text('ALTER TABLE message RENAME TO message_old'))
+        connection.execute(text(ddl.replace('lead_id INTEGER', 'lead_id INTEGER NOT NULL')))
+        connection.execute(text('INSERT INTO message SELECT * FROM message_old'))
+        connection.execute(text('DROP TABLE message_old'))
+    assert not {col['name']: col for col in inspect(db.engine).get_columns('message')}['lead_id']['nullable']
+
+    assert relax_not_null_columns() == ['message.lead_id']
+    apply_schema_upgrades()
+    assert relax_not_null_columns() == []
+    assert 'ix_message_status_next_attempt_at' in _index_names('message')
+    assert [(row.lead_id, row.content) for row in db.session.execute(text('SELECT lead_id, content FROM message'))] == [(lead.id, 'Hola')]
+    db.session.add(Message(lead_id=None, to_number='+541155559000', content='Aviso'))
+    db.session.commit()
+
+def test_message_template_switches_to_autoincrement_above_stored_versions(app):
+    from migrations import enable_sqlite_autoincrement
+    from models import MessageTemplate
+    db.session.add(MessageTemplate(name='Vigente', category='welcome', content='Hola'))
+    db.session.commit()
+    # Tabla creada por versiones anteriores (sin AUTOINCREMENT) y una versión guardada de la plantilla 5, ya borrada
+    with db.engine.begin() as connection:
+        ddl = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'message_template'")).scalar()
+        connection.execute(text('ALTER TABLE message_template RENAME TO message_template_old'))
+        connection.execute(text(ddl.replace(' AUTOINCREMENT', '')))
+        connection.execute(text('INSERT INTO message_template SELECT * FROM message_template_old'))
+        connection.execute(text('DROP TABLE message_template_old'))
+        connection.execute(text(
+            "INSERT INTO message_template_version (template_id, version, content) VALUES (5, 1, 'Borrada')"
+        ))
+
+    assert enable_sqlite_autoincrement() == ['message_template']
+    assert enable_sqlite_autoincrement() == []
+    template = MessageTemplate(name='Nueva', category='offer', content='Chau')
+    db.session.add(template)
+    db.session.commit()
+    assert template.id == 6
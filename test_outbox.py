@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Pruebas del outbox de mensajes salientes: reclamo, reintentos con backoff y lease (outbox.py)
+"""
+
+import time
+from datetime import datetime, timedelta
+from models import db, Lead, Message, normalize_phone
+from dispatcher import OutboundDispatcher, build_twilio_client
+from fake_twilio import FakeTwilioServer
+import outbox
+from outbox import claim_batch, enqueue_message, get_outbox_stats, process_batch, promote_due_scheduled
+
+def _dispatcher(server, timeout=5):
+    client = build_twilio_client('ACtest', 'token', pool_size=4, base_url=server.base_url, timeout=timeout)
+    return OutboundDispatcher(client, '+5491100000000', workers=4, rate=0)
+
+def _format_phone(phone_number):
+    return normalize_phone(phone_number) or phone_number
+
+def _enqueue(lead, count=1):
+    messages = [enqueue_message(lead.id, f'Mensaje {index}') for index in range(count)]
+    db.session.commit()
+    return messages
+
+def _make_ready(message):
+    message.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+def test_claimed_rows_are_not_claimed_twice(app, make_lead):
+    _enqueue(make_lead(), count=3)
+
+    first = claim_batch(2)
+    second = claim_batch(10)
+    assert len(first) == 2 and len(second) == 1
+    assert not {row['message_id'] for row in first} & {row['message_id'] for row in second}
+    assert first[0]['claimed_by'] != second[0]['claimed_by']
+    assert claim_batch(10) == []
+
+def test_sent_messages_store_sid_and_leave_the_queue(app, make_lead):
+    messages = _enqueue(make_lead(), count=2)
+    with FakeTwilioServer() as server:
+        totals = process_batch(_dispatcher(server), _format_phone)
+
+    assert totals == {'claimed': 2, 'sent': 2, 'retrying': 0, 'failed': 0, 'lost': 0}
+    for message in messages:
+        db.session.refresh(message)
+        assert message.status == 'sent' and message.twilio_sid.startswith('SM')
+        assert message.locked_until is None and message.attempts == 1
+
+def test_transient_errors_back_off_until_max_attempts(app, make_lead, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_MAX_ATTEMPTS', 2)
+    [message] = _enqueue(make_lead())
+
+    with FakeTwilioServer(failure_rate=1.0, error_status=503) as server:
+        dispatcher = _dispatcher(server)
+        assert process_batch(dispatcher, _format_phone)['retrying'] == 1
+        db.session.refresh(message)
+        assert message.status == 'pending' and message.last_error
+        # Backoff: base * 2^(intento-1) con hasta 10% de jitter
+        delay = (message.next_attempt_at - datetime.utcnow()).total_seconds()
+        assert outbox.OUTBOX_BACKOFF_SECONDS - 2 <= delay <= outbox.OUTBOX_BACKOFF_SECONDS * 1.1
+        assert process_batch(dispatcher, _format_phone)['claimed'] == 0  # todavía no le toca
+
+        _make_ready(message)
+        assert process_batch(dispatcher, _format_phone)['failed'] == 1
+    db.session.refresh(message)
+    assert (message.status, message.attempts) == ('failed', 2)
+
+def test_rejected_numbers_fail_without_retry(app, make_lead):
+    [message] = _enqueue(make_lead())
+    with FakeTwilioServer(failure_rate=1.0, error_status=400) as server:
+        assert process_batch(_dispatcher(server), _format_phone)['failed'] == 1
+    db.session.refresh(message)
+    assert (message.status, message.attempts) == ('failed', 1)
+
+def test_worker_that_lost_its_lease_cannot_overwrite_the_new_claim(app, make_lead, monkeypatch):
+    [message] = _enqueue(make_lead())
+    stale = claim_batch(1)
+
+    # El lease vence y otro proceso reclama y envía el mismo mensaje
+    message.locked_until = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    with FakeTwilioServer() as server:
+        assert process_batch(_dispatcher(server), _format_phone)['sent'] == 1
+    db.session.refresh(message)
+    sid = message.twilio_sid
+
+    # El proceso viejo termina después con un error: su resultado se descarta
+    monkeypatch.setattr(outbox, 'claim_batch', lambda limit: stale)
+    with FakeTwilioServer(failure_rate=1.0, error_status=400) as server:
+        totals = process_batch(_dispatcher(server), _format_phone)
+    assert totals['lost'] == 1 and totals['failed'] == 0
+    db.session.refresh(message)
+    assert (message.status, message.twilio_sid) == ('sent', sid)
+
+def test_unanswered_requests_time_out_and_are_retried(app, make_lead):
+    [message] = _enqueue(make_lead())
+    started = time.monotonic()
+    with FakeTwilioServer(latency=3) as server:
+        totals = process_batch(_dispatcher(server, timeout=0.5), _format_phone)
+
+    assert time.monotonic() - started < 2.5
+    assert totals['retrying'] == 1
+    db.session.refresh(message)
+    assert message.status == 'pending' and message.locked_until is None
+
+def test_worst_case_batch_time_fits_the_default_lease():
+    client = build_twilio_client('ACtest', 'token')
+    dispatcher = OutboundDispatcher(client, '+5491100000000')
+    assert client.http_client.timeout
+    assert dispatcher.worst_case_seconds(outbox.OUTBOX_BATCH_SIZE) < outbox.OUTBOX_CLAIM_TIMEOUT_SECONDS / 2
+
+def _schedule(lead, minutes_from_now):
+    message = Message(lead_id=lead.id, content='Recordatorio', message_type='outbound', status='scheduled',
+                      scheduled_at=datetime.utcnow() + timedelta(minutes=minutes_from_now))
+    db.session.add(message)
+    db.session.commit()
+    return message
+
+def test_due_scheduled_messages_are_promoted_and_sent_through_the_outbox(app, make_lead):
+    lead = make_lead()
+    due = [_schedule(lead, -10), _schedule(lead, -1)]
+    future = _schedule(lead, 30)
+    assert get_outbox_stats()['scheduled']['overdue'] == 2
+
+    assert promote_due_scheduled(limit=1) == 1  # el más atrasado primero
+    assert promote_due_scheduled() == 1
+    assert promote_due_scheduled() == 0
+    for message in due:
+        db.session.refresh(message)
+        assert message.status == 'pending' and message.next_attempt_at == message.scheduled_at
+    db.session.refresh(future)
+    assert future.status == 'scheduled'
+
+    with FakeTwilioServer() as server:
+        assert process_batch(_dispatcher(server), _format_phone)['sent'] == 2
+    lateness = get_outbox_stats()['scheduled']['lateness_last_hour']
+    assert lateness['count'] == 2 and 60 <= lateness['p50_seconds'] <= lateness['max_seconds'] < 700
+
+def test_messages_go_to_the_stored_e164_number_and_format_only_legacy_rows(app, make_lead):
+    normalized = make_lead(phone_number='011 5555-0001')
+    legacy = make_lead(phone_number='011 5555-0002')
+    # Lead anterior a la columna phone_e164 que el backfill todavía no completó
+    Lead.query.filter_by(id=legacy.id).update({'phone_e164': None})
+    db.session.commit()
+    _enqueue(normalized)
+    _enqueue(legacy)
+
+    formatted = []
+    def format_phone(phone_number):
+        formatted.append(phone_number)
+        return _format_phone(phone_number)
+
+    with FakeTwilioServer() as server:
+        assert process_batch(_dispatcher(server), format_phone)['sent'] == 2
+        received = sorted(message['to'] for message in server.received)
+    assert received == ['whatsapp:+541155550001', 'whatsapp:+541155550002']
+    assert formatted == ['011 5555-0002']
+
+def test_weekly_summary_is_queued_for_admins_and_sent_by_the_outbox(app, make_lead):
+    from lead_manager import lead_manager
+    from models import User
+    make_lead()
+    db.session.add_all([
+        User(username='admin', email='admin@nexa.test', password_hash='x', role='admin', phone_number='011 5555-9000'),
+        User(username='sin_tel', email='sintel@nexa.test', password_hash='x', role='admin'),
+        User(username='vendedor', email='ventas@nexa.test', password_hash='x', role='user', phone_number='011 5555-9001'),
+    ])
+    db.session.commit()
+    lead_messages = Message.query.filter(Message.lead_id.isnot(None)).count()
+
+    lead_manager.send_weekly_summary()
+
+    [summary] = Message.query.filter(Message.lead_id.is_(None)).all()
+    assert (summary.status, summary.to_number) == ('pending', '+541155559000')
+    assert 'Resumen Semanal' in summary.content
+    assert Message.query.filter(Message.lead_id.isnot(None)).count() == lead_messages
+
+    with FakeTwilioServer() as server:
+        assert process_batch(_dispatcher(server), _format_phone)['sent'] == 1
+        assert [message['to'] for message in server.received] == ['whatsapp:+541155559000']
+    db.session.refresh(summary)
+    assert summary.status == 'sent' and summary.twilio_sid
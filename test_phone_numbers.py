@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la normalización de teléfonos a E.164 y de la búsqueda de leads por número (models.py)
+"""
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+from models import db, find_lead_by_phone, normalize_phone
+
+@pytest.mark.parametrize('raw, expected', [
+    ('+54 9 11 5555-0001', '+5491155550001'),
+    ('whatsapp:+5491155550001', '+5491155550001'),
+    ('011 5555-0001', '+541155550001'),          # prefijo nacional 0
+    ('11 5555 0001', '+541155550001'),           # sin código de país: Argentina
+    ('(549) 11-5555-0001', '+5491155550001'),
+    ('+1 415 555 0100', '+14155550100'),
+    ('123', None),
+    ('', None),
+])
+def test_normalize_phone(raw, expected):
+    assert normalize_phone(raw) == expected
+
+def test_lookup_finds_the_lead_however_the_number_is_written(app, make_lead):
+    lead = make_lead(phone_number='+54 9 11 5555-0001')
+    assert lead.phone_e164 == '+5491155550001'
+    assert find_lead_by_phone('whatsapp:+5491155550001').id == lead.id
+    assert find_lead_by_phone('5491155550001').id == lead.id
+    assert find_lead_by_phone('+5491155550002') is None
+
+def test_the_same_number_written_differently_is_rejected(app, make_lead):
+    make_lead(phone_number='+5491155550001')
+    with pytest.raises(IntegrityError):
+        make_lead(phone_number='549 11 5555 0001')
+    db.session.rollback()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Pruebas de los rollups diarios de leads y mensajes (rollups.py)
+"""
+
+from datetime import datetime, timedelta
+from models import db, Lead, LeadStatus, LeadSource, LeadDailyStat, Message
+from rollups import backfill_rollups, count_messages_since, lead_rollup_rows, refresh_trailing_rollups
+from lead_manager import lead_manager
+
+def _days_ago(days):
+    return datetime.utcnow() - timedelta(days=days)
+
+def _rollup_snapshot():
+    return sorted(
+        (row.day, row.status.value, row.source.value, row.assigned_to_id, row.lead_count, row.estimated_value)
+        for row in LeadDailyStat.query
+    )
+
+def test_old_lead_converting_today_moves_in_the_rollup(app, make_lead):
+    # Fuera de la ventana que re-agrega la tarea nocturna (ROLLUP_TRAILING_DAYS)
+    lead = make_lead(created_at=_days_ago(45), status=LeadStatus.INTERESADO)
+    make_lead(created_at=_days_ago(45), status=LeadStatus.INTERESADO)
+    backfill_rollups()
+
+    lead.status = LeadStatus.CONVERTIDO
+    db.session.commit()
+    refresh_trailing_rollups()
+
+    analytics = lead_manager.get_lead_analytics(days=60)
+    assert analytics['status_distribution'] == {'convertido': 1, 'interesado': 1}
+    assert analytics['conversions'] == 1
+    assert analytics['conversion_rate'] == 50.0
+
+def test_incremental_rollup_matches_a_full_rebuild(app, make_lead):
+    leads = [make_lead(created_at=_days_ago(days), estimated_value=1000.0) for days in (90, 45, 45, 12, 1)]
+    backfill_rollups()
+
+    leads[0].status = LeadStatus.PERDIDO
+    leads[1].source = LeadSource.REFERIDO
+    leads[2].assigned_to_id = 7
+    leads[3].estimated_value = 2500.0
+    db.session.delete(leads[4])
+    db.session.commit()
+    incremental = _rollup_snapshot()
+
+    backfill_rollups()
+    assert incremental == _rollup_snapshot()
+
+def test_rows_combine_closed_days_with_today_live(app, make_lead):
+    make_lead(created_at=_days_ago(2))
+    backfill_rollups()
+    today_lead = make_lead()  # después del backfill: solo la lectura en vivo lo ve
+    db.session.add(Message(lead_id=today_lead.id, content='Hola', message_type='outbound'))
+    db.session.add(Message(lead_id=today_lead.id, content='Ayer', message_type='outbound', created_at=_days_ago(1)))
+    db.session.commit()
+    backfill_rollups()
+
+    rows = lead_rollup_rows((_days_ago(7)).date())
+    assert sum(row[4] for row in rows) == 2
+    assert count_messages_since((_days_ago(7)).date()) == 2
+    assert count_messages_since(datetime.utcnow().date()) == 1
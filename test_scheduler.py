@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Pruebas del lease de líder y del lock que deja los bucles embebidos en un solo worker (scheduler.py)
+"""
+
+import threading
+from models import db, SchedulerLease
+from scheduler import TASKS, _job_triggers, acquire_lease, release_lease, release_process_lock, start_when_lock_acquired
+
+def test_lease_is_exclusive_until_it_expires(app):
+    assert acquire_lease('web-1', ttl=60)
+    assert acquire_lease('web-1', ttl=60)  # renovación del mismo dueño
+    assert not acquire_lease('web-2', ttl=60)
+
+    # El líder deja de renovar: al vencer, otro proceso lo reemplaza
+    assert acquire_lease('web-1', ttl=-1)
+    assert acquire_lease('web-2', ttl=60)
+    assert not acquire_lease('web-1', ttl=60)
+
+def test_released_lease_is_taken_immediately(app):
+    assert acquire_lease('web-1', ttl=60)
+    release_lease('web-1')
+    assert db.session.query(SchedulerLease).count() == 0
+    assert acquire_lease('web-2', ttl=60)
+
+def test_every_task_has_a_trigger():
+    assert set(TASKS) == set(_job_triggers())
+
+def test_only_the_lock_holder_starts_the_embedded_loops(tmp_path):
+    lock_path = str(tmp_path / 'embedded.lock')
+    first, second = threading.Event(), threading.Event()
+
+    start_when_lock_acquired(lock_path, first.set)
+    assert first.wait(2)
+    # Un segundo worker (otro descriptor del mismo archivo) espera sin arrancar nada
+    waiting = start_when_lock_acquired(lock_path, second.set)
+    assert not second.wait(0.3)
+
+    # El worker que tenía el lock se recicla: el que esperaba toma el relevo
+    release_process_lock(lock_path)
+    assert second.wait(2)
+    waiting.join(1)
+    release_process_lock(lock_path)
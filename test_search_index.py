@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Pruebas del índice de búsqueda FTS5 de leads (search_index.py)
+"""
+
+from models import db, Lead
+from search_index import apply_lead_search, build_match_query, rebuild_search_index, search_index_available
+
+def _search(term):
+    query, rank = apply_lead_search(Lead.query, term)
+    ordering = [rank, Lead.id] if rank is not None else [Lead.id]
+    return [lead.name for lead in query.order_by(*ordering)]
+
+def test_match_query_uses_prefixes_and_drops_operators():
+    assert build_match_query('Juan Pérez') == '"Juan"* "Pérez"*'
+    # Comillas, asteriscos y operadores de FTS5 no llegan a la consulta MATCH
+    assert build_match_query('"ana" OR * -(') == '"ana"* "OR"*'
+    assert build_match_query('  ') == ''
+
+def test_search_by_prefix_ignores_accents_and_ranks_name_first(app, make_lead):
+    assert search_index_available()
+    make_lead(name='Constructora Gómez', company='Otra SA')
+    make_lead(name='María López', company='Gomez Hermanos')
+    make_lead(name='Pedro Ruiz', notes='recomendado por gomez')
+    make_lead(name='Sin relación')
+
+    assert _search('gomez') == ['Constructora Gómez', 'María López', 'Pedro Ruiz']
+    assert _search('mar lop') == ['María López']
+
+def test_index_follows_updates_and_deletes(app, make_lead):
+    lead = make_lead(name='Nombre Viejo')
+    lead.name = 'Nombre Nuevo'
+    db.session.commit()
+    assert _search('viejo') == []
+    assert _search('nuevo') == ['Nombre Nuevo']
+
+    db.session.delete(lead)
+    db.session.commit()
+    assert _search('nuevo') == []
+
+def test_rebuild_indexes_rows_written_without_triggers(app, make_lead):
+    make_lead(name='Lead Existente')
+    db.session.execute(db.text("INSERT INTO lead_fts(lead_fts) VALUES ('delete-all')"))
+    db.session.commit()
+    assert _search('existente') == []
+
+    assert rebuild_search_index()
+    assert _search('existente') == ['Lead Existente']
+
+def test_search_by_partial_or_local_phone_number(app, make_lead):
+    make_lead(name='Con Teléfono', phone_number='+5491155551234')
+    make_lead(name='Otro Número', phone_number='+5491166667777')
+
+    for term in ('5551234', '1155551234', '11 5555 1234', '011 5555-1234', '+54 9 11 5555-1234'):
+        assert _search(term) == ['Con Teléfono'], term
+    # Los textos con letras siguen yendo solo al índice FTS5
+    assert _search('numero') == ['Otro Número']
+    assert _search('12') == []
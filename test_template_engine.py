@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Pruebas del motor de plantillas compiladas (template_engine.py)
+"""
+
+from types import SimpleNamespace
+from template_engine import compile_template, get_compiled, render_for_leads, validate_template
+
+def test_render_fills_known_variables_and_keeps_the_rest():
+    compiled = compile_template('Hola {name} de {company}, te escribe {agent}')
+    assert compiled.variables == {'name', 'company', 'agent'}
+    assert compiled.render({'name': 'Ana', 'company': 'Obras SA'}) == 'Hola Ana de Obras SA, te escribe {agent}'
+
+def test_render_many_matches_render_and_applies_extra():
+    compiled = compile_template('{name}: {offer}')
+    rows = [{'name': 'Ana'}, {'name': 'Luis'}]
+    assert compiled.render_many(rows, extra={'offer': '10%'}) == ['Ana: 10%', 'Luis: 10%']
+    assert compile_template('Sin variables').render_many(rows) == ['Sin variables', 'Sin variables']
+
+def test_render_for_leads_uses_defaults_for_missing_fields():
+    leads = [SimpleNamespace(name='Ana', company=None, phone_number='+5491100000001', email=None)]
+    [text] = render_for_leads(compile_template('{name} ({company}) - {website}'), leads)
+    assert text == 'Ana (tu empresa) - https://nexaconstructora.com.ar'
+
+def test_pack_and_match_round_trip_the_variables():
+    compiled = compile_template('Hola {name}, {name}: tu obra en {city}')
+    values = {'name': 'Ana', 'city': 'Rosario', 'unused': 'x'}
+    assert compiled.pack(values) == '{"city":"Rosario","name":"Ana"}'
+
+    text = compiled.render(values)
+    assert compiled.match(text) == {'name': 'Ana', 'city': 'Rosario'}
+    assert compiled.match('Hola Ana, Luis: tu obra en Rosario') is None  # la misma variable difiere
+    assert compiled.match('Otro texto') is None
+
+def test_compiled_templates_are_cached_by_id_until_the_version_changes():
+    template = SimpleNamespace(id=9001, version=1, content='Hola {name}')
+    first = get_compiled(template)
+    assert get_compiled(SimpleNamespace(id=9001, version=1, content='ignorado')) is first
+
+    template.version, template.content = 2, 'Buen día {name}'
+    assert get_compiled(template).render({'name': 'Ana'}) == 'Buen día Ana'
+
+def test_validate_template_reports_only_undeclared_variables():
+    assert validate_template('Hola {name}, {promo}') == ['promo']
+    assert validate_template('Hola {name}, {promo}', '{"promo": "2x1"}') == []
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Pruebas de los mensajes guardados como versión de plantilla + variables (template_registry.py)
+"""
+
+import pytest
+from types import SimpleNamespace
+from models import db, Message, MessageTemplate
+from outbox import enqueue_message
+import template_registry
+from template_registry import TemplateVersionConflict, compact_template_messages, render_stored, store_template_version
+
+def _template(content):
+    template = MessageTemplate(name='Promo', category='offer', content=content)
+    db.session.add(template)
+    db.session.commit()
+    return template
+
+def _plain_message(lead, content):
+    message = Message(lead_id=lead.id, content=content, message_type='outbound')
+    db.session.add(message)
+    db.session.commit()
+    return message
+
+def test_messages_keep_rendering_with_the_version_they_were_sent_with(app, make_lead):
+    lead = make_lead()
+    template = _template('Hola {name}, tenemos una promo')
+    old = enqueue_message(lead.id, template=template, values={'name': 'Ana', 'company': 'sin usar'})
+    db.session.commit()
+    assert (old.content, old.variables) == ('', '{"name":"Ana"}')
+
+    template.content = 'Buen día {name}, la promo sigue'
+    db.session.commit()
+    new = enqueue_message(lead.id, template=template, values={'name': 'Ana'})
+    plain = enqueue_message(lead.id, content='Texto libre')
+    db.session.commit()
+
+    assert render_stored([old, new, plain]) == [
+        'Hola Ana, tenemos una promo', 'Buen día Ana, la promo sigue', 'Texto libre'
+    ]
+
+def test_compaction_only_rewrites_texts_the_template_reproduces(app, make_lead):
+    lead = make_lead()
+    _template('Hola {name}, te escribimos de Nexa Constructora por tu consulta sobre {topic}')
+    full = _plain_message(lead, 'Hola Ana, te escribimos de Nexa Constructora por tu consulta sobre techos')
+    other = _plain_message(lead, 'Gracias por escribirnos')
+
+    totals = compact_template_messages(chunk_size=1)
+    assert (totals['scanned'], totals['compacted']) == (2, 1) and totals['bytes_saved'] > 0
+
+    db.session.refresh(full)
+    db.session.refresh(other)
+    assert full.template_id is not None and full.content == ''
+    assert other.template_id is None
+    assert render_stored([full, other]) == [
+        'Hola Ana, te escribimos de Nexa Constructora por tu consulta sobre techos', 'Gracias por escribirnos'
+    ]
+    assert compact_template_messages()['compacted'] == 0
+
+def test_stored_version_with_other_content_is_rejected(app, make_lead):
+    lead = make_lead()
+    template = _template('Hola {name}, OFERTA VIEJA')
+    enqueue_message(lead.id, template=template, values={'name': 'Ana'})
+    db.session.commit()
+
+    # Misma (id, versión) con otro texto: no se guarda ni se encola en silencio
+    reused = SimpleNamespace(id=template.id, version=template.version, content='Hola {name}, OFERTA NUEVA')
+    with pytest.raises(TemplateVersionConflict):
+        enqueue_message(lead.id, template=reused, values={'name': 'Ana'})
+    db.session.rollback()
+    store_template_version(template)  # el mismo texto sigue siendo idempotente
+
+def test_deleting_a_template_drops_its_cached_versions(app, make_lead):
+    lead = make_lead()
+    template = _template('Hola {name}')
+    message = enqueue_message(lead.id, template=template, values={'name': 'Ana'})
+    db.session.commit()
+    assert render_stored([message]) == ['Hola Ana']
+    key = (template.id, template.version)
+    assert key in template_registry._versions
+
+    db.session.delete(template)
+    db.session.commit()
+    assert key not in template_registry._versions
+    # La versión guardada sigue en la base: el mensaje ya enviado se sigue leyendo igual
+    assert render_stored([message]) == ['Hola Ana']
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Pruebas del registro de plantillas y de su invalidación por contador de versión (template_registry.py)
+"""
+
+from sqlalchemy import text
+from models import db, MessageTemplate
+from counters import TEMPLATES_VERSION_KEY, apply_deltas, read_counters
+from template_registry import template_registry
+
+def _version():
+    return read_counters([TEMPLATES_VERSION_KEY])[TEMPLATES_VERSION_KEY]
+
+def _add(**values):
+    template = MessageTemplate(**values)
+    db.session.add(template)
+    db.session.commit()
+    return template
+
+def test_lookups_return_the_first_active_template(app):
+    _add(name='Bienvenida', category='welcome', content='Hola', is_active=False)
+    active = _add(name='Bienvenida', category='welcome', content='Hola {name}')
+    _add(name='Bienvenida', category='welcome', content='Buen día')
+
+    assert template_registry.get_by_name('Bienvenida').id == active.id
+    assert template_registry.get_by_category('welcome').content == 'Hola {name}'
+    assert len(template_registry.active()) == 2
+
+def test_editing_content_bumps_the_template_and_registry_versions(app):
+    template = _add(name='Seguimiento', category='follow_up', content='Hola {name}')
+    before = _version()
+
+    template.content = 'Buen día {name}'
+    db.session.commit()
+    assert template.version == 2 and _version() == before + 1
+    assert template_registry.get(template.id).content == 'Buen día {name}'
+
+    template.is_active = True  # sin cambios reales: no hay versión nueva
+    db.session.commit()
+    assert _version() == before + 1
+
+def test_change_from_another_process_is_seen_on_the_next_request(app):
+    template = _add(name='Promo', category='offer', content='Oferta A')
+    assert template_registry.get(template.id).content == 'Oferta A'
+
+    # Otro proceso edita la plantilla e incrementa el contador en su transacción
+    db.session.execute(text("UPDATE message_template SET content = 'Oferta B' WHERE id = :id"), {'id': template.id})
+    apply_deltas(db.session.connection(), {TEMPLATES_VERSION_KEY: 1})
+    db.session.commit()
+
+    # El contador se consulta una vez por request: dentro de la misma sigue la copia anterior
+    assert template_registry.get(template.id).content == 'Oferta A'
+    with app.app_context():
+        assert template_registry.get(template.id).content == 'Oferta B'
+
+def test_rolled_back_change_does_not_bump_the_version(app):
+    template = _add(name='Promo', category='offer', content='Oferta A')
+    before = _version()
+
+    template.content = 'Oferta B'
+    db.session.flush()
+    db.session.rollback()
+    assert _version() == before
+    assert template_registry.get(template.id).content == 'Oferta A'
+
+def test_deleted_template_ids_are_not_reused(app):
+    from template_engine import get_compiled
+    _add(name='Base', category='welcome', content='Hola {name}')
+    old = _add(name='Oferta', category='offer', content='Hola {name}, OFERTA VIEJA')
+    assert get_compiled(template_registry.get(old.id)).render({'name': 'Ana'}) == 'Hola Ana, OFERTA VIEJA'
+    old_id = old.id
+    db.session.delete(old)
+    db.session.commit()
+
+    new = _add(name='Oferta', category='offer', content='Hola {name}, OFERTA NUEVA')
+    assert new.id != old_id
+    assert get_compiled(template_registry.get(new.id)).render({'name': 'Ana'}) == 'Hola Ana, OFERTA NUEVA'